@@ -11,8 +11,9 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from flask import Flask, render_template
-from database import init_database, add_sample_data
+from database import init_database, run_migrations, add_sample_data, init_app, get_performance_report
 from routes import register_blueprints
+from services.payment_jobs import resume_payment_jobs
 
 
 def create_app():
@@ -27,10 +28,24 @@ def create_app():
     
     # Initialize the database
     init_database()
+    app.logger.info('SQLite settings in effect: %s', get_performance_report())
+    
+    # Bring the schema up to date (indexes, new tables)
+    applied = run_migrations()
+    if applied:
+        app.logger.info('Applied schema migrations: %s', applied)
     
     # Add sample data for testing and demonstration
     add_sample_data()
     
+    # Share one connection and transaction per request
+    init_app(app)
+    
+    # Pick up payment jobs left unfinished by the last run
+    resumed = resume_payment_jobs()
+    if any(resumed.values()):
+        app.logger.info('Payment jobs after restart: %s', resumed)
+    
     # Register all route blueprints
     register_blueprints(app)
     
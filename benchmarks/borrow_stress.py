@@ -0,0 +1,103 @@
+"""
+Multi-threaded stress benchmark for the borrow path.
+
+Many threads race to borrow a small number of copies through
+borrow_book_by_patron. Reports borrows/sec and checks that no copy was
+oversold: available_copies never goes negative and every active loan is
+backed by a claimed copy.
+
+Usage:
+    python -m benchmarks.borrow_stress --threads 16 --books 50 --copies 10
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import database
+from services.library_service import borrow_book_by_patron
+
+
+def run_borrow_stress(threads: int = 16, books: int = 50, copies: int = 10, attempts: int = 50) -> dict:
+    """
+    Run the stress test against the current database.DATABASE.
+
+    Each thread plays a different patron range and tries `attempts` borrows
+    spread over the catalog. Returns throughput and consistency figures.
+    """
+    book_ids = []
+    for i in range(books):
+        isbn = f"978{i:010d}"
+        database.insert_book(f"Stress Book {i}", "Bench Author", isbn, copies, copies)
+        book_ids.append(database.get_book_by_isbn(isbn)['id'])
+
+    successes = [0] * threads
+    barrier = threading.Barrier(threads)
+
+    def worker(n):
+        barrier.wait()
+        for attempt in range(attempts):
+            # A fresh patron per attempt keeps the loan limit out of the picture
+            patron_id = f"{(n * attempts + attempt) % 1000000:06d}"
+            book_id = book_ids[(n + attempt) % books]
+            ok, _ = borrow_book_by_patron(patron_id, book_id)
+            if ok:
+                successes[n] += 1
+
+    pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    conn = database.get_db_connection()
+    try:
+        min_available = conn.execute('SELECT MIN(available_copies) FROM books').fetchone()[0]
+        claimed = conn.execute('SELECT SUM(total_copies - available_copies) FROM books').fetchone()[0]
+        loans = conn.execute('SELECT COUNT(*) FROM borrow_records WHERE return_date IS NULL').fetchone()[0]
+    finally:
+        conn.close()
+
+    total_attempts = threads * attempts
+    return {
+        'threads': threads,
+        'attempts': total_attempts,
+        'borrows': sum(successes),
+        'elapsed_seconds': elapsed,
+        'attempts_per_second': total_attempts / elapsed if elapsed else 0.0,
+        'borrows_per_second': sum(successes) / elapsed if elapsed else 0.0,
+        'min_available_copies': min_available,
+        'claimed_copies': claimed,
+        'active_loans': loans,
+        'consistent': min_available >= 0 and claimed == loans == sum(successes),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--books', type=int, default=50)
+    parser.add_argument('--copies', type=int, default=10)
+    parser.add_argument('--attempts', type=int, default=50, help='borrow attempts per thread')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE = os.path.join(tmp, 'borrow_stress.db')
+        database.init_database()
+        database.run_migrations()
+        result = run_borrow_stress(args.threads, args.books, args.copies, args.attempts)
+        database.close_pool()
+
+    for key, value in result.items():
+        print(f"{key:>22}: {value:.2f}" if isinstance(value, float) else f"{key:>22}: {value}")
+    return 0 if result['consistent'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Benchmark for the library-wide overdue fines report.
+
+Fills a scratch database with synthetic loans (a share of them open and
+overdue), then times overdue_report() per loan and per patron, with NumPy
+and with the pure-Python fallback.
+
+Usage:
+    python -m benchmarks.fines_report --loans 1000000 --patrons 100000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import database
+from services import fines_report
+
+
+def seed_loans(loans: int, patrons: int, open_share: float = 0.3, seed: int = 1):
+    """Insert `loans` borrow records in one transaction; `open_share` of them not returned."""
+    rng = random.Random(seed)
+    today = database.today_epoch_day()
+
+    def rows():
+        for _ in range(loans):
+            due_day = today - rng.randrange(-14, 60)
+            returned = rng.random() >= open_share
+            due = database.date_from_epoch_day(due_day).isoformat()
+            yield (f"{rng.randrange(patrons):06d}", rng.randrange(1, 4),
+                   database.date_from_epoch_day(due_day - 14).isoformat(), due,
+                   due if returned else None, due_day - 14, due_day, due_day if returned else None)
+
+    conn = database.get_standalone_connection()
+    try:
+        with database.write_transaction(conn):
+            conn.executemany('''
+                INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date,
+                                            borrow_day, due_day, return_day)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows())
+    finally:
+        conn.close()
+
+
+def run_fines_benchmark(top: int = 10) -> dict:
+    """Time each report variant against the current database.DATABASE."""
+    results = {}
+    numpy = fines_report.np
+    engines = [('numpy', numpy), ('python', None)] if numpy is not None else [('python', None)]
+    for engine, module in engines:
+        fines_report.np = module
+        try:
+            for by_patron in (False, True):
+                started = time.perf_counter()
+                report = fines_report.overdue_report(top=top, by_patron=by_patron)
+                label = f"{engine}_{'patrons' if by_patron else 'loans'}_seconds"
+                results[label] = time.perf_counter() - started
+        finally:
+            fines_report.np = numpy
+    results['overdue_loans'] = report['overdue_loans']
+    results['total_fees'] = report['total_fees']
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--loans', type=int, default=1000000)
+    parser.add_argument('--patrons', type=int, default=100000)
+    parser.add_argument('--open-share', type=float, default=0.3, help='share of loans not yet returned')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE = os.path.join(tmp, 'fines_report.db')
+        database.init_database()
+        database.run_migrations()
+        started = time.perf_counter()
+        seed_loans(args.loans, args.patrons, args.open_share)
+        print(f"{'seed_seconds':>24}: {time.perf_counter() - started:.2f}")
+        result = run_fines_benchmark()
+        database.close_pool()
+
+    for key, value in result.items():
+        print(f"{key:>24}: {value:.2f}" if isinstance(value, float) else f"{key:>24}: {value}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""
+Benchmark for the late fee payment path under simulated gateway latency.
+
+Gives each synthetic patron an overdue loan, then has a pool of threads
+(the desk terminals) pay each fee with pay_late_fees and refund it with
+refund_late_fee_payment, through a PaymentGateway backed by one of the
+gateway simulator profiles. Reports throughput, latency percentiles per
+operation and the outcomes seen.
+
+Usage:
+    python -m benchmarks.payment_path --patrons 500 --threads 16 --profile realistic
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import database
+from services.gateway_simulator import make_simulator, SIMULATOR_PROFILES
+from services.library_service import pay_late_fees, refund_late_fee_payment
+from services.payment_service import PaymentGateway
+
+
+def seed_overdue_loans(patrons: int, days_overdue: int = 10) -> list:
+    """One book and one overdue loan per patron; returns (patron_id, book_id) pairs."""
+    due = datetime.now() - timedelta(days=days_overdue)
+    borrowed = due - timedelta(days=14)
+    conn = database.get_standalone_connection()
+    try:
+        with database.write_transaction(conn):
+            conn.executemany('''
+                INSERT INTO books (title, author, isbn, total_copies, available_copies)
+                VALUES (?, 'Benchmark', ?, 1, 0)
+            ''', [(f"Book {n}", f"{9800000000000 + n}") for n in range(patrons)])
+            books = [row[0] for row in conn.execute(
+                "SELECT id FROM books WHERE author = 'Benchmark' ORDER BY id").fetchall()]
+            pairs = [(f"{100000 + n:06d}", book_id) for n, book_id in enumerate(books)]
+            conn.executemany(database.INSERT_BORROW_SQL, [
+                (patron_id, book_id, borrowed.isoformat(), due.isoformat(),
+                 database.epoch_day(borrowed), database.epoch_day(due)) for patron_id, book_id in pairs])
+    finally:
+        conn.close()
+    return pairs
+
+
+def percentiles(samples: list) -> dict:
+    """p50/p95/p99/max of a list of seconds, in milliseconds."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(share):
+        return round(ordered[min(len(ordered) - 1, int(share * len(ordered)))] * 1000, 1)
+    return {'p50_ms': at(0.50), 'p95_ms': at(0.95), 'p99_ms': at(0.99), 'max_ms': round(ordered[-1] * 1000, 1)}
+
+
+def _outcome(success: bool, message: str) -> str:
+    """'ok', or the kind of failure (the message up to its first colon)."""
+    return 'ok' if success else message.split(':')[0]
+
+
+def run_payment_benchmark(patrons: int = 500, threads: int = 16, profile: str = 'realistic',
+                          seed: int = 1) -> dict:
+    """Seed and run the payment path against the current database.DATABASE."""
+    pairs = seed_overdue_loans(patrons)
+    simulator = make_simulator(profile, seed=seed)
+    timings = {'pay': [], 'refund': []}
+    outcomes = Counter()
+    lock = threading.Lock()
+
+    def desk(pair):
+        patron_id, book_id = pair
+        gateway = PaymentGateway(simulator=simulator)
+        started = time.perf_counter()
+        success, message, transaction_id = pay_late_fees(patron_id, book_id, gateway)
+        paid = time.perf_counter()
+        results = [('pay', paid - started, f"pay {_outcome(success, message)}")]
+        if success:
+            refunded, message = refund_late_fee_payment(transaction_id, 3.25, gateway)
+            results.append(('refund', time.perf_counter() - paid, f"refund {_outcome(refunded, message)}"))
+        with lock:
+            for operation, seconds, outcome in results:
+                timings[operation].append(seconds)
+                outcomes[outcome] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(desk, pairs))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'profile': profile,
+        'patrons': patrons,
+        'threads': threads,
+        'elapsed_seconds': round(elapsed, 2),
+        'payments_per_second': round(len(timings['pay']) / elapsed, 1) if elapsed > 0 else 0.0,
+        'pay': percentiles(timings['pay']),
+        'refund': percentiles(timings['refund']),
+        'outcomes': dict(outcomes),
+        'simulator': simulator.stats(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--patrons', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--profile', choices=SIMULATOR_PROFILES, default='realistic')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE = os.path.join(tmp, 'payment_path.db')
+        database.init_database()
+        database.run_migrations()
+        result = run_payment_benchmark(args.patrons, args.threads, args.profile, args.seed)
+        database.close_pool()
+
+    for key, value in result.items():
+        print(f"{key:>20}: {value}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""
+Benchmark for the payment reconciliation job.
+
+Fills a scratch database with settled payments, then reconciles them
+against a simulated gateway that answers each status check after a fixed
+delay (0.3 s, like PaymentGateway.verify_payment_status). A few charges are
+made to disagree with the ledger so the discrepancy report has content.
+Reports checks per second against RECONCILE_TARGET_PER_SECOND and the time
+the same checks would take one at a time.
+
+Usage:
+    python -m benchmarks.reconciliation --transactions 2000 --workers 16
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import database
+from services.reconciliation import reconcile_payments, RECONCILE_WORKERS, RECONCILE_TARGET_PER_SECOND
+
+
+class SimulatedGateway:
+    """Answers status checks from a dict of charges after `latency` seconds."""
+
+    def __init__(self, charges: dict, latency: float = 0.3):
+        self.charges = charges
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def verify_payment_status(self, transaction_id: str) -> dict:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        charge = self.charges.get(transaction_id)
+        if charge is None:
+            return {"status": "not_found", "message": "Transaction not found"}
+        return dict(charge, transaction_id=transaction_id)
+
+
+def seed_payments(transactions: int, mismatch_every: int = 50, seed: int = 1) -> dict:
+    """
+    Insert `transactions` paid payments and return the gateway's view of them.
+
+    Every `mismatch_every`-th charge is missing at the gateway, refunded, or
+    recorded for a different amount, in turn.
+    """
+    rng = random.Random(seed)
+    now = datetime.now().isoformat()
+    rows, charges = [], {}
+    for n in range(transactions):
+        txn = f"txn_{n:06d}"
+        amount = round(rng.randrange(25, 1500, 25) / 100, 2)
+        rows.append((f"{txn}:key", f"{n % 1000:06d}", n % 50 + 1, n + 1, amount,
+                     database.PAYMENT_PAID, txn, now, now))
+        charges[txn] = {"status": "completed", "amount": amount}
+        if mismatch_every and n % mismatch_every == mismatch_every - 1:
+            fault = (n // mismatch_every) % 3
+            if fault == 0:
+                del charges[txn]
+            elif fault == 1:
+                charges[txn]["status"] = "refunded"
+            else:
+                charges[txn]["amount"] = round(amount + 1, 2)
+
+    conn = database.get_standalone_connection()
+    try:
+        with database.write_transaction(conn):
+            conn.executemany('''
+                INSERT INTO payments (idempotency_key, patron_id, book_id, loan_id, amount, status,
+                                      transaction_id, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+    finally:
+        conn.close()
+    return charges
+
+
+def run_reconciliation_benchmark(transactions: int = 2000, workers: int = RECONCILE_WORKERS,
+                                 latency: float = 0.3, mismatch_every: int = 50) -> dict:
+    """Seed and reconcile against the current database.DATABASE; returns throughput figures."""
+    gateway = SimulatedGateway(seed_payments(transactions, mismatch_every), latency)
+    report = reconcile_payments(lambda: gateway, workers=workers)
+    rerun = reconcile_payments(lambda: gateway, workers=workers)
+    return {
+        'transactions': transactions,
+        'workers': workers,
+        'elapsed_seconds': report['elapsed_seconds'],
+        'per_second': report['per_second'],
+        'target_per_second': RECONCILE_TARGET_PER_SECOND,
+        'meets_target': report['per_second'] >= RECONCILE_TARGET_PER_SECOND,
+        'serial_estimate_seconds': round(transactions * latency, 1),
+        'discrepancies': report['discrepancies'],
+        'gateway_calls': gateway.calls,
+        'rerun_checked': rerun['checked'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--transactions', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=RECONCILE_WORKERS)
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds per status check')
+    parser.add_argument('--mismatch-every', type=int, default=50, help='1 in N charges disagrees (0: none)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE = os.path.join(tmp, 'reconciliation.db')
+        database.init_database()
+        database.run_migrations()
+        result = run_reconciliation_benchmark(args.transactions, args.workers, args.latency, args.mismatch_every)
+        database.close_pool()
+
+    for key, value in result.items():
+        print(f"{key:>24}: {value:.2f}" if isinstance(value, float) else f"{key:>24}: {value}")
+    return 0 if result['meets_target'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Command line tools for the Library Management System.
+
+Usage:
+    python cli.py import-books books.csv --errors rejected.csv
+    python cli.py import-books books.jsonl --format jsonl
+    python cli.py export-books --format csv -o books.csv
+    python cli.py export-borrows --patron-id 123456
+    python cli.py overdue-report --by-patron --top 20
+    python cli.py update-fines    # once a day, shortly after midnight
+    python cli.py reconcile-payments --since 2024-06-01
+    python cli.py gateway-stub --port 8765    # then PAYMENT_GATEWAY_URL=http://127.0.0.1:8765
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+from datetime import date, datetime
+
+import database
+from database import init_database, run_migrations, update_fines_ledger
+from services.fines_report import overdue_report, REPORT_SORTS, REPORT_TOP
+from services.catalog_export import export_books, export_borrow_records, EXPORT_FORMATS
+from services.catalog_import import import_books, detect_format, IMPORT_FIELDS, IMPORT_BATCH_SIZE, IMPORT_FORMATS
+from services.gateway_stub import StubGatewayServer
+from services.reconciliation import reconcile_payments, RECONCILE_WORKERS
+
+
+def _import_books(args) -> int:
+    fmt = args.format or detect_format(args.file)
+    error_file = open(args.errors, 'w', newline='', encoding='utf-8') if args.errors else None
+    error_sink = None
+    if error_file is not None:
+        writer = csv.writer(error_file)
+        writer.writerow(('line', 'error') + IMPORT_FIELDS)
+
+        def write_error_row(line_number, record, message):
+            record = record or {}
+            writer.writerow([line_number, message] + [record.get(f, '') for f in IMPORT_FIELDS])
+
+        error_sink = write_error_row
+
+    try:
+        with open(args.file, newline='', encoding='utf-8') as stream:
+            report = import_books(stream, fmt, args.batch_size, error_sink)
+    finally:
+        if error_file is not None:
+            error_file.close()
+
+    report.pop('errors')
+    print(json.dumps(report, indent=2))
+    return 0 if report['rejected'] == 0 else 1
+
+
+def _write_export(chunks, output) -> int:
+    if output:
+        with open(output, 'w', newline='', encoding='utf-8') as f:
+            f.writelines(chunks)
+    else:
+        sys.stdout.writelines(chunks)
+    return 0
+
+
+def _export_books(args) -> int:
+    return _write_export(export_books(args.format), args.output)
+
+
+def _export_borrows(args) -> int:
+    return _write_export(export_borrow_records(args.format, args.patron_id), args.output)
+
+
+def _overdue_report(args) -> int:
+    report = overdue_report(as_of=args.as_of, sort=args.sort, top=args.top or None,
+                            by_patron=args.by_patron)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+def _update_fines(args) -> int:
+    today = database.epoch_day(args.as_of) if args.as_of else None
+    print(json.dumps(update_fines_ledger(today), indent=2))
+    return 0
+
+
+def _reconcile_payments(args) -> int:
+    since = datetime.combine(args.since, datetime.min.time()) if args.since else None
+    report = reconcile_payments(workers=args.workers, since=since)
+    print(json.dumps(report, indent=2))
+    return 0 if report['discrepancies'] == 0 else 1
+
+
+def _gateway_stub(args) -> int:
+    with StubGatewayServer(args.host, args.port, args.latency, webhook_secret=args.webhook_secret,
+                           callback_delay=args.callback_delay,
+                           duplicate_callbacks=args.duplicate_callbacks) as stub:
+        print(f"Stub payment gateway listening on {stub.url} (Ctrl+C to stop)", flush=True)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        print(json.dumps(stub.stats(), indent=2))
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='cli.py', description='Library Management System tools')
+    parser.add_argument('--database', help=f'SQLite database file (default: {database.DATABASE})')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    imp = commands.add_parser('import-books', help='Bulk import books from a CSV or JSONL file')
+    imp.add_argument('file', help='CSV with a title,author,isbn,total_copies header, or JSON lines')
+    imp.add_argument('--format', choices=IMPORT_FORMATS, help='File format (default: from the extension)')
+    imp.add_argument('--errors', help='Write rejected rows to this CSV file')
+    imp.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help='Rows per transaction')
+    imp.set_defaults(handler=_import_books)
+
+    books = commands.add_parser('export-books', help='Stream the catalog as NDJSON or CSV')
+    books.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+    books.add_argument('--output', '-o', help='Output file (default: stdout)')
+    books.set_defaults(handler=_export_books)
+
+    borrows = commands.add_parser('export-borrows', help='Stream borrow records as NDJSON or CSV')
+    borrows.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+    borrows.add_argument('--patron-id', help='Only export this patron\'s history')
+    borrows.add_argument('--output', '-o', help='Output file (default: stdout)')
+    borrows.set_defaults(handler=_export_borrows)
+
+    overdue = commands.add_parser('overdue-report', help='Overdue loans and fines across the library')
+    overdue.add_argument('--sort', choices=REPORT_SORTS, default='fee')
+    overdue.add_argument('--top', type=int, default=REPORT_TOP, help='Entries to print (0 for all)')
+    overdue.add_argument('--by-patron', action='store_true', help='Per-patron totals instead of loans')
+    overdue.add_argument('--as-of', type=date.fromisoformat, help='Charge fees up to this date (YYYY-MM-DD)')
+    overdue.set_defaults(handler=_overdue_report)
+
+    fines = commands.add_parser('update-fines', help='Daily job: bring the fines ledger up to date')
+    fines.add_argument('--as-of', type=date.fromisoformat, help='Run for this date instead of today (YYYY-MM-DD)')
+    fines.set_defaults(handler=_update_fines)
+
+    reconcile = commands.add_parser('reconcile-payments', help='Confirm settled payments with the gateway')
+    reconcile.add_argument('--since', type=date.fromisoformat, help='Only payments settled on or after (YYYY-MM-DD)')
+    reconcile.add_argument('--workers', type=int, default=RECONCILE_WORKERS, help='Status checks in flight at once')
+    reconcile.set_defaults(handler=_reconcile_payments)
+
+    stub = commands.add_parser('gateway-stub', help='Run a local stand-in for the HTTP payment gateway')
+    stub.add_argument('--host', default='127.0.0.1')
+    stub.add_argument('--port', type=int, default=8765)
+    stub.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before each reply')
+    stub.add_argument('--callback-delay', type=float, default=1.0,
+                      help='Seconds before the webhook for a charge submitted with a callback URL')
+    stub.add_argument('--webhook-secret', help='Secret to sign webhooks with (default: PAYMENT_WEBHOOK_SECRET)')
+    stub.add_argument('--duplicate-callbacks', type=int, default=0, help='Extra deliveries of each webhook')
+    stub.set_defaults(handler=_gateway_stub)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    if args.database:
+        database.DATABASE = args.database
+    init_database()
+    run_migrations()
+    try:
+        return args.handler(args)
+    finally:
+        database.close_pool()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,120 +3,1582 @@ Database module for Library Management System
 Handles all database operations and connections
 """
 
+import re
 import sqlite3
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from flask import current_app, g, has_app_context
+
+from cache import LRUCache
+from services.fee_policy import late_fee_for_days, LATE_FEE_CAP_DAYS
 
 # Database configuration
 DATABASE = 'library.db'
 
-def get_db_connection():
-    """Get a database connection."""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row  # This enables column access by name
-    return conn
+# Circulation rules
+BORROW_LIMIT = 5        # a patron holding more than this many books cannot borrow
+LOAN_PERIOD_DAYS = 14
 
-def init_database():
-    """Initialize the database with required tables."""
+# Connection pool configuration
+POOL_SIZE = 5                       # maximum open connections per database file
+POOL_TIMEOUT = 30.0                 # seconds to wait for a free connection
+POOL_HEALTH_CHECK_INTERVAL = 30.0   # idle seconds before a connection is re-validated
+
+# SQLite performance profile applied to every new connection
+PERFORMANCE_PROFILE = {
+    'journal_mode': 'WAL',       # readers don't block the writer and vice versa
+    'synchronous': 'NORMAL',     # safe with WAL; fsync at checkpoints, not every commit
+    'mmap_size': 268435456,      # 256 MiB memory-mapped I/O
+    'cache_size': -65536,        # negative means KiB: a 64 MiB page cache
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,        # ms to wait on a locked database before failing
+}
+
+_PRAGMA_VALUE = re.compile(r'^(-?\d+|[A-Za-z_]+)$')
+
+
+def configure_performance_profile(**settings):
+    """
+    Override entries of PERFORMANCE_PROFILE (e.g. synchronous='FULL').
+
+    Settings apply to connections opened afterwards, so the shared pool is
+    reset. Only the pragmas already listed in the profile may be changed.
+    """
+    for name, value in settings.items():
+        if name not in PERFORMANCE_PROFILE:
+            raise ValueError(f'Unknown SQLite performance setting: {name}')
+        if not _PRAGMA_VALUE.match(str(value)):
+            raise ValueError(f'Invalid value for {name}: {value!r}')
+    PERFORMANCE_PROFILE.update(settings)
+    close_pool()
+
+
+def apply_performance_profile(conn: sqlite3.Connection):
+    """Apply PERFORMANCE_PROFILE to a freshly opened connection."""
+    for name, value in PERFORMANCE_PROFILE.items():
+        conn.execute(f'PRAGMA {name} = {value}').fetchall()
+
+
+def get_performance_report() -> Dict:
+    """Read back the SQLite settings actually in effect on a pooled connection."""
     conn = get_db_connection()
-    
-    # Create books table
+    try:
+        report = {}
+        for name in PERFORMANCE_PROFILE:
+            row = conn.execute(f'PRAGMA {name}').fetchone()
+            report[name] = row[0] if row else None
+        report['sqlite_version'] = sqlite3.sqlite_version
+        return report
+    finally:
+        conn.close()
+
+
+def register_functions(conn: sqlite3.Connection):
+    """
+    Register the application's SQL functions on a connection.
+
+    late_fee(days_overdue) applies the R5 fee policy inside SQLite, so fees
+    can be summed, grouped and filtered in SQL. It is pure, so it is marked
+    deterministic and the planner may factor repeated calls.
+    """
+    try:
+        conn.create_function('late_fee', 1, late_fee_for_days, deterministic=True)
+    except sqlite3.NotSupportedError:
+        # SQLite < 3.8.3 has no SQLITE_DETERMINISTIC flag
+        conn.create_function('late_fee', 1, late_fee_for_days)
+
+
+class PoolTimeoutError(sqlite3.OperationalError):
+    """Raised when no pooled connection becomes free within POOL_TIMEOUT."""
+
+
+class PooledConnection:
+    """
+    Proxy around a pooled sqlite3 connection.
+
+    Behaves like the underlying connection, except that close() checks the
+    connection back into its pool instead of closing it.
+    """
+
+    def __init__(self, pool: 'ConnectionPool', conn: sqlite3.Connection):
+        self._pool = pool
+        self._conn = conn
+
+    def close(self):
+        """Return the connection to the pool (safe to call more than once)."""
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        self._pool.release(conn)
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Same semantics as sqlite3.Connection: commit or roll back, never close
+        return self._conn.__exit__(exc_type, exc, tb)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of sqlite3 connections to a single database file.
+
+    Connections are created lazily up to `size`; callers beyond that wait up
+    to `timeout` seconds for a checkin. Idle connections are health-checked
+    before reuse and any open transaction is rolled back on checkin.
+    """
+
+    def __init__(self, database: str, size: int = POOL_SIZE, timeout: float = POOL_TIMEOUT,
+                 health_check_interval: float = POOL_HEALTH_CHECK_INTERVAL):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle = deque()  # (connection, last_used) pairs, most recent on the right
+        self._cond = threading.Condition()
+        self._open = 0
+        self._in_use = 0
+        self._closed = False
+        self._stats = {
+            'connections_created': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'total_wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'health_check_failures': 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections move between request threads, so same-thread checks are off;
+        # the pool guarantees a connection is only used by one holder at a time.
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        conn.row_factory = sqlite3.Row  # This enables column access by name
+        try:
+            apply_performance_profile(conn)
+            register_functions(conn)
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def _is_healthy(self, conn: sqlite3.Connection) -> bool:
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self) -> PooledConnection:
+        """Check out a connection, waiting up to `timeout` seconds for one to free up."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        conn, last_used, waited = None, None, False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise sqlite3.ProgrammingError('Connection pool has been closed.')
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        f'No database connection available after {self.timeout:.1f}s '
+                        f'(pool size {self.size}).'
+                    )
+                if not waited:
+                    self._stats['waits'] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+            wait_time = time.monotonic() - started
+            self._stats['total_wait_time'] += wait_time
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'], wait_time)
+
+        try:
+            if conn is not None and time.monotonic() - last_used > self.health_check_interval:
+                if not self._is_healthy(conn):
+                    with self._cond:
+                        self._stats['health_check_failures'] += 1
+                    try:
+                        conn.close()
+                    except sqlite3.Error:
+                        pass
+                    conn = None
+            if conn is None:
+                conn = self._connect()
+                with self._cond:
+                    self._stats['connections_created'] += 1
+        except Exception:
+            self._discard()
+            raise
+        return PooledConnection(self, conn)
+
+    def release(self, conn: sqlite3.Connection):
+        """Check a connection back in, rolling back anything left uncommitted."""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            self._discard()
+            return
+        with self._cond:
+            self._in_use -= 1
+            if self._closed:
+                self._open -= 1
+                conn.close()
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self):
+        # A checked-out slot whose connection is gone; free it for a new one
+        with self._cond:
+            self._in_use -= 1
+            self._open -= 1
+            self._cond.notify()
+
+    def close(self):
+        """Close idle connections; checked-out ones are closed when released."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+                self._open -= 1
+            self._cond.notify_all()
+
+    def stats(self) -> Dict:
+        """Snapshot of pool size, utilisation and wait-time counters."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'database': self.database,
+                'pool_size': self.size,
+                'open': self._open,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+            })
+        checkouts = stats['checkouts']
+        stats['avg_wait_time'] = stats['total_wait_time'] / checkouts if checkouts else 0.0
+        return stats
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Return the pool for the current DATABASE, replacing it if the path changed."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.database != DATABASE:
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(DATABASE)
+        return _pool
+
+
+def close_pool():
+    """Close the shared connection pool (a new one is created on next use)."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def get_pool_stats() -> Dict:
+    """Get usage statistics for the shared connection pool."""
+    return get_pool().stats()
+
+
+class UnitOfWork:
+    """
+    A single pooled connection, and at most one transaction, shared by every
+    database call made while the unit is active (e.g. one HTTP request).
+
+    The connection is checked out lazily on first use. Helpers keep calling
+    commit() and close() as usual: commits are deferred until the unit is
+    committed and close() is a no-op until the unit is released.
+    """
+
+    def __init__(self):
+        self._conn: Optional[PooledConnection] = None
+
+    def connection(self) -> 'UnitOfWorkConnection':
+        if self._conn is None:
+            self._conn = get_pool().acquire()
+        return UnitOfWorkConnection(self._conn)
+
+    def commit(self):
+        """Commit the pending transaction, if any."""
+        if self._conn is not None and self._conn.in_transaction:
+            self._conn.commit()
+
+    def release(self, commit: bool = True):
+        """Commit (or roll back) and check the connection back into the pool."""
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        try:
+            if commit:
+                conn.commit()
+        finally:
+            conn.close()  # the pool rolls back anything still uncommitted
+
+
+class UnitOfWorkConnection:
+    """Connection handle given out inside a unit of work."""
+
+    def __init__(self, conn: PooledConnection):
+        self._conn = conn
+
+    def commit(self):
+        """Deferred: the unit of work commits once at the end."""
+
+    def close(self):
+        """No-op: the unit of work releases the connection."""
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Roll back on error like sqlite3.Connection; a clean exit defers the commit
+        if exc_type is not None:
+            self._conn.rollback()
+        return False
+
+
+_UOW_EXTENSION = 'library_unit_of_work'
+
+
+def _current_unit_of_work() -> Optional[UnitOfWork]:
+    """The request-scoped unit of work, if running inside an app set up by init_app."""
+    if not has_app_context() or _UOW_EXTENSION not in current_app.extensions:
+        return None
+    if 'db_unit_of_work' not in g:
+        g.db_unit_of_work = UnitOfWork()
+    return g.db_unit_of_work
+
+
+def _commit_unit_of_work(response):
+    uow = g.get('db_unit_of_work')
+    if uow is not None:
+        uow.commit()
+    return response
+
+
+def _release_unit_of_work(exc):
+    uow = g.pop('db_unit_of_work', None)
+    if uow is not None:
+        uow.release(commit=exc is None)
+
+
+def init_app(app):
+    """
+    Bind a unit of work to each Flask app context.
+
+    Work is committed just before the response is sent (so a failed commit
+    surfaces as an error response) and the connection is released in
+    teardown_appcontext, rolling back if the request raised.
+    """
+    app.extensions[_UOW_EXTENSION] = True
+    app.after_request(_commit_unit_of_work)
+    app.teardown_appcontext(_release_unit_of_work)
+
+
+@contextmanager
+def write_transaction(conn):
+    """
+    Run a block as one write transaction on `conn`.
+
+    Starts with BEGIN IMMEDIATE so the write lock is taken up front (no
+    read-then-upgrade deadlocks between concurrent writers) and commits on
+    success. If the connection already has a transaction open, e.g. inside a
+    unit of work, the block runs in a savepoint of that transaction instead.
+    """
+    if conn.in_transaction:
+        conn.execute('SAVEPOINT write_transaction')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK TO write_transaction')
+            conn.execute('RELEASE write_transaction')
+            raise
+        conn.execute('RELEASE write_transaction')
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def get_standalone_connection():
+    """
+    Check a connection out of the shared pool, bypassing any unit of work.
+
+    For long-running bulk jobs (imports, exports) that manage their own
+    transactions; close() checks the connection back in.
+    """
+    return get_pool().acquire()
+
+
+def get_db_connection():
+    """
+    Get a database connection.
+
+    Inside a Flask app context registered with init_app this is the
+    request's unit-of-work connection; otherwise a connection is checked out
+    of the shared pool and close() checks it back in.
+    """
+    uow = _current_unit_of_work()
+    if uow is not None:
+        return uow.connection()
+    return get_pool().acquire()
+
+def release_db_connection():
+    """
+    Commit the request's unit of work and check its connection back in.
+
+    Call before taking a standalone connection or waiting on something slow
+    (a payment gateway call) so a request never holds two pool slots, or one
+    across the wait. Handles from earlier get_db_connection() calls must not
+    be used afterwards; a later call checks out a connection again. Does
+    nothing outside a unit of work.
+    """
+    uow = g.get('db_unit_of_work') if has_app_context() else None
+    if uow is not None:
+        uow.release()
+
+# borrow_records keeps each date twice: the original ISO text (borrow_date,
+# due_date, return_date) for readability, and an integer day number since
+# 1970-01-01 (borrow_day, due_day, return_day) for arithmetic and indexing.
+_EPOCH = date(1970, 1, 1)
+
+def epoch_day(value) -> int:
+    """Day number since 1970-01-01 of a date or datetime (time of day ignored)."""
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - _EPOCH).days
+
+def date_from_epoch_day(day: int) -> date:
+    """Inverse of epoch_day()."""
+    return _EPOCH + timedelta(days=day)
+
+def today_epoch_day() -> int:
+    """epoch_day() of the current local date."""
+    return epoch_day(date.today())
+
+# SQL equivalent of epoch_day() for an ISO date/datetime text column
+_EPOCH_DAY_SQL = "CAST(julianday(substr({0}, 1, 10)) - 2440587.5 AS INTEGER)"
+_EPOCH_DAY_COLUMNS_SQL = ', '.join(
+    f'{day} = {_EPOCH_DAY_SQL.format(iso)}'
+    for day, iso in (('borrow_day', 'borrow_date'), ('due_day', 'due_date'), ('return_day', 'return_date'))
+)
+
+# Queries on the circulation hot path. They live here rather than inline so
+# that check_hot_query_plans() can verify each one is served by an index.
+ACTIVE_LOANS_SQL = '''
+    SELECT br.*, b.title, b.author
+    FROM borrow_records br
+    JOIN books b ON br.book_id = b.id
+    WHERE br.patron_id = ? AND br.return_date IS NULL
+    ORDER BY br.borrow_date
+'''
+
+ACTIVE_LOAN_COUNT_SQL = '''
+    SELECT COUNT(*) as count FROM borrow_records
+    WHERE patron_id = ? AND return_date IS NULL
+'''
+
+INSERT_BORROW_SQL = '''
+    INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, borrow_day, due_day)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+MARK_RETURNED_SQL = '''
+    UPDATE borrow_records
+    SET return_date = ?, return_day = ?
+    WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
+'''
+
+LATEST_LOAN_SQL = '''
+    SELECT borrow_date, due_date, return_date
+    FROM borrow_records
+    WHERE patron_id = ? AND book_id = ?
+    ORDER BY id DESC
+    LIMIT 1
+'''
+
+PATRON_HISTORY_SQL = '''
+    SELECT br.id,
+           br.patron_id,
+           br.book_id,
+           br.borrow_date,
+           br.due_date,
+           br.return_date,
+           b.title,
+           b.author
+    FROM borrow_records br
+    JOIN books b ON b.id = br.book_id
+    WHERE br.patron_id = ?
+    ORDER BY br.borrow_date DESC, br.id DESC
+'''
+
+ACTIVE_LOAN_FOR_BOOK_SQL = '''
+    SELECT id, patron_id, book_id, borrow_date, due_date, due_day
+    FROM borrow_records
+    WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
+    ORDER BY id
+    LIMIT 1
+'''
+
+# Claims one copy only if one is free and the patron is within the loan
+# limit, so concurrent borrows can never oversell the last copy.
+CLAIM_COPY_SQL = '''
+    UPDATE books
+    SET available_copies = available_copies - 1
+    WHERE id = ?
+      AND available_copies > 0
+      AND (SELECT COUNT(*) FROM borrow_records
+           WHERE patron_id = ? AND return_date IS NULL) <= ?
+'''
+
+# Whole days a loan is (or was) overdue: its return day, or :today while
+# still open, minus its due day; never negative. Pure integer arithmetic on
+# the epoch-day columns. NULL if the due day is unknown (late_fee() -> 0).
+DAYS_OVERDUE_SQL = 'MAX(0, COALESCE(br.return_day, :today) - br.due_day)'
+
+# Fee of one loan, computed live by late_fee(), or read from the fines
+# ledger (see update_fines_ledger) where loans without a row owe nothing.
+_LIVE_FEE_SQL = f'late_fee({DAYS_OVERDUE_SQL})'
+_LEDGER_FEE_SQL = 'COALESCE(f.fee_amount, 0.0)'
+_LEDGER_JOIN_SQL = 'LEFT JOIN fines f ON f.loan_id = br.id'
+
+# Amount already paid towards a loan's fee (see the payments ledger), and
+# what is still owed: the fee accrued so far less those payments
+_PAID_SQL = ("(SELECT COALESCE(SUM(pay.amount), 0) FROM payments pay "
+             "WHERE pay.loan_id = br.id AND pay.status = 'paid')")
+_LIVE_OWED_SQL = f'ROUND(MAX(0, {_LIVE_FEE_SQL} - {_PAID_SQL}), 2)'
+LOAN_AMOUNT_PAID_SQL = "SELECT COALESCE(SUM(amount), 0) FROM payments WHERE loan_id = ? AND status = 'paid'"
+_LEDGER_OWED_SQL = f'ROUND(MAX(0, {_LEDGER_FEE_SQL} - {_PAID_SQL}), 2)'
+
+# The loan a fee enquiry is about: the oldest open loan of the book, else the latest one
+_LOAN_FEE_TEMPLATE = '''
+    SELECT br.id, br.due_date, br.return_date,
+           {days} AS days_overdue,
+           {fee} AS fee_amount,
+           {paid} AS amount_paid
+    FROM borrow_records br
+    {join}
+    WHERE br.patron_id = :patron_id AND br.book_id = :book_id
+    ORDER BY br.return_date IS NOT NULL,
+             CASE WHEN br.return_date IS NULL THEN br.id ELSE -br.id END
+    LIMIT 1
+'''
+
+_PATRON_FEES_TEMPLATE = '''
+    SELECT br.id,
+           br.book_id,
+           b.title,
+           b.author,
+           br.borrow_date,
+           br.due_date,
+           br.return_date,
+           COALESCE({days}, 0) AS days_overdue,
+           {fee} AS fee_amount,
+           {paid} AS amount_paid
+    FROM borrow_records br
+    JOIN books b ON b.id = br.book_id
+    {join}
+    WHERE br.patron_id = :patron_id {page}
+    ORDER BY br.borrow_date DESC, br.id DESC
+    LIMIT :limit
+'''
+
+# Keyset condition for the patron history pages after a (borrow_date, id) cursor
+_PATRON_PAGE_AFTER_SQL = 'AND (br.borrow_date, br.id) < (:after_date, :after_id)'
+
+# fee_amount is what is still owed; amount_paid what has been paid already
+LOAN_FEE_SQL = _LOAN_FEE_TEMPLATE.format(days=DAYS_OVERDUE_SQL, fee=_LIVE_OWED_SQL, paid=_PAID_SQL, join='')
+LEDGER_LOAN_FEE_SQL = _LOAN_FEE_TEMPLATE.format(
+    days=DAYS_OVERDUE_SQL, fee=_LEDGER_OWED_SQL, paid=_PAID_SQL, join=_LEDGER_JOIN_SQL)
+
+# A patron's borrows newest first, :limit at a time (-1 for all of them);
+# the _AFTER variants continue from the cursor row
+PATRON_FEES_SQL = _PATRON_FEES_TEMPLATE.format(
+    days=DAYS_OVERDUE_SQL, fee=_LIVE_OWED_SQL, paid=_PAID_SQL, join='', page='')
+PATRON_FEES_AFTER_SQL = _PATRON_FEES_TEMPLATE.format(
+    days=DAYS_OVERDUE_SQL, fee=_LIVE_OWED_SQL, paid=_PAID_SQL, join='', page=_PATRON_PAGE_AFTER_SQL)
+LEDGER_PATRON_FEES_SQL = _PATRON_FEES_TEMPLATE.format(
+    days=DAYS_OVERDUE_SQL, fee=_LEDGER_OWED_SQL, paid=_PAID_SQL, join=_LEDGER_JOIN_SQL, page='')
+LEDGER_PATRON_FEES_AFTER_SQL = _PATRON_FEES_TEMPLATE.format(
+    days=DAYS_OVERDUE_SQL, fee=_LEDGER_OWED_SQL, paid=_PAID_SQL, join=_LEDGER_JOIN_SQL,
+    page=_PATRON_PAGE_AFTER_SQL)
+
+# Default and maximum borrows per page of a patron status report
+PATRON_HISTORY_PAGE_SIZE = 50
+PATRON_HISTORY_MAX_PAGE_SIZE = 500
+
+# LOAN_FEE_SQL for many (patron_id, book_id) pairs at once, passed as the
+# JSON array :pairs; each result row carries the position of its pair
+_LOAN_FEES_BATCH_TEMPLATE = '''
+    SELECT p.key AS position, br.id, br.due_date, br.return_date,
+           {days} AS days_overdue,
+           {fee} AS fee_amount,
+           {paid} AS amount_paid
+    FROM json_each(:pairs) p
+    JOIN borrow_records br ON br.id = (
+        SELECT id FROM borrow_records
+        WHERE patron_id = json_extract(p.value, '$[0]') AND book_id = json_extract(p.value, '$[1]')
+        ORDER BY return_date IS NOT NULL,
+                 CASE WHEN return_date IS NULL THEN id ELSE -id END
+        LIMIT 1)
+    {join}
+'''
+
+LOAN_FEES_BATCH_SQL = _LOAN_FEES_BATCH_TEMPLATE.format(
+    days=DAYS_OVERDUE_SQL, fee=_LIVE_OWED_SQL, paid=_PAID_SQL, join='')
+LEDGER_LOAN_FEES_BATCH_SQL = _LOAN_FEES_BATCH_TEMPLATE.format(
+    days=DAYS_OVERDUE_SQL, fee=_LEDGER_OWED_SQL, paid=_PAID_SQL, join=_LEDGER_JOIN_SQL)
+
+# Most pairs one batch fee enquiry may ask about
+LATE_FEE_BATCH_LIMIT = 500
+
+# Every loan a patron still owes a fee on, oldest due first, with what is
+# owed (fee_amount) and already paid; for paying them all in one charge
+_PATRON_OUTSTANDING_TEMPLATE = '''
+    SELECT id, book_id, title, days_overdue, fee_amount, amount_paid
+    FROM (
+        SELECT br.id, br.book_id, b.title, br.due_date,
+               COALESCE({days}, 0) AS days_overdue,
+               {fee} AS fee_amount,
+               {paid} AS amount_paid
+        FROM borrow_records br
+        JOIN books b ON b.id = br.book_id
+        {join}
+        WHERE br.patron_id = :patron_id
+    )
+    WHERE fee_amount > 0
+    ORDER BY due_date, id
+'''
+
+PATRON_OUTSTANDING_FEES_SQL = _PATRON_OUTSTANDING_TEMPLATE.format(
+    days=DAYS_OVERDUE_SQL, fee=_LIVE_OWED_SQL, paid=_PAID_SQL, join='')
+LEDGER_PATRON_OUTSTANDING_FEES_SQL = _PATRON_OUTSTANDING_TEMPLATE.format(
+    days=DAYS_OVERDUE_SQL, fee=_LEDGER_OWED_SQL, paid=_PAID_SQL, join=_LEDGER_JOIN_SQL)
+
+PATRON_FEE_TOTALS_SQL = f'''
+    SELECT COALESCE(SUM(br.return_date IS NULL), 0) AS borrowed_count,
+           ROUND(COALESCE(SUM({_LIVE_OWED_SQL}), 0), 2) AS total_late_fees
+    FROM borrow_records br
+    WHERE br.patron_id = :patron_id
+'''
+
+# Only the patron's fee-bearing loans and payments are read, from the
+# fines and payments indexes; payments never exceed the fee of their loan
+LEDGER_PATRON_FEE_TOTALS_SQL = '''
+    SELECT (SELECT COUNT(*) FROM borrow_records
+            WHERE patron_id = :patron_id AND return_date IS NULL) AS borrowed_count,
+           ROUND((SELECT COALESCE(SUM(fee_amount), 0) FROM fines WHERE patron_id = :patron_id)
+                 - (SELECT COALESCE(SUM(amount), 0) FROM payments
+                    WHERE patron_id = :patron_id AND status = 'paid' AND loan_id IS NOT NULL), 2)
+               AS total_late_fees
+'''
+
+# Payments a gateway webhook is about: by transaction id, or by the
+# reference sent with the charge (a payment key or a consolidated charge key)
+PAYMENTS_FOR_EVENT_SQL = '''
+    SELECT * FROM payments
+    WHERE transaction_id = :transaction_id OR idempotency_key = :reference OR charge_key = :reference
+'''
+
+# Settled charges the gateway has not yet confirmed, one row per gateway
+# transaction (the allocations of a consolidated charge are summed)
+UNVERIFIED_TRANSACTIONS_SQL = '''
+    SELECT p.transaction_id,
+           ROUND(SUM(p.amount), 2) AS amount,
+           COUNT(*) AS payments,
+           MAX(p.updated_at) AS paid_at
+    FROM payments p
+    WHERE p.status = 'paid' AND p.transaction_id IS NOT NULL AND p.updated_at >= :since
+      AND NOT EXISTS (SELECT 1 FROM payment_verifications v WHERE v.transaction_id = p.transaction_id)
+    GROUP BY p.transaction_id
+'''
+
+# Patrons whose total fees exceed :min_fee, largest first
+PATRONS_OWING_SQL = f'''
+    SELECT br.patron_id,
+           COUNT(*) AS loans,
+           SUM(br.return_date IS NULL) AS borrowed_count,
+           ROUND(SUM(late_fee({DAYS_OVERDUE_SQL})), 2) AS total_late_fees
+    FROM borrow_records br
+    GROUP BY br.patron_id
+    HAVING total_late_fees > :min_fee
+    ORDER BY total_late_fees DESC, br.patron_id
+'''
+
+# Every open loan past its due day, served by the partial due_day index
+OVERDUE_LOANS_SQL = '''
+    SELECT id, patron_id, book_id, due_day
+    FROM borrow_records
+    WHERE return_date IS NULL AND due_day < ?
+'''
+
+# name -> (sql, sample parameters) checked by check_hot_query_plans()
+HOT_QUERIES = {
+    'active_loans': (ACTIVE_LOANS_SQL, ('123456',)),
+    'active_loan_count': (ACTIVE_LOAN_COUNT_SQL, ('123456',)),
+    'mark_returned': (MARK_RETURNED_SQL, ('2024-01-01T00:00:00', 19723, '123456', 1)),
+    'latest_loan': (LATEST_LOAN_SQL, ('123456', 1)),
+    'patron_history': (PATRON_HISTORY_SQL, ('123456',)),
+    'claim_copy': (CLAIM_COPY_SQL, (1, '123456', 5)),
+    'active_loan_for_book': (ACTIVE_LOAN_FOR_BOOK_SQL, ('123456', 1)),
+    'loan_fee': (LOAN_FEE_SQL, {'patron_id': '123456', 'book_id': 1, 'today': 19723}),
+    'patron_fees': (PATRON_FEES_SQL, {'patron_id': '123456', 'today': 19723, 'limit': -1}),
+    'patron_fees_after': (PATRON_FEES_AFTER_SQL, {
+        'patron_id': '123456', 'today': 19723, 'limit': 51, 'after_date': '2024-01-01', 'after_id': 1}),
+    'patron_fee_totals': (PATRON_FEE_TOTALS_SQL, {'patron_id': '123456', 'today': 19723}),
+    'ledger_loan_fee': (LEDGER_LOAN_FEE_SQL, {'patron_id': '123456', 'book_id': 1, 'today': 19723}),
+    'ledger_patron_fees': (LEDGER_PATRON_FEES_SQL, {'patron_id': '123456', 'today': 19723, 'limit': -1}),
+    'ledger_patron_fees_after': (LEDGER_PATRON_FEES_AFTER_SQL, {
+        'patron_id': '123456', 'today': 19723, 'limit': 51, 'after_date': '2024-01-01', 'after_id': 1}),
+    'ledger_patron_fee_totals': (LEDGER_PATRON_FEE_TOTALS_SQL, {'patron_id': '123456'}),
+    'loan_fees_batch': (LOAN_FEES_BATCH_SQL, {'pairs': '[["123456", 1]]', 'today': 19723}),
+    'ledger_loan_fees_batch': (LEDGER_LOAN_FEES_BATCH_SQL, {'pairs': '[["123456", 1]]', 'today': 19723}),
+    'patron_outstanding_fees': (PATRON_OUTSTANDING_FEES_SQL, {'patron_id': '123456', 'today': 19723}),
+    'ledger_patron_outstanding_fees': (LEDGER_PATRON_OUTSTANDING_FEES_SQL, {'patron_id': '123456', 'today': 19723}),
+    'payment_allocations': ('SELECT * FROM payments WHERE charge_key = ?', ('123456:all:0',)),
+    'unverified_transactions': (UNVERIFIED_TRANSACTIONS_SQL, {'since': '2024-01-01'}),
+    'payments_for_event': (PAYMENTS_FOR_EVENT_SQL, {'transaction_id': 'txn_1', 'reference': 'key'}),
+    'overdue_loans': (OVERDUE_LOANS_SQL, (19723,)),
+    'books_page_after': (
+        'SELECT * FROM books WHERE (title, id) > (?, ?) ORDER BY title, id LIMIT ?', ('M', 1, 26)),
+    'books_page_before': (
+        'SELECT * FROM books WHERE (title, id) < (?, ?) ORDER BY title DESC, id DESC LIMIT ?', ('M', 1, 26)),
+}
+
+def _create_books_fts(conn):
+    """
+    Full-text index over book titles and authors, kept in sync by triggers.
+
+    Uses the trigram tokenizer so MATCH keeps the case-insensitive substring
+    semantics of the old Python scan. If this SQLite build lacks FTS5 or the
+    trigram tokenizer the index is skipped and search falls back to LIKE.
+    """
+    try:
+        conn.execute('''
+            CREATE VIRTUAL TABLE books_fts USING fts5(
+                title, author, content='books', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        return
     conn.execute('''
-        CREATE TABLE IF NOT EXISTS books (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT NOT NULL,
-            author TEXT NOT NULL,
-            isbn TEXT UNIQUE NOT NULL,
-            total_copies INTEGER NOT NULL,
-            available_copies INTEGER NOT NULL
-        )
+        CREATE TRIGGER books_fts_insert AFTER INSERT ON books BEGIN
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+        END
     ''')
-    
-    # Create borrow_records table
     conn.execute('''
-        CREATE TABLE IF NOT EXISTS borrow_records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE TRIGGER books_fts_delete AFTER DELETE ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER books_fts_update AFTER UPDATE OF title, author ON books BEGIN
+            INSERT INTO books_fts (books_fts, rowid, title, author)
+            VALUES ('delete', old.id, old.title, old.author);
+            INSERT INTO books_fts (rowid, title, author) VALUES (new.id, new.title, new.author);
+        END
+    ''')
+    conn.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+
+# Rows updated per statement when backfilling the epoch-day columns
+BACKFILL_BATCH_SIZE = 5000
+
+def _backfill_epoch_days(conn, batch_size: int = None):
+    """
+    Fill borrow_day/due_day/return_day from the ISO columns, in id-range batches.
+
+    Each UPDATE touches at most `batch_size` rows, which bounds the work and
+    journal growth per statement on large tables; the batches share the
+    migration's transaction so the upgrade stays all-or-nothing.
+    """
+    batch_size = batch_size or BACKFILL_BATCH_SIZE
+    last_id = 0
+    while True:
+        upper = conn.execute(
+            'SELECT MAX(id) FROM (SELECT id FROM borrow_records WHERE id > ? ORDER BY id LIMIT ?)',
+            (last_id, batch_size),
+        ).fetchone()[0]
+        if upper is None:
+            return
+        conn.execute(f'UPDATE borrow_records SET {_EPOCH_DAY_COLUMNS_SQL} WHERE id > ? AND id <= ?',
+                     (last_id, upper))
+        last_id = upper
+
+# Schema migrations applied in order by run_migrations(). Each entry is
+# (version, description, steps); a step is an SQL statement or a callable
+# taking the connection. Never edit a released migration, append a new one.
+MIGRATIONS = [
+    (1, 'Hot-path indexes on borrow_records', [
+        'CREATE INDEX IF NOT EXISTS idx_borrow_records_patron_active '
+        'ON borrow_records (patron_id, return_date)',
+        'CREATE INDEX IF NOT EXISTS idx_borrow_records_patron_book '
+        'ON borrow_records (patron_id, book_id, id DESC)',
+        'CREATE INDEX IF NOT EXISTS idx_borrow_records_book_active '
+        'ON borrow_records (book_id, return_date)',
+    ]),
+    (2, 'Full-text search index on book title/author', [_create_books_fts]),
+    (3, 'Keyset pagination index on books (title, id)', [
+        'CREATE INDEX IF NOT EXISTS idx_books_title_id ON books (title, id)',
+    ]),
+    # Each books write logs the changed id, so a borrow or return evicts one
+    # cached book in other processes instead of the whole cache
+    (4, 'Per-row change log on books for cross-process cache invalidation', [
+        '''CREATE TABLE IF NOT EXISTS book_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            book_id INTEGER NOT NULL
+        )''',
+        '''CREATE TRIGGER books_change_insert AFTER INSERT ON books BEGIN
+            INSERT INTO book_changes (book_id) VALUES (new.id);
+        END''',
+        '''CREATE TRIGGER books_change_update AFTER UPDATE ON books BEGIN
+            INSERT INTO book_changes (book_id) VALUES (old.id);
+        END''',
+        '''CREATE TRIGGER books_change_delete AFTER DELETE ON books BEGIN
+            INSERT INTO book_changes (book_id) VALUES (old.id);
+        END''',
+        # Keep the last 10000 changes; a reader that falls further behind resets
+        '''CREATE TRIGGER book_changes_prune AFTER INSERT ON book_changes BEGIN
+            DELETE FROM book_changes WHERE seq <= new.seq - 10000;
+        END''',
+    ]),
+    (5, 'Integer epoch-day columns and overdue index on borrow_records', [
+        'ALTER TABLE borrow_records ADD COLUMN borrow_day INTEGER',
+        'ALTER TABLE borrow_records ADD COLUMN due_day INTEGER',
+        'ALTER TABLE borrow_records ADD COLUMN return_day INTEGER',
+        _backfill_epoch_days,
+        # Keep the day columns in step for writers that only set the ISO text
+        f'''CREATE TRIGGER borrow_records_days_insert AFTER INSERT ON borrow_records
+            WHEN new.due_day IS NULL BEGIN
+            UPDATE borrow_records SET {_EPOCH_DAY_COLUMNS_SQL} WHERE id = new.id;
+        END''',
+        f'''CREATE TRIGGER borrow_records_days_update
+            AFTER UPDATE OF borrow_date, due_date, return_date ON borrow_records
+            WHEN new.borrow_day IS old.borrow_day AND new.due_day IS old.due_day
+                 AND new.return_day IS old.return_day BEGIN
+            UPDATE borrow_records SET {_EPOCH_DAY_COLUMNS_SQL} WHERE id = new.id;
+        END''',
+        # Covers the library-wide overdue report: it reads only these columns,
+        # so SQLite never has to visit the table rows
+        'CREATE INDEX IF NOT EXISTS idx_borrow_records_overdue '
+        'ON borrow_records (due_day, patron_id, book_id, return_date) WHERE return_date IS NULL',
+    ]),
+    (6, 'Fines ledger maintained by the daily fines job', [
+        '''CREATE TABLE IF NOT EXISTS fines (
+            loan_id INTEGER PRIMARY KEY REFERENCES borrow_records (id),
             patron_id TEXT NOT NULL,
             book_id INTEGER NOT NULL,
-            borrow_date TEXT NOT NULL,
-            due_date TEXT NOT NULL,
-            return_date TEXT,
-            FOREIGN KEY (book_id) REFERENCES books (id)
-        )
-    ''')
+            fee_amount REAL NOT NULL,
+            fee_day INTEGER NOT NULL,
+            final INTEGER NOT NULL DEFAULT 0
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_fines_patron ON fines (patron_id, fee_amount)',
+        'CREATE INDEX IF NOT EXISTS idx_fines_open ON fines (loan_id) WHERE final = 0',
+        '''CREATE TABLE IF NOT EXISTS fines_ledger_runs (
+            run_day INTEGER PRIMARY KEY,
+            finished_at TEXT NOT NULL,
+            loans_updated INTEGER NOT NULL,
+            loans_finalized INTEGER NOT NULL
+        )''',
+    ]),
+    (7, 'Keyset pagination index for patron borrow history', [
+        'CREATE INDEX IF NOT EXISTS idx_borrow_records_patron_history '
+        'ON borrow_records (patron_id, borrow_date, id)',
+    ]),
+    (8, 'Persistent state for asynchronous late fee payment jobs', [
+        '''CREATE TABLE IF NOT EXISTS payment_jobs (
+            id TEXT PRIMARY KEY,
+            patron_id TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            description TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            transaction_id TEXT,
+            message TEXT,
+            claimed_by TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_payment_jobs_unfinished ON payment_jobs (created_at) '
+        "WHERE status IN ('queued', 'running')",
+    ]),
+    (9, 'Idempotent payments ledger for late fees', [
+        '''CREATE TABLE IF NOT EXISTS payments (
+            idempotency_key TEXT PRIMARY KEY,
+            patron_id TEXT NOT NULL,
+            book_id INTEGER NOT NULL,
+            loan_id INTEGER REFERENCES borrow_records (id),
+            amount REAL NOT NULL,
+            status TEXT NOT NULL,
+            transaction_id TEXT,
+            message TEXT,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_payments_loan ON payments (loan_id, status, amount)',
+        'CREATE INDEX IF NOT EXISTS idx_payments_patron ON payments (patron_id, status, amount, loan_id)',
+        'ALTER TABLE payment_jobs ADD COLUMN idempotency_key TEXT',
+        'ALTER TABLE payment_jobs ADD COLUMN loan_id INTEGER',
+    ]),
+    (10, 'Per-loan allocation of consolidated late fee charges', [
+        'ALTER TABLE payments ADD COLUMN charge_key TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_payments_charge ON payments (charge_key) WHERE charge_key IS NOT NULL',
+    ]),
+    (11, 'Payment reconciliation runs, verified transactions and discrepancies', [
+        'CREATE INDEX IF NOT EXISTS idx_payments_settled '
+        'ON payments (status, transaction_id, amount, updated_at)',
+        '''CREATE TABLE IF NOT EXISTS payment_verifications (
+            transaction_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            amount REAL,
+            checked_at TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS reconciliation_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT NOT NULL,
+            finished_at TEXT NOT NULL,
+            checked INTEGER NOT NULL,
+            already_verified INTEGER NOT NULL,
+            discrepancies INTEGER NOT NULL,
+            errors INTEGER NOT NULL,
+            elapsed_seconds REAL NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS payment_discrepancies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER NOT NULL REFERENCES reconciliation_runs (id),
+            transaction_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            expected_amount REAL,
+            gateway_status TEXT,
+            gateway_amount REAL,
+            detail TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_payment_discrepancies_run ON payment_discrepancies (run_id)',
+    ]),
+    (12, 'Webhook completion of payments', [
+        'CREATE INDEX IF NOT EXISTS idx_payments_transaction ON payments (transaction_id) '
+        'WHERE transaction_id IS NOT NULL',
+        '''CREATE TABLE IF NOT EXISTS payment_webhook_events (
+            event_id TEXT PRIMARY KEY,
+            event_type TEXT NOT NULL,
+            transaction_id TEXT,
+            received_at TEXT NOT NULL
+        )''',
+    ]),
+    # Webhooks report discrepancies too, outside any reconciliation run:
+    # rebuild payment_discrepancies with a nullable run_id and the event id
+    (13, 'Payment discrepancies from webhooks', [
+        '''CREATE TABLE payment_discrepancies_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER REFERENCES reconciliation_runs (id),
+            event_id TEXT,
+            transaction_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            expected_amount REAL,
+            gateway_status TEXT,
+            gateway_amount REAL,
+            detail TEXT
+        )''',
+        '''INSERT INTO payment_discrepancies_new (id, run_id, transaction_id, kind, expected_amount,
+                                                  gateway_status, gateway_amount, detail)
+           SELECT id, run_id, transaction_id, kind, expected_amount, gateway_status, gateway_amount, detail
+           FROM payment_discrepancies''',
+        'DROP TABLE payment_discrepancies',
+        'ALTER TABLE payment_discrepancies_new RENAME TO payment_discrepancies',
+        'CREATE INDEX IF NOT EXISTS idx_payment_discrepancies_run ON payment_discrepancies (run_id)',
+    ]),
+    (14, 'Gateway idempotency key attempts', [
+        'ALTER TABLE payments ADD COLUMN gateway_attempt INTEGER NOT NULL DEFAULT 1',
+    ]),
+    # Loans and payments that change a late fee enquiry's answer, for caches
+    # in other processes; a fee only moves otherwise at midnight
+    (15, 'Per-loan change log for cross-process late fee cache invalidation', [
+        '''CREATE TABLE IF NOT EXISTS loan_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            patron_id TEXT NOT NULL,
+            book_id INTEGER NOT NULL
+        )''',
+        '''CREATE TRIGGER borrow_records_change_insert AFTER INSERT ON borrow_records BEGIN
+            INSERT INTO loan_changes (patron_id, book_id) VALUES (new.patron_id, new.book_id);
+        END''',
+        '''CREATE TRIGGER borrow_records_change_update AFTER UPDATE ON borrow_records BEGIN
+            INSERT INTO loan_changes (patron_id, book_id) VALUES (old.patron_id, old.book_id);
+        END''',
+        '''CREATE TRIGGER borrow_records_change_delete AFTER DELETE ON borrow_records BEGIN
+            INSERT INTO loan_changes (patron_id, book_id) VALUES (old.patron_id, old.book_id);
+        END''',
+        '''CREATE TRIGGER payments_change_status AFTER UPDATE OF status ON payments BEGIN
+            INSERT INTO loan_changes (patron_id, book_id) VALUES (new.patron_id, new.book_id);
+        END''',
+        '''CREATE TRIGGER loan_changes_prune AFTER INSERT ON loan_changes BEGIN
+            DELETE FROM loan_changes WHERE seq <= new.seq - 10000;
+        END''',
+    ]),
+]
+
+def init_database():
+    """Initialize the database with required tables."""
+    conn = get_db_connection()
+    try:
+        # Create books table
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS books (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                author TEXT NOT NULL,
+                isbn TEXT UNIQUE NOT NULL,
+                total_copies INTEGER NOT NULL,
+                available_copies INTEGER NOT NULL
+            )
+        ''')
     
-    conn.commit()
-    conn.close()
+        # Create borrow_records table
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS borrow_records (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                patron_id TEXT NOT NULL,
+                book_id INTEGER NOT NULL,
+                borrow_date TEXT NOT NULL,
+                due_date TEXT NOT NULL,
+                return_date TEXT,
+                FOREIGN KEY (book_id) REFERENCES books (id)
+            )
+        ''')
+    
+        conn.commit()
+    finally:
+        conn.close()
+
+def get_schema_version(conn=None) -> int:
+    """Get the highest migration version applied to the database (0 if none)."""
+    own = conn is None
+    if own:
+        conn = get_db_connection()
+    try:
+        table = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+        ).fetchone()
+        if not table:
+            return 0
+        return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+    finally:
+        if own:
+            conn.close()
+
+def run_migrations() -> List[int]:
+    """
+    Apply pending MIGRATIONS and record each one in schema_version.
+
+    Every migration runs in its own BEGIN IMMEDIATE transaction, so several
+    processes starting at once still apply it exactly once.
+
+    Returns:
+        list: versions applied by this call
+    """
+    applied = []
+    conn = get_pool().acquire()
+    try:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+        ''')
+        for version, description, steps in MIGRATIONS:
+            if version <= get_schema_version(conn):
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Another process may have applied it while we waited for the lock
+                if version <= get_schema_version(conn):
+                    conn.rollback()
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(
+                    'INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                    (version, description, datetime.now().isoformat()),
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+    finally:
+        conn.close()
+    return applied
+
+def explain_query_plan(sql: str, params: Tuple = ()) -> List[str]:
+    """Get the EXPLAIN QUERY PLAN detail lines for a statement."""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+    finally:
+        conn.close()
+    return [row['detail'] for row in rows]
+
+def check_hot_query_plans() -> Dict[str, Dict]:
+    """
+    Explain every query in HOT_QUERIES.
+
+    Returns:
+        dict: name -> {'plan': [detail, ...], 'uses_index': bool}; uses_index
+        is False when any table in the plan is read by a full scan, or when
+        the query cannot be planned because the schema is not migrated
+        (the error is then reported under 'error')
+    """
+    results = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        try:
+            plan = explain_query_plan(sql, params)
+        except sqlite3.OperationalError as e:
+            results[name] = {'plan': [], 'uses_index': False, 'error': str(e)}
+            continue
+        full_scans = [d for d in plan
+                      if d.startswith('SCAN') and 'INDEX' not in d and d != 'SCAN CONSTANT ROW']
+        results[name] = {'plan': plan, 'uses_index': not full_scans}
+    return results
 
 def add_sample_data():
     """Add sample data to the database if it's empty."""
     conn = get_db_connection()
-    book_count = conn.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
+    try:
+        book_count = conn.execute('SELECT COUNT(*) as count FROM books').fetchone()['count']
     
-    if book_count == 0:
-        # Add sample books
-        sample_books = [
-            ('The Great Gatsby', 'F. Scott Fitzgerald', '9780743273565', 3),
-            ('To Kill a Mockingbird', 'Harper Lee', '9780061120084', 2),
-            ('1984', 'George Orwell', '9780451524935', 1)
-        ]
+        if book_count == 0:
+            # Add sample books
+            sample_books = [
+                ('The Great Gatsby', 'F. Scott Fitzgerald', '9780743273565', 3),
+                ('To Kill a Mockingbird', 'Harper Lee', '9780061120084', 2),
+                ('1984', 'George Orwell', '9780451524935', 1)
+            ]
         
-        for title, author, isbn, copies in sample_books:
-            conn.execute('''
-                INSERT INTO books (title, author, isbn, total_copies, available_copies)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (title, author, isbn, copies, copies))
+            for title, author, isbn, copies in sample_books:
+                conn.execute('''
+                    INSERT INTO books (title, author, isbn, total_copies, available_copies)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (title, author, isbn, copies, copies))
         
-        # Make 1984 unavailable by adding a borrow record
-        conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
-            VALUES (?, ?, ?, ?)
-        ''', ('123456', 3, 
-              (datetime.now() - timedelta(days=5)).isoformat(),
-              (datetime.now() + timedelta(days=9)).isoformat()))
+            # Make 1984 unavailable by adding a borrow record
+            borrow_date = datetime.now() - timedelta(days=5)
+            due_date = datetime.now() + timedelta(days=9)
+            conn.execute(INSERT_BORROW_SQL, ('123456', 3, borrow_date.isoformat(), due_date.isoformat(),
+                                             epoch_day(borrow_date), epoch_day(due_date)))
         
-        # Update available copies for 1984
-        conn.execute('UPDATE books SET available_copies = 0 WHERE id = 3')
+            # Update available copies for 1984
+            conn.execute('UPDATE books SET available_copies = 0 WHERE id = 3')
         
-        conn.commit()
-    
-    conn.close()
+            conn.commit()
+    finally:
+        conn.close()
 
 # Helper Functions for Database Operations
 
 def get_all_books() -> List[Dict]:
     """Get all books from the database."""
     conn = get_db_connection()
-    books = conn.execute('SELECT * FROM books ORDER BY title').fetchall()
-    conn.close()
+    try:
+        books = conn.execute('SELECT * FROM books ORDER BY title').fetchall()
+    finally:
+        conn.close()
     return [dict(book) for book in books]
 
+# Rows fetched from SQLite per round trip while streaming exports
+EXPORT_FETCH_SIZE = 500
+
+EXPORT_BOOKS_SQL = '''
+    SELECT id, title, author, isbn, total_copies, available_copies
+    FROM books
+    ORDER BY id
+'''
+
+EXPORT_BORROWS_SQL = '''
+    SELECT br.id,
+           br.patron_id,
+           br.book_id,
+           br.borrow_date,
+           br.due_date,
+           br.return_date,
+           b.title,
+           b.author
+    FROM borrow_records br
+    JOIN books b ON b.id = br.book_id
+    ORDER BY br.id
+'''
+
+def iter_rows(sql: str, params: tuple = (), fetch_size: int = EXPORT_FETCH_SIZE) -> Iterator[Dict]:
+    """
+    Stream the rows of a query as dicts, `fetch_size` rows at a time.
+
+    Uses its own pooled connection (not the request's unit of work) and
+    holds it only while the generator is being consumed; closing the
+    generator early releases it. A single SELECT reads one consistent
+    snapshot, and in WAL mode it does not block writers.
+    """
+    conn = get_standalone_connection()
+    try:
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(row)
+    finally:
+        conn.close()
+
+def iter_all_books(fetch_size: int = EXPORT_FETCH_SIZE) -> Iterator[Dict]:
+    """Stream every book, in id order."""
+    return iter_rows(EXPORT_BOOKS_SQL, (), fetch_size)
+
+def iter_borrow_records(patron_id: Optional[str] = None,
+                        fetch_size: int = EXPORT_FETCH_SIZE) -> Iterator[Dict]:
+    """Stream borrow records with book title/author, for one patron or everyone."""
+    if patron_id is not None:
+        return iter_rows(PATRON_HISTORY_SQL, (patron_id,), fetch_size)
+    return iter_rows(EXPORT_BORROWS_SQL, (), fetch_size)
+
+# Book row cache configuration
+BOOK_CACHE_SIZE = 4096               # maximum cached book rows
+BOOK_CACHE_TTL = 300.0               # seconds a cached row may be served
+BOOK_CACHE_VERSION_CHECK = 1.0       # seconds between checks for other processes' writes
+
+class ChangeFeed:
+    """
+    Reader of a change log table (book_changes, loan_changes) that triggers
+    append the key of every changed row to.
+
+    poll() returns the keys logged since the previous poll, or None when it
+    cannot tell: on the first poll of a database file, when the log has been
+    pruned past the last position read, or when the log does not exist yet.
+    Callers then drop everything they cache from that database.
+    """
+
+    def __init__(self, table: str, columns: Tuple[str, ...]):
+        self._sql = f'SELECT seq, {", ".join(columns)} FROM {table} WHERE seq > ? ORDER BY seq'
+        self._max_sql = f'SELECT COALESCE(MAX(seq), 0) FROM {table}'
+        self._lock = threading.Lock()
+        self._database = None
+        self._seq = None
+        self._checked_at = 0.0
+
+    def tracking(self) -> bool:
+        """Whether a position in the current database's log is held."""
+        with self._lock:
+            return self._database == DATABASE and self._seq is not None
+
+    def reset(self):
+        """Forget the position; the next poll starts over."""
+        with self._lock:
+            self._database = None
+            self._seq = None
+
+    def due(self, interval: float) -> bool:
+        """Whether `interval` seconds have passed since the last poll of this database."""
+        with self._lock:
+            return self._database != DATABASE or time.monotonic() - self._checked_at >= interval
+
+    def poll(self, conn) -> Optional[List[tuple]]:
+        """Keys changed since the last poll, oldest first; None to start over."""
+        now = time.monotonic()
+        with self._lock:
+            seq = self._seq if self._database == DATABASE else None
+        try:
+            if seq is None:
+                changes = None
+                seq = conn.execute(self._max_sql).fetchone()[0]
+            else:
+                rows = conn.execute(self._sql, (seq,)).fetchall()
+                if rows and rows[0][0] > seq + 1:
+                    changes = None  # pruned past our position: we can't know what changed
+                else:
+                    changes = [tuple(row[1:]) for row in rows]
+                if rows:
+                    seq = rows[-1][0]
+        except sqlite3.OperationalError:
+            changes, seq = None, None  # not migrated yet: rely on TTLs and local invalidation
+        with self._lock:
+            self._database = DATABASE
+            self._seq = seq
+            self._checked_at = now
+        return changes
+
+
+class BookCache:
+    """
+    Process-local LRU cache of book rows, looked up by id or ISBN.
+
+    Writes made through this module invalidate the affected row directly.
+    Writes from other processes sharing the database file are detected
+    through the book_changes log: at most every `version_check` seconds the
+    log is read past the last sequence seen and just those rows are evicted.
+    The whole cache is dropped only when the log can't tell what changed
+    (see ChangeFeed). Rows read inside an uncommitted transaction are never
+    cached.
+    """
+
+    def __init__(self, maxsize: int = BOOK_CACHE_SIZE, ttl: float = BOOK_CACHE_TTL,
+                 version_check: float = BOOK_CACHE_VERSION_CHECK):
+        self.version_check = version_check
+        self._rows = LRUCache(maxsize, ttl)      # book id -> row dict
+        self._isbn_to_id: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._changes = ChangeFeed('book_changes', ('book_id',))
+        self._counters = {'hits': 0, 'misses': 0, 'version_resets': 0, 'row_invalidations': 0}
+
+    def _sync(self, conn):
+        """Evict rows other processes changed; drop everything if the log can't tell."""
+        if not self._changes.due(self.version_check):
+            return
+        tracking = self._changes.tracking()
+        changes = self._changes.poll(conn)
+        with self._lock:
+            if changes is None:
+                if tracking:
+                    self._counters['version_resets'] += 1
+                self._rows.clear()
+                self._isbn_to_id.clear()
+            else:
+                for (book_id,) in changes:
+                    self._rows.invalidate(book_id)
+                self._counters['row_invalidations'] += len(changes)
+
+    def get(self, conn, book_id: Optional[int] = None, isbn: Optional[str] = None) -> Optional[Dict]:
+        """Cached row for a book id or ISBN, or None on a miss."""
+        self._sync(conn)
+        if book_id is None:
+            with self._lock:
+                book_id = self._isbn_to_id.get(isbn)
+        row = self._rows.get(book_id) if book_id is not None else None
+        if row is not None and isbn is not None and row['isbn'] != isbn:
+            row = None
+        with self._lock:
+            self._counters['hits' if row is not None else 'misses'] += 1
+        return dict(row) if row is not None else None
+
+    def put(self, conn, row: Dict):
+        """Cache a row read from the database (skipped inside a transaction)."""
+        if conn.in_transaction:
+            return
+        self._rows.set(row['id'], dict(row))
+        with self._lock:
+            if len(self._isbn_to_id) >= 2 * self._rows.maxsize:
+                self._isbn_to_id.clear()  # stale mappings just become misses
+            self._isbn_to_id[row['isbn']] = row['id']
+
+    def invalidate(self, book_id: Optional[int] = None, isbn: Optional[str] = None):
+        """Forget one book after a local write."""
+        if isbn is not None:
+            with self._lock:
+                mapped = self._isbn_to_id.pop(isbn, None)
+            book_id = book_id if book_id is not None else mapped
+        if book_id is not None:
+            self._rows.invalidate(book_id)
+
+    def clear(self):
+        self._rows.clear()
+        with self._lock:
+            self._isbn_to_id.clear()
+        self._changes.reset()
+
+    def stats(self) -> Dict:
+        stats = self._rows.stats()
+        with self._lock:
+            stats.update(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['ttl'] = self._rows.ttl
+        return stats
+
+book_cache = BookCache()
+
+def get_book_cache_stats() -> Dict:
+    """Get hit/miss/eviction counters for the book row cache."""
+    return book_cache.stats()
+
+# Default and maximum page size for catalog browsing
+CATALOG_PAGE_SIZE = 25
+CATALOG_MAX_PAGE_SIZE = 100
+
+def get_books_page(after_title: Optional[str] = None, after_id: Optional[int] = None,
+                   limit: int = CATALOG_PAGE_SIZE, before_title: Optional[str] = None,
+                   before_id: Optional[int] = None) -> Dict:
+    """
+    Get one page of books ordered by (title, id) using keyset pagination.
+
+    Pass the (title, id) of the last book on the current page as
+    after_title/after_id for the next page, or of the first book as
+    before_title/before_id for the previous one. Each page is an index range
+    scan on (title, id), so latency does not grow with catalog size or depth.
+
+    Returns:
+        dict: {'books': [...], 'has_more': bool} where has_more says whether
+        another page exists in the direction being read
+    """
+    backwards = before_id is not None
+    if backwards:
+        sql = '''
+            SELECT * FROM books WHERE (title, id) < (?, ?)
+            ORDER BY title DESC, id DESC LIMIT ?
+        '''
+        params = (before_title, before_id, limit + 1)
+    elif after_id is not None:
+        sql = '''
+            SELECT * FROM books WHERE (title, id) > (?, ?)
+            ORDER BY title, id LIMIT ?
+        '''
+        params = (after_title, after_id, limit + 1)
+    else:
+        sql = 'SELECT * FROM books ORDER BY title, id LIMIT ?'
+        params = (limit + 1,)
+
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+    books = [dict(row) for row in rows[:limit]]
+    if backwards:
+        books.reverse()
+    return {'books': books, 'has_more': len(rows) > limit}
+
 def get_book_by_id(book_id: int) -> Optional[Dict]:
-    """Get a specific book by ID."""
+    """Get a specific book by ID (served from the book cache when possible)."""
     conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
-    conn.close()
+    try:
+        cached = book_cache.get(conn, book_id=book_id)
+        if cached is not None:
+            return cached
+        book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+        if book:
+            book_cache.put(conn, dict(book))
+    finally:
+        conn.close()
     return dict(book) if book else None
 
 def get_book_by_isbn(isbn: str) -> Optional[Dict]:
-    """Get a specific book by ISBN."""
+    """Get a specific book by ISBN (served from the book cache when possible)."""
     conn = get_db_connection()
-    book = conn.execute('SELECT * FROM books WHERE isbn = ?', (isbn,)).fetchone()
-    conn.close()
+    try:
+        cached = book_cache.get(conn, isbn=isbn)
+        if cached is not None:
+            return cached
+        book = conn.execute('SELECT * FROM books WHERE isbn = ?', (isbn,)).fetchone()
+        if book:
+            book_cache.put(conn, dict(book))
+    finally:
+        conn.close()
     return dict(book) if book else None
 
+# Default and maximum page size for catalog searches
+SEARCH_LIMIT = 50
+SEARCH_MAX_LIMIT = 200
+
+# Trigram full-text queries need at least this many characters
+FTS_MIN_TERM_LENGTH = 3
+
+def fts_available(conn) -> bool:
+    """Check whether the books_fts full-text index exists in this database."""
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'"
+    ).fetchone() is not None
+
+def search_books(term: str, field: str, limit: int = SEARCH_LIMIT, offset: int = 0) -> List[Dict]:
+    """
+    Case-insensitive substring search on book title or author.
+
+    Uses the books_fts index ranked by bm25 relevance when available;
+    otherwise (no FTS5, or a term shorter than a trigram) falls back to a
+    LIKE scan ordered by title.
+
+    Args:
+        term: text to look for
+        field: 'title' or 'author'
+        limit: maximum number of rows to return
+        offset: number of matching rows to skip
+    """
+    if field not in ('title', 'author'):
+        raise ValueError(f'Cannot search books by {field!r}')
+    conn = get_db_connection()
+    try:
+        if len(term) >= FTS_MIN_TERM_LENGTH and fts_available(conn):
+            # Quote the term as an FTS5 string so punctuation is matched literally
+            match = '%s : "%s"' % (field, term.replace('"', '""'))
+            rows = conn.execute('''
+                SELECT b.*
+                FROM books_fts f
+                JOIN books b ON b.id = f.rowid
+                WHERE books_fts MATCH ?
+                ORDER BY f.rank, b.title, b.id
+                LIMIT ? OFFSET ?
+            ''', (match, limit, offset)).fetchall()
+        else:
+            pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            rows = conn.execute(f'''
+                SELECT * FROM books
+                WHERE {field} LIKE ? ESCAPE '\\'
+                ORDER BY title, id
+                LIMIT ? OFFSET ?
+            ''', (pattern, limit, offset)).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
 def get_patron_borrowed_books(patron_id: str) -> List[Dict]:
     """Get currently borrowed books for a patron."""
     conn = get_db_connection()
-    records = conn.execute('''
-        SELECT br.*, b.title, b.author 
-        FROM borrow_records br 
-        JOIN books b ON br.book_id = b.id 
-        WHERE br.patron_id = ? AND br.return_date IS NULL
-        ORDER BY br.borrow_date
-    ''', (patron_id,)).fetchall()
-    conn.close()
+    try:
+        records = conn.execute(ACTIVE_LOANS_SQL, (patron_id,)).fetchall()
+    finally:
+        conn.close()
     
+    today = today_epoch_day()
     borrowed_books = []
     for record in records:
         borrowed_books.append({
@@ -125,7 +1587,7 @@ def get_patron_borrowed_books(patron_id: str) -> List[Dict]:
             'author': record['author'],
             'borrow_date': datetime.fromisoformat(record['borrow_date']),
             'due_date': datetime.fromisoformat(record['due_date']),
-            'is_overdue': datetime.now() > datetime.fromisoformat(record['due_date'])
+            'is_overdue': record['due_day'] is not None and record['due_day'] < today
         })
     
     return borrowed_books
@@ -133,11 +1595,10 @@ def get_patron_borrowed_books(patron_id: str) -> List[Dict]:
 def get_patron_borrow_count(patron_id: str) -> int:
     """Get the number of books currently borrowed by a patron."""
     conn = get_db_connection()
-    count = conn.execute('''
-        SELECT COUNT(*) as count FROM borrow_records 
-        WHERE patron_id = ? AND return_date IS NULL
-    ''', (patron_id,)).fetchone()['count']
-    conn.close()
+    try:
+        count = conn.execute(ACTIVE_LOAN_COUNT_SQL, (patron_id,)).fetchone()['count']
+    finally:
+        conn.close()
     return count
 
 def insert_book(title: str, author: str, isbn: str, total_copies: int, available_copies: int) -> bool:
@@ -150,6 +1611,7 @@ def insert_book(title: str, author: str, isbn: str, total_copies: int, available
         ''', (title, author, isbn, total_copies, available_copies))
         conn.commit()
         conn.close()
+        book_cache.invalidate(isbn=isbn)
         return True
     except Exception as e:
         conn.close()
@@ -159,10 +1621,8 @@ def insert_borrow_record(patron_id: str, book_id: int, borrow_date: datetime, du
     """Insert a new borrow record into the database."""
     conn = get_db_connection()
     try:
-        conn.execute('''
-            INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date)
-            VALUES (?, ?, ?, ?)
-        ''', (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat()))
+        conn.execute(INSERT_BORROW_SQL, (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat(),
+                                         epoch_day(borrow_date), epoch_day(due_date)))
         conn.commit()
         conn.close()
         return True
@@ -179,6 +1639,7 @@ def update_book_availability(book_id: int, change: int) -> bool:
         ''', (change, book_id))
         conn.commit()
         conn.close()
+        book_cache.invalidate(book_id)
         return True
     except Exception as e:
         conn.close()
@@ -188,14 +1649,726 @@ def update_borrow_record_return_date(patron_id: str, book_id: int, return_date:
     """Update the return date for a borrow record."""
     conn = get_db_connection()
     try:
-        conn.execute('''
-            UPDATE borrow_records 
-            SET return_date = ? 
-            WHERE patron_id = ? AND book_id = ? AND return_date IS NULL
-        ''', (return_date.isoformat(), patron_id, book_id))
+        conn.execute(MARK_RETURNED_SQL, (return_date.isoformat(), epoch_day(return_date), patron_id, book_id))
+        conn.execute(FINALIZE_BOOK_FINES_SQL, (patron_id, book_id, return_date.isoformat()))
         conn.commit()
         conn.close()
         return True
     except Exception as e:
         conn.close()
         return False
+
+
+# Outcomes of borrow_book_atomic()
+BORROW_OK = 'ok'
+BORROW_NOT_FOUND = 'not_found'
+BORROW_UNAVAILABLE = 'unavailable'
+BORROW_LIMIT_REACHED = 'limit_reached'
+BORROW_ERROR = 'error'
+
+def borrow_book_atomic(patron_id: str, book_id: int, borrow_date: datetime, due_date: datetime,
+                       limit: int = BORROW_LIMIT) -> Tuple[str, Optional[Dict]]:
+    """
+    Borrow a book in a single write transaction.
+
+    The availability and loan-limit checks are part of the conditional
+    UPDATE that claims the copy, so two patrons racing for the last copy
+    cannot both succeed. The borrow record is inserted in the same
+    transaction.
+
+    Returns:
+        tuple: (outcome, book) where outcome is one of the BORROW_* values
+        and book is the book row (None if not found or on error)
+    """
+    conn = get_db_connection()
+    try:
+        with write_transaction(conn):
+            claimed = conn.execute(CLAIM_COPY_SQL, (book_id, patron_id, limit)).rowcount
+            book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+            if not claimed:
+                if not book:
+                    return BORROW_NOT_FOUND, None
+                if book['available_copies'] <= 0:
+                    return BORROW_UNAVAILABLE, dict(book)
+                return BORROW_LIMIT_REACHED, dict(book)
+            conn.execute(INSERT_BORROW_SQL, (patron_id, book_id, borrow_date.isoformat(), due_date.isoformat(),
+                                             epoch_day(borrow_date), epoch_day(due_date)))
+        book_cache.invalidate(book_id)
+        return BORROW_OK, dict(book)
+    except Exception as e:
+        return BORROW_ERROR, None
+    finally:
+        conn.close()
+
+# Outcomes of return_book_atomic()
+RETURN_OK = 'ok'
+RETURN_NOT_FOUND = 'not_found'
+RETURN_NO_LOAN = 'no_loan'
+RETURN_ERROR = 'error'
+
+def return_book_atomic(patron_id: str, book_id: int,
+                       return_date: datetime) -> Tuple[str, Optional[Dict], Optional[Dict]]:
+    """
+    Return a borrowed book in a single write transaction.
+
+    The patron's oldest active loan of the book is found with one indexed
+    lookup, marked returned, and the copy is put back on the shelf.
+
+    Returns:
+        tuple: (outcome, book, loan) where outcome is one of the RETURN_*
+        values, book is the book row and loan is the closed borrow record
+        (including due_date, return_date and the amount_paid towards its
+        late fee) when outcome is RETURN_OK
+    """
+    conn = get_db_connection()
+    try:
+        with write_transaction(conn):
+            book = conn.execute('SELECT * FROM books WHERE id = ?', (book_id,)).fetchone()
+            if not book:
+                return RETURN_NOT_FOUND, None, None
+            loan = conn.execute(ACTIVE_LOAN_FOR_BOOK_SQL, (patron_id, book_id)).fetchone()
+            if not loan:
+                return RETURN_NO_LOAN, dict(book), None
+            conn.execute('UPDATE borrow_records SET return_date = ?, return_day = ? WHERE id = ?',
+                         (return_date.isoformat(), epoch_day(return_date), loan['id']))
+            conn.execute(FINALIZE_LOAN_FINE_SQL, (loan['id'],))
+            conn.execute('UPDATE books SET available_copies = available_copies + 1 WHERE id = ?',
+                         (book_id,))
+            amount_paid = conn.execute(LOAN_AMOUNT_PAID_SQL, (loan['id'],)).fetchone()[0]
+        book_cache.invalidate(book_id)
+        loan = dict(loan)
+        loan['amount_paid'] = amount_paid
+        loan['return_date'] = return_date.isoformat()
+        loan['return_day'] = epoch_day(return_date)
+        return RETURN_OK, dict(book), loan
+    except Exception as e:
+        return RETURN_ERROR, None, None
+    finally:
+        conn.close()
+
+
+# SQLite's default limit on host parameters in one statement is 999
+MAX_QUERY_PARAMS = 900
+
+
+def find_existing_isbns(conn, isbns: List[str]) -> set:
+    """Get the subset of `isbns` already present in the books table."""
+    existing = set()
+    for start in range(0, len(isbns), MAX_QUERY_PARAMS):
+        chunk = isbns[start:start + MAX_QUERY_PARAMS]
+        placeholders = ','.join('?' * len(chunk))
+        rows = conn.execute(f'SELECT isbn FROM books WHERE isbn IN ({placeholders})', chunk).fetchall()
+        existing.update(row[0] for row in rows)
+    return existing
+
+
+def insert_books_batch(conn, books: List[Tuple[str, str, str, int, int]]) -> int:
+    """
+    Insert many books with one executemany in a single write transaction.
+
+    Args:
+        conn: connection from get_standalone_connection()
+        books: (title, author, isbn, total_copies, available_copies) tuples
+
+    Returns:
+        int: number of rows inserted
+
+    Raises:
+        sqlite3.IntegrityError: if an ISBN already exists; nothing is inserted
+    """
+    with write_transaction(conn):
+        cur = conn.executemany('''
+            INSERT INTO books (title, author, isbn, total_copies, available_copies)
+            VALUES (?, ?, ?, ?, ?)
+        ''', books)
+    return cur.rowcount
+
+
+def get_patrons_owing(min_fee: float = 0.0, as_of: Optional[date] = None) -> List[Dict]:
+    """
+    Patrons whose total late fees exceed `min_fee`, computed in one grouped query.
+
+    Args:
+        min_fee: only patrons owing more than this are returned
+        as_of: date open loans are charged up to; defaults to today
+
+    Returns:
+        list: {'patron_id', 'loans', 'borrowed_count', 'total_late_fees'} dicts,
+        largest total first
+    """
+    params = {'min_fee': min_fee, 'today': epoch_day(as_of) if as_of else today_epoch_day()}
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(PATRONS_OWING_SQL, params).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+
+def get_overdue_loan_columns(today: Optional[int] = None,
+                             fetch_size: int = EXPORT_FETCH_SIZE * 10) -> Dict[str, list]:
+    """
+    Load every overdue open loan column-wise in a single query.
+
+    Args:
+        today: epoch day to measure against; defaults to today
+        fetch_size: rows fetched from SQLite per round trip
+
+    Returns:
+        dict: 'id', 'patron_id', 'book_id' and 'due_day' lists of equal length
+    """
+    columns = {'id': [], 'patron_id': [], 'book_id': [], 'due_day': []}
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None  # plain tuples; sqlite3.Row costs more per row than it saves here
+        cursor.execute(OVERDUE_LOANS_SQL, (today_epoch_day() if today is None else today,))
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for column, values in zip(columns.values(), zip(*rows)):
+                column.extend(values)
+    finally:
+        conn.close()
+    return columns
+
+
+def get_book_titles(book_ids: List[int]) -> Dict[int, str]:
+    """Map book ids to titles, querying in chunks of MAX_QUERY_PARAMS."""
+    book_ids = list(dict.fromkeys(book_ids))
+    titles = {}
+    conn = get_db_connection()
+    try:
+        for start in range(0, len(book_ids), MAX_QUERY_PARAMS):
+            chunk = book_ids[start:start + MAX_QUERY_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(f'SELECT id, title FROM books WHERE id IN ({placeholders})', chunk)
+            titles.update((row['id'], row['title']) for row in rows)
+    finally:
+        conn.close()
+    return titles
+
+
+# Fines ledger: one row per fee-bearing loan, kept current by the daily
+# update_fines_ledger() job. Open loans are refreshed by the job; a loan's
+# row is made final (fee fixed at its return day) when it is returned.
+_FINALIZE_FINES_TEMPLATE = '''
+    INSERT INTO fines (loan_id, patron_id, book_id, fee_amount, fee_day, final)
+    SELECT id, patron_id, book_id, late_fee(return_day - due_day), return_day, 1
+    FROM borrow_records
+    WHERE {where} AND return_day IS NOT NULL AND return_day > due_day
+    ON CONFLICT (loan_id) DO UPDATE
+    SET fee_amount = excluded.fee_amount, fee_day = excluded.fee_day, final = 1
+'''
+
+FINALIZE_LOAN_FINE_SQL = _FINALIZE_FINES_TEMPLATE.format(where='id = ?')
+FINALIZE_BOOK_FINES_SQL = _FINALIZE_FINES_TEMPLATE.format(
+    where='patron_id = ? AND book_id = ? AND return_date = ?')
+# Returned loans whose row is still open, e.g. returned by another tool
+FINALIZE_STALE_FINES_SQL = _FINALIZE_FINES_TEMPLATE.format(
+    where='id IN (SELECT loan_id FROM fines WHERE final = 0) AND return_date IS NOT NULL')
+FINALIZE_ALL_FINES_SQL = _FINALIZE_FINES_TEMPLATE.format(where='1')
+
+# Open loans overdue by :today whose fee may have changed since the ledger
+# was last brought up to date; rows whose fee is unchanged are not rewritten
+REFRESH_OPEN_FINES_SQL = '''
+    INSERT INTO fines (loan_id, patron_id, book_id, fee_amount, fee_day, final)
+    SELECT id, patron_id, book_id, late_fee(:today - due_day), :today, 0
+    FROM borrow_records
+    WHERE return_date IS NULL AND due_day < :today AND due_day > :since
+    ON CONFLICT (loan_id) DO UPDATE
+    SET fee_amount = excluded.fee_amount, fee_day = excluded.fee_day
+    WHERE fines.fee_amount <> excluded.fee_amount
+'''
+
+def update_fines_ledger(today: Optional[int] = None) -> Dict:
+    """
+    Bring the fines ledger up to date for `today` (an epoch day, default today).
+
+    Only loans whose fee can have changed since the previous run are
+    touched: open loans that became overdue or have not yet reached the cap
+    (LATE_FEE_CAP_DAYS), plus returned loans whose row is not final yet. The
+    first run builds the ledger from the whole history. Runs at most once
+    per day; the run is recorded in fines_ledger_runs.
+
+    Returns:
+        dict: run_day, previous_run_day, full_rebuild, skipped, loans_updated,
+        loans_finalized and elapsed_seconds
+    """
+    today = today_epoch_day() if today is None else today
+    result = {'run_day': today, 'previous_run_day': None, 'full_rebuild': False, 'skipped': False,
+              'loans_updated': 0, 'loans_finalized': 0}
+    started = time.perf_counter()
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            last = conn.execute('SELECT MAX(run_day) FROM fines_ledger_runs').fetchone()[0]
+            result['previous_run_day'] = last
+            if last is not None and last >= today:
+                result['skipped'] = True
+            else:
+                result['full_rebuild'] = last is None
+                finalize_sql = FINALIZE_ALL_FINES_SQL if last is None else FINALIZE_STALE_FINES_SQL
+                result['loans_finalized'] = conn.execute(finalize_sql).rowcount
+                since = -1 if last is None else last - LATE_FEE_CAP_DAYS
+                result['loans_updated'] = conn.execute(
+                    REFRESH_OPEN_FINES_SQL, {'today': today, 'since': since}).rowcount
+                conn.execute(
+                    'INSERT INTO fines_ledger_runs (run_day, finished_at, loans_updated, loans_finalized) '
+                    'VALUES (?, ?, ?, ?)',
+                    (today, datetime.now().isoformat(), result['loans_updated'], result['loans_finalized']),
+                )
+    finally:
+        conn.close()
+    result['elapsed_seconds'] = round(time.perf_counter() - started, 3)
+    return result
+
+def fines_ledger_is_current(conn, today: Optional[int] = None) -> bool:
+    """True if the fines job has already run for `today` (default today)."""
+    today = today_epoch_day() if today is None else today
+    return conn.execute('SELECT 1 FROM fines_ledger_runs WHERE run_day = ?', (today,)).fetchone() is not None
+
+def get_fines_ledger_stats() -> Dict:
+    """Last run of the fines job and the size of the ledger, for /api/metrics."""
+    conn = get_db_connection()
+    try:
+        last = conn.execute('SELECT * FROM fines_ledger_runs ORDER BY run_day DESC LIMIT 1').fetchone()
+        rows = conn.execute('SELECT COUNT(*) FROM fines').fetchone()[0]
+    finally:
+        conn.close()
+    return {
+        'last_run_day': date_from_epoch_day(last['run_day']).isoformat() if last else None,
+        'current': last is not None and last['run_day'] == today_epoch_day(),
+        'last_loans_updated': last['loans_updated'] if last else None,
+        'rows': rows,
+    }
+
+# Payment jobs: late fee payments run in the background by
+# services/payment_jobs.py. Their state is kept here, written on standalone
+# connections so a worker sees a job as soon as it has been submitted, and
+# read back after a restart to resume unfinished work. A running job names
+# the runner that claimed it, which keeps its updated_at fresh as a heartbeat
+# so other processes can tell a live claim from one left by a dead process.
+PAYMENT_JOB_QUEUED = 'queued'
+PAYMENT_JOB_RUNNING = 'running'
+PAYMENT_JOB_SUCCEEDED = 'succeeded'
+PAYMENT_JOB_FAILED = 'failed'
+PAYMENT_JOB_INTERRUPTED = 'interrupted'    # was running when the process stopped
+
+def insert_payment_job(job_id: str, patron_id: str, book_id: int, amount: float, description: str,
+                       idempotency_key: Optional[str] = None, loan_id: Optional[int] = None) -> Dict:
+    """Record a new queued payment job and return it."""
+    now = datetime.now().isoformat()
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            conn.execute('''
+                INSERT INTO payment_jobs (id, patron_id, book_id, amount, description, status,
+                                          created_at, updated_at, idempotency_key, loan_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (job_id, patron_id, book_id, amount, description, PAYMENT_JOB_QUEUED, now, now,
+                  idempotency_key, loan_id))
+            row = conn.execute('SELECT * FROM payment_jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return dict(row)
+
+def claim_payment_job(job_id: str, owner: Optional[str] = None) -> Optional[Dict]:
+    """
+    Move a queued job to running, claimed by `owner`, and return it.
+    Returns None if the job is unknown or no longer queued, so each job is
+    run by one worker only.
+    """
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            claimed = conn.execute('''
+                UPDATE payment_jobs SET status = ?, attempts = attempts + 1, claimed_by = ?, updated_at = ?
+                WHERE id = ? AND status = ?
+            ''', (PAYMENT_JOB_RUNNING, owner, datetime.now().isoformat(), job_id,
+                  PAYMENT_JOB_QUEUED)).rowcount
+            row = conn.execute('SELECT * FROM payment_jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return dict(row) if claimed else None
+
+def finish_payment_job(job_id: str, status: str, transaction_id: Optional[str], message: str):
+    """Record the outcome of a payment job."""
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            conn.execute('''
+                UPDATE payment_jobs SET status = ?, transaction_id = ?, message = ?, updated_at = ?
+                WHERE id = ?
+            ''', (status, transaction_id, message, datetime.now().isoformat(), job_id))
+    finally:
+        conn.close()
+
+def heartbeat_payment_jobs(owner: str) -> int:
+    """Refresh updated_at on the running jobs claimed by `owner`; returns how many."""
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            return conn.execute('''
+                UPDATE payment_jobs SET updated_at = ? WHERE claimed_by = ? AND status = ?
+            ''', (datetime.now().isoformat(), owner, PAYMENT_JOB_RUNNING)).rowcount
+    finally:
+        conn.close()
+
+def interrupt_stale_payment_job(job_id: str, stale_before: datetime, message: str) -> bool:
+    """
+    Mark a running job interrupted if its heartbeat is older than `stale_before`.
+    Returns False (and changes nothing) while its runner is still alive.
+    """
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            return conn.execute('''
+                UPDATE payment_jobs SET status = ?, message = ?, updated_at = ?
+                WHERE id = ? AND status = ? AND updated_at < ?
+            ''', (PAYMENT_JOB_INTERRUPTED, message, datetime.now().isoformat(), job_id,
+                  PAYMENT_JOB_RUNNING, stale_before.isoformat())).rowcount > 0
+    finally:
+        conn.close()
+
+def get_payment_job(job_id: str) -> Optional[Dict]:
+    """Get a payment job by id."""
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT * FROM payment_jobs WHERE id = ?', (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return dict(row) if row else None
+
+def get_unfinished_payment_jobs() -> List[Dict]:
+    """Queued and running jobs, oldest first (read through the partial index)."""
+    conn = get_standalone_connection()
+    try:
+        rows = conn.execute('''
+            SELECT * FROM payment_jobs WHERE status IN ('queued', 'running') ORDER BY created_at
+        ''').fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+def get_payment_job_counts() -> Dict[str, int]:
+    """Number of payment jobs in each status."""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('SELECT status, COUNT(*) AS jobs FROM payment_jobs GROUP BY status').fetchall()
+    finally:
+        conn.close()
+    return {row['status']: row['jobs'] for row in rows}
+
+# Payments ledger: one row per idempotency key, i.e. per loan and fee
+# snapshot. A key is claimed (pending) before the gateway is called and
+# settled afterwards, so a retry or double submission of the same fee finds
+# the earlier payment instead of charging again.
+PAYMENT_PENDING = 'pending'
+PAYMENT_SUBMITTED = 'submitted'    # accepted by the gateway, completion to follow by webhook
+PAYMENT_PAID = 'paid'
+PAYMENT_FAILED = 'failed'
+PAYMENT_PENDING_TIMEOUT = 120.0    # seconds after which an unsettled claim may be retried
+
+def begin_payment(idempotency_key: str, patron_id: str, book_id: int, loan_id: Optional[int],
+                  amount: float) -> Tuple[bool, Dict]:
+    """
+    Claim an idempotency key before charging.
+
+    A new key, a failed attempt, or a pending claim older than
+    PAYMENT_PENDING_TIMEOUT is (re)claimed as pending.
+
+    Returns:
+        tuple: (claimed, payment row); when not claimed the row is the
+        existing paid or still-pending payment
+    """
+    now = datetime.now()
+    stale = (now - timedelta(seconds=PAYMENT_PENDING_TIMEOUT)).isoformat()
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            claimed = conn.execute('''
+                INSERT INTO payments (idempotency_key, patron_id, book_id, loan_id, amount, status,
+                                      created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (idempotency_key) DO UPDATE
+                SET status = excluded.status, amount = excluded.amount, message = NULL,
+                    charge_key = NULL, updated_at = excluded.updated_at
+                WHERE payments.status = ? OR (payments.status = ? AND payments.updated_at < ?)
+            ''', (idempotency_key, patron_id, book_id, loan_id, amount, PAYMENT_PENDING,
+                  now.isoformat(), now.isoformat(), PAYMENT_FAILED, PAYMENT_PENDING, stale)).rowcount
+            row = conn.execute('SELECT * FROM payments WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+    finally:
+        conn.close()
+    return bool(claimed), dict(row)
+
+def gateway_idempotency_key(key: str, attempt: int) -> str:
+    """
+    The Idempotency-Key to send the gateway for a payment (or consolidated charge) key.
+
+    Every retry of a payment sends the same key, so the gateway applies the
+    charge once however often it is resent, including after a timeout or
+    when a stale pending claim is taken over. Only a definite answer from
+    the gateway (a decline) moves the payment to its next attempt, since
+    the gateway would replay that answer for the old key.
+    """
+    return f"{key}#{attempt}"
+
+def settle_payment(idempotency_key: str, status: str, transaction_id: Optional[str], message: str,
+                   next_attempt: bool = False):
+    """Record the gateway's answer for a claimed payment; `next_attempt` after a decline."""
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            conn.execute('''
+                UPDATE payments SET status = ?, transaction_id = ?, message = ?, updated_at = ?,
+                                    gateway_attempt = gateway_attempt + ?
+                WHERE idempotency_key = ?
+            ''', (status, transaction_id, message, datetime.now().isoformat(), int(next_attempt),
+                  idempotency_key))
+    finally:
+        conn.close()
+
+def get_payment(idempotency_key: str) -> Optional[Dict]:
+    """Get a payments ledger row by idempotency key."""
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT * FROM payments WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+    finally:
+        conn.close()
+    return dict(row) if row else None
+
+# A consolidated charge pays several loans in one gateway transaction. Each
+# loan's share is an ordinary payments row under that loan's own key, tagged
+# with the charge_key of the charge, so owed/paid amounts and single-book
+# retries see it exactly like a payment made for that book alone.
+
+def begin_payment_allocations(charge_key: str, patron_id: str,
+                              allocations: List[Dict]) -> Tuple[bool, List[Dict]]:
+    """
+    Claim the keys of every allocation of a consolidated charge, or none.
+
+    Each allocation has idempotency_key, book_id, loan_id and amount. The
+    claim fails if any key is paid, submitted for webhook completion, or
+    claimed by a live pending payment.
+
+    Returns:
+        tuple: (claimed, rows); the claimed rows, or else the rows in the way
+    """
+    now = datetime.now()
+    stale = (now - timedelta(seconds=PAYMENT_PENDING_TIMEOUT)).isoformat()
+    keys = [a['idempotency_key'] for a in allocations]
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            blocking = conn.execute(f'''
+                SELECT * FROM payments
+                WHERE idempotency_key IN ({', '.join('?' * len(keys))})
+                  AND (status IN (?, ?) OR (status = ? AND updated_at >= ?))
+            ''', keys + [PAYMENT_PAID, PAYMENT_SUBMITTED, PAYMENT_PENDING, stale]).fetchall()
+            if blocking:
+                return False, [dict(row) for row in blocking]
+            conn.executemany('''
+                INSERT INTO payments (idempotency_key, patron_id, book_id, loan_id, amount, status,
+                                      charge_key, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (idempotency_key) DO UPDATE
+                SET status = excluded.status, amount = excluded.amount, message = NULL,
+                    transaction_id = NULL, charge_key = excluded.charge_key,
+                    updated_at = excluded.updated_at
+            ''', [(a['idempotency_key'], patron_id, a['book_id'], a['loan_id'], a['amount'], PAYMENT_PENDING,
+                   charge_key, now.isoformat(), now.isoformat()) for a in allocations])
+            rows = conn.execute('SELECT * FROM payments WHERE charge_key = ? ORDER BY rowid',
+                                (charge_key,)).fetchall()
+    finally:
+        conn.close()
+    return True, [dict(row) for row in rows]
+
+def settle_payment_allocations(charge_key: str, status: str, transaction_id: Optional[str], message: str,
+                               next_attempt: bool = False):
+    """Record the gateway's answer for every allocation of a consolidated charge."""
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            conn.execute('''
+                UPDATE payments SET status = ?, transaction_id = ?, message = ?, updated_at = ?,
+                                    gateway_attempt = gateway_attempt + ?
+                WHERE charge_key = ?
+            ''', (status, transaction_id, message, datetime.now().isoformat(), int(next_attempt),
+                  charge_key))
+    finally:
+        conn.close()
+
+def get_payment_allocations(charge_key: str) -> List[Dict]:
+    """The per-loan rows of a consolidated charge."""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('SELECT * FROM payments WHERE charge_key = ? ORDER BY rowid', (charge_key,)).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+# Payment reconciliation: settled charges are checked against the gateway.
+# Transactions the gateway reports in a terminal status are remembered in
+# payment_verifications and not checked again; anything that does not match
+# the ledger is written to payment_discrepancies under the run that found it.
+DISCREPANCY_NOT_FOUND = 'not_found'
+DISCREPANCY_STATUS = 'status'
+DISCREPANCY_AMOUNT = 'amount'
+
+def get_unverified_transactions(since: str = '') -> List[Dict]:
+    """Paid gateway transactions settled at or after `since` (ISO time) and not yet verified."""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute(UNVERIFIED_TRANSACTIONS_SQL, {'since': since}).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+def count_verified_transactions() -> int:
+    conn = get_db_connection()
+    try:
+        return conn.execute('SELECT COUNT(*) FROM payment_verifications').fetchone()[0]
+    finally:
+        conn.close()
+
+def record_reconciliation_run(started_at: datetime, stats: Dict, verifications: List[Tuple],
+                              discrepancies: List[Dict]) -> int:
+    """
+    Store the outcome of a reconciliation run in one transaction.
+
+    Args:
+        stats: checked, already_verified, errors and elapsed_seconds
+        verifications: (transaction_id, status, amount) of terminal statuses
+        discrepancies: dicts with transaction_id, kind, expected_amount,
+            gateway_status, gateway_amount and detail
+
+    Returns:
+        int: the run id
+    """
+    now = datetime.now().isoformat()
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            run_id = conn.execute('''
+                INSERT INTO reconciliation_runs (started_at, finished_at, checked, already_verified,
+                                                 discrepancies, errors, elapsed_seconds)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (started_at.isoformat(), now, stats['checked'], stats['already_verified'],
+                  len(discrepancies), stats['errors'], stats['elapsed_seconds'])).lastrowid
+            conn.executemany('''
+                INSERT OR REPLACE INTO payment_verifications (transaction_id, status, amount, checked_at)
+                VALUES (?, ?, ?, ?)
+            ''', [(txn, status, amount, now) for txn, status, amount in verifications])
+            conn.executemany('''
+                INSERT INTO payment_discrepancies (run_id, transaction_id, kind, expected_amount,
+                                                   gateway_status, gateway_amount, detail)
+                VALUES (:run_id, :transaction_id, :kind, :expected_amount,
+                        :gateway_status, :gateway_amount, :detail)
+            ''', [dict(d, run_id=run_id) for d in discrepancies])
+    finally:
+        conn.close()
+    return run_id
+
+def get_payment_discrepancies(run_id: Optional[int] = None) -> List[Dict]:
+    """Discrepancies found by one run, or by every run, oldest first."""
+    conn = get_db_connection()
+    try:
+        if run_id is None:
+            rows = conn.execute('SELECT * FROM payment_discrepancies ORDER BY id').fetchall()
+        else:
+            rows = conn.execute('SELECT * FROM payment_discrepancies WHERE run_id = ? ORDER BY id',
+                                (run_id,)).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+def mark_payment_submitted(idempotency_key: str, transaction_id: str):
+    """Record the transaction id of a charge the gateway accepted for webhook completion."""
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            conn.execute('''
+                UPDATE payments
+                SET transaction_id = COALESCE(transaction_id, ?),
+                    status = CASE WHEN status = ? THEN ? ELSE status END,
+                    updated_at = ?
+                WHERE idempotency_key = ?
+            ''', (transaction_id, PAYMENT_PENDING, PAYMENT_SUBMITTED, datetime.now().isoformat(),
+                  idempotency_key))
+    finally:
+        conn.close()
+
+# Outcomes of apply_payment_event
+WEBHOOK_APPLIED = 'applied'
+WEBHOOK_DUPLICATE = 'duplicate'
+WEBHOOK_UNKNOWN = 'unknown'
+WEBHOOK_AMOUNT_MISMATCH = 'amount_mismatch'
+
+def apply_payment_event(event_id: str, event_type: str, transaction_id: Optional[str],
+                        reference: Optional[str], status: str, message: str,
+                        amount: Optional[float] = None) -> Tuple[str, List[Dict]]:
+    """
+    Apply a gateway webhook to the payments it is about, at most once.
+
+    The event id is recorded in the same transaction as the update, so a
+    repeated delivery changes nothing. A success settles every matching
+    payment that is not already paid (even one given up as failed, since
+    the money was taken), but only if `amount` is what those payments add
+    up to; otherwise nothing is settled and an amount discrepancy is
+    recorded for reconciliation. A failure only settles payments still
+    pending or submitted. An event matching no payment is not recorded, so
+    a later redelivery can still apply.
+
+    Returns:
+        tuple: (WEBHOOK_APPLIED, DUPLICATE, UNKNOWN or AMOUNT_MISMATCH,
+        payment rows updated)
+    """
+    now = datetime.now().isoformat()
+    conn = get_standalone_connection()
+    try:
+        with write_transaction(conn):
+            if conn.execute('SELECT 1 FROM payment_webhook_events WHERE event_id = ?', (event_id,)).fetchone():
+                return WEBHOOK_DUPLICATE, []
+            rows = conn.execute(PAYMENTS_FOR_EVENT_SQL,
+                                {'transaction_id': transaction_id, 'reference': reference}).fetchall()
+            if not rows:
+                return WEBHOOK_UNKNOWN, []
+            outcome = WEBHOOK_APPLIED
+            expected = round(sum(r['amount'] for r in rows), 2)
+            if status == PAYMENT_PAID and (amount is None or abs(amount - expected) >= 0.005):
+                outcome, updatable = WEBHOOK_AMOUNT_MISMATCH, []
+                conn.execute('''
+                    INSERT INTO payment_discrepancies (event_id, transaction_id, kind, expected_amount,
+                                                       gateway_status, gateway_amount, detail)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (event_id, transaction_id or reference, DISCREPANCY_AMOUNT, expected, event_type, amount,
+                      f"Webhook {event_id} reports {amount} for payments of {expected:.2f}; not settled"))
+            elif status == PAYMENT_PAID:
+                updatable = [r for r in rows if r['status'] != PAYMENT_PAID]
+            else:
+                updatable = [r for r in rows if r['status'] in (PAYMENT_PENDING, PAYMENT_SUBMITTED)]
+            conn.executemany('''
+                UPDATE payments SET status = ?, transaction_id = COALESCE(?, transaction_id), message = ?,
+                                    updated_at = ?
+                WHERE idempotency_key = ?
+            ''', [(status, transaction_id, message, now, r['idempotency_key']) for r in updatable])
+            conn.execute('''
+                INSERT INTO payment_webhook_events (event_id, event_type, transaction_id, received_at)
+                VALUES (?, ?, ?, ?)
+            ''', (event_id, event_type, transaction_id, now))
+    finally:
+        conn.close()
+    return outcome, [dict(r) for r in updatable]
+
+
+def get_payments_by_transaction(transaction_id: str) -> List[Dict]:
+    """Payments ledger rows for a gateway transaction (several for a consolidated charge)."""
+    conn = get_db_connection()
+    try:
+        rows = conn.execute('SELECT * FROM payments WHERE transaction_id = ? ORDER BY rowid',
+                            (transaction_id,)).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
@@ -4,10 +4,17 @@ API Routes - JSON API endpoints
 
 import sys
 import os
+from datetime import date
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from flask import Blueprint, jsonify, request
-from services.library_service import calculate_late_fee_for_book, search_books_in_catalog
+from flask import Blueprint, Response, jsonify, request, stream_with_context, url_for
+from services.library_service import get_cached_late_fee, get_late_fee_cache_stats, calculate_late_fees_for_books, get_patron_status_report, pay_all_late_fees, search_catalog_page, get_catalog_page, submit_late_fee_payment, complete_payment_from_webhook, WEBHOOK_IGNORED, WEBHOOK_BAD_SIGNATURE, WEBHOOK_MALFORMED, WEBHOOK_NOT_CONFIGURED
+from services.catalog_import import import_books, detect_format, open_text, IMPORT_FORMATS
+from services.payment_jobs import submit_payment_job, get_payment_job_stats
+from services.payment_service import get_gateway_stats, get_webhook_secret, WEBHOOK_SIGNATURE_HEADER
+from services.fines_report import overdue_report, REPORT_SORTS, REPORT_TOP
+from services.catalog_export import export_books, export_borrow_records, EXPORT_FORMATS, EXPORT_MIMETYPES
+from database import get_payment_job, get_payments_by_transaction, WEBHOOK_APPLIED, WEBHOOK_DUPLICATE, WEBHOOK_UNKNOWN, WEBHOOK_AMOUNT_MISMATCH, get_pool_stats, get_performance_report, get_book_cache_stats, get_fines_ledger_stats, SEARCH_LIMIT, CATALOG_PAGE_SIZE, LATE_FEE_BATCH_LIMIT, PATRON_HISTORY_PAGE_SIZE
 
 
 
@@ -18,10 +25,58 @@ def get_late_fee(patron_id, book_id):
     """
     Calculate late fee for a specific book borrowed by a patron.
     API endpoint for R4: Late Fee Calculation
+    Cached until midnight; borrowing or returning the book drops the entry.
     """
-    result = calculate_late_fee_for_book(patron_id, book_id)
+    result = get_cached_late_fee(patron_id, book_id)
     return jsonify(result), 501 if 'not implemented' in result.get('status', '') else 200
 
+@api_bp.route('/late_fee/batch', methods=['POST'])
+def get_late_fees_batch():
+    """
+    Late fees for many loans in one request.
+    Batch interface for R4: Late Fee Calculation
+
+    Body: {"loans": [{"patron_id": "123456", "book_id": 1}, ...]}, at most
+    LATE_FEE_BATCH_LIMIT entries; results are returned in the same order.
+    """
+    body = request.get_json(silent=True) or {}
+    loans = body.get('loans')
+    if not isinstance(loans, list):
+        return jsonify({'error': "Body must be a JSON object with a 'loans' list"}), 400
+    if len(loans) > LATE_FEE_BATCH_LIMIT:
+        return jsonify({'error': f'At most {LATE_FEE_BATCH_LIMIT} loans per request'}), 400
+
+    pairs = []
+    for index, loan in enumerate(loans):
+        if (not isinstance(loan, dict) or not isinstance(loan.get('patron_id'), str)
+                or not isinstance(loan.get('book_id'), int) or isinstance(loan.get('book_id'), bool)):
+            return jsonify({'error': f'Loan {index} needs a string patron_id and an integer book_id'}), 400
+        pairs.append((loan['patron_id'], loan['book_id']))
+
+    results = calculate_late_fees_for_books(pairs)
+    return jsonify({'results': results, 'count': len(results)}), 200
+
+@api_bp.route('/catalog')
+def catalog_api():
+    """
+    Browse the catalog via API endpoint, one page at a time.
+    JSON interface for R2: Book Catalog Display
+    
+    Pass next_cursor (as ?after=) or prev_cursor (as ?before=) from a
+    previous response to move between pages.
+    """
+    page = get_catalog_page(
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        limit=request.args.get('limit', CATALOG_PAGE_SIZE, type=int),
+    )
+    return jsonify({
+        'books': page['books'],
+        'count': len(page['books']),
+        'next_cursor': page['next_cursor'],
+        'prev_cursor': page['prev_cursor']
+    })
+
 @api_bp.route('/search')
 def search_books_api():
     """
@@ -34,12 +89,243 @@ def search_books_api():
     if not search_term:
         return jsonify({'error': 'Search term is required'}), 400
     
-    # Use business logic function
-    books = search_books_in_catalog(search_term, search_type)
+    # Use business logic function; limit and offset come back clamped as used
+    page = search_catalog_page(search_term, search_type,
+                               request.args.get('limit', SEARCH_LIMIT, type=int),
+                               request.args.get('offset', 0, type=int))
+    books = page['books']
     
     return jsonify({
         'search_term': search_term,
         'search_type': search_type,
         'results': books,
-        'count': len(books)
+        'count': len(books),
+        'limit': page['limit'],
+        'offset': page['offset'],
+        'has_more': page['has_more']
+    })
+
+
+@api_bp.route('/books/import', methods=['POST'])
+def import_books_api():
+    """
+    Bulk import books from an uploaded CSV or JSONL file.
+    Batch interface for R1: Add Book To Catalog
+    
+    Send the file as multipart field 'file' or as the raw request body;
+    ?format=csv|jsonl overrides the format guessed from the file name.
+    The file is read as a stream, so large imports are not held in memory.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        stream, filename = upload.stream, upload.filename or ''
+    else:
+        stream, filename = request.stream, ''
+    fmt = request.args.get('format') or detect_format(filename)
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({'error': f"Unsupported format '{fmt}'; use csv or jsonl"}), 400
+    
+    report = import_books(open_text(stream), fmt)
+    return jsonify(report), 200
+
+
+def _export_response(fmt, chunks, name):
+    """Stream export chunks as a file download."""
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_MIMETYPES[fmt],
+        headers={'Content-Disposition': f'attachment; filename={name}.{fmt}'},
+    )
+
+@api_bp.route('/export/books')
+def export_books_api():
+    """
+    Export the whole catalog as NDJSON (default) or CSV (?format=csv).
+    Rows are streamed as they are read from the database.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported format '{fmt}'; use ndjson or csv"}), 400
+    return _export_response(fmt, export_books(fmt), 'books')
+
+@api_bp.route('/export/borrows')
+def export_borrows_api():
+    """
+    Export borrow records as NDJSON (default) or CSV (?format=csv).
+    Pass ?patron_id= to export a single patron's history.
+    """
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported format '{fmt}'; use ndjson or csv"}), 400
+    patron_id = request.args.get('patron_id') or None
+    return _export_response(fmt, export_borrow_records(fmt, patron_id), 'borrow_records')
+
+
+@api_bp.route('/reports/overdue')
+def overdue_report_api():
+    """
+    Library-wide overdue loans and the fines they have accrued.
+    
+    Query parameters: sort (fee, days or patron), top (entries to return,
+    0 for all), group=patron for per-patron totals, as_of=YYYY-MM-DD.
+    """
+    sort = request.args.get('sort', 'fee')
+    if sort not in REPORT_SORTS:
+        return jsonify({'error': f"Unsupported sort '{sort}'; use one of {', '.join(REPORT_SORTS)}"}), 400
+    top = request.args.get('top', REPORT_TOP, type=int)
+    if top < 0:
+        return jsonify({'error': 'top must be zero or positive'}), 400
+    as_of = request.args.get('as_of')
+    if as_of:
+        try:
+            as_of = date.fromisoformat(as_of)
+        except ValueError:
+            return jsonify({'error': 'as_of must be a YYYY-MM-DD date'}), 400
+    
+    report = overdue_report(as_of=as_of or None, sort=sort, top=top or None,
+                            by_patron=request.args.get('group') == 'patron')
+    return jsonify(report)
+
+
+@api_bp.route('/patrons/<patron_id>/status')
+def patron_status_api(patron_id):
+    """
+    Status report for a patron, one page of borrow history at a time.
+    API endpoint for R7: Patron Status Report
+    
+    Query parameters: limit (borrows per page), after (next_cursor of the
+    previous page), summary=1 for the counts and fee total only.
+    """
+    if request.args.get('summary') in ('1', 'true'):
+        return jsonify(get_patron_status_report(patron_id, summary_only=True))
+    report = get_patron_status_report(
+        patron_id,
+        limit=request.args.get('limit', PATRON_HISTORY_PAGE_SIZE, type=int),
+        after=request.args.get('after'),
+    )
+    return jsonify(report)
+
+
+@api_bp.route('/patrons/<patron_id>/late_fees/pay', methods=['POST'])
+def pay_all_late_fees_api(patron_id):
+    """
+    Pay all of a patron's outstanding late fees in one gateway charge.
+    Returns the transaction id, the total and how it was split across books.
+    """
+    success, message, transaction_id, allocations = pay_all_late_fees(patron_id)
+    if not success:
+        return jsonify({'error': message}), 400
+    return jsonify({
+        'transaction_id': transaction_id,
+        'message': message,
+        'total': round(sum(a['amount'] for a in allocations), 2),
+        'allocations': allocations,
+    })
+
+
+@api_bp.route('/payments', methods=['POST'])
+def submit_payment_api():
+    """
+    Queue payment of the late fee for a book; returns a job id at once.
+    Body: {"patron_id": "123456", "book_id": 1}. Poll /api/payments/<job_id>
+    for the outcome.
+
+    With "completion": "webhook" the charge is submitted to the gateway
+    instead, which posts the outcome to /api/payments/webhook; poll
+    /api/payments/transactions/<transaction_id> for it.
+    """
+    body = request.get_json(silent=True) or {}
+    patron_id, book_id = body.get('patron_id'), body.get('book_id')
+    if not isinstance(patron_id, str) or not isinstance(book_id, int) or isinstance(book_id, bool):
+        return jsonify({'error': 'patron_id (string) and book_id (integer) are required'}), 400
+
+    completion = body.get('completion', 'job')
+    if completion == 'webhook':
+        if not get_webhook_secret():
+            return jsonify({'error': 'Webhook payments are not configured'}), 503
+        callback_url = os.environ.get('PAYMENT_WEBHOOK_URL') or url_for('api.payment_webhook_api', _external=True)
+        success, message, transaction_id = submit_late_fee_payment(patron_id, book_id, callback_url)
+        if not success:
+            return jsonify({'error': message}), 400
+        return jsonify({
+            'transaction_id': transaction_id,
+            'status': 'submitted',
+            'message': message,
+            'status_url': url_for('api.payment_transaction_api', transaction_id=transaction_id),
+        }), 202
+    if completion != 'job':
+        return jsonify({'error': 'completion must be "job" or "webhook"'}), 400
+
+    success, message, job_id = submit_payment_job(patron_id, book_id)
+    if not success:
+        return jsonify({'error': message}), 400
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'message': message,
+        'status_url': url_for('api.payment_job_api', job_id=job_id),
+    }), 202
+
+@api_bp.route('/payments/<job_id>')
+def payment_job_api(job_id):
+    """Status of a payment job: queued, running, succeeded, failed or interrupted."""
+    job = get_payment_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Payment job not found'}), 404
+    return jsonify(job)
+
+
+# HTTP status for each webhook outcome; a 404 lets the gateway redeliver later
+WEBHOOK_HTTP_STATUS = {
+    WEBHOOK_APPLIED: 200,
+    WEBHOOK_DUPLICATE: 200,
+    WEBHOOK_AMOUNT_MISMATCH: 200,       # acknowledged; left for reconciliation
+    WEBHOOK_IGNORED: 200,
+    WEBHOOK_UNKNOWN: 404,
+    WEBHOOK_BAD_SIGNATURE: 401,
+    WEBHOOK_MALFORMED: 400,
+    WEBHOOK_NOT_CONFIGURED: 503,
+}
+
+@api_bp.route('/payments/webhook', methods=['POST'])
+def payment_webhook_api():
+    """
+    Payment outcome callbacks from the gateway, signed in the
+    X-Gateway-Signature header. A repeated delivery of an event is
+    acknowledged without being applied again.
+    """
+    outcome, details = complete_payment_from_webhook(request.get_data(),
+                                                     request.headers.get(WEBHOOK_SIGNATURE_HEADER))
+    return jsonify(dict(details, result=outcome)), WEBHOOK_HTTP_STATUS[outcome]
+
+@api_bp.route('/payments/transactions/<transaction_id>')
+def payment_transaction_api(transaction_id):
+    """Ledger entries for a gateway transaction: submitted until its webhook arrives, then paid or failed."""
+    payments = get_payments_by_transaction(transaction_id)
+    if not payments:
+        return jsonify({'error': 'Transaction not found'}), 404
+    return jsonify({
+        'transaction_id': transaction_id,
+        'status': payments[0]['status'],
+        'amount': round(sum(p['amount'] for p in payments), 2),
+        'payments': payments,
+    })
+
+
+@api_bp.route('/metrics')
+def metrics():
+    """
+    Operational metrics for the running instance.
+    Reports database connection pool usage, the SQLite settings in effect,
+    book and late fee cache counters, the state of the fines ledger, the
+    payment job workers and the HTTP payment gateway circuit breakers.
+    """
+    return jsonify({
+        'db_pool': get_pool_stats(),
+        'sqlite': get_performance_report(),
+        'book_cache': get_book_cache_stats(),
+        'late_fee_cache': get_late_fee_cache_stats(),
+        'fines_ledger': get_fines_ledger_stats(),
+        'payment_jobs': get_payment_job_stats(),
+        'payment_gateway': get_gateway_stats(),
     })
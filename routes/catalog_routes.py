@@ -6,8 +6,8 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from flask import Blueprint, render_template, request, redirect, url_for, flash
-from database import get_all_books
-from services.library_service import add_book_to_catalog
+from database import CATALOG_PAGE_SIZE
+from services.library_service import add_book_to_catalog, get_catalog_page
 
 
 catalog_bp = Blueprint('catalog', __name__)
@@ -20,11 +20,16 @@ def index():
 @catalog_bp.route('/catalog')
 def catalog():
     """
-    Display all books in the catalog.
+    Display the catalog one page at a time.
     Implements R2: Book Catalog Display
     """
-    books = get_all_books()
-    return render_template('catalog.html', books=books)
+    page = get_catalog_page(
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        limit=request.args.get('limit', CATALOG_PAGE_SIZE, type=int),
+    )
+    return render_template('catalog.html', books=page['books'],
+                           next_cursor=page['next_cursor'], prev_cursor=page['prev_cursor'])
 
 @catalog_bp.route('/add_book', methods=['GET', 'POST'])
 def add_book():
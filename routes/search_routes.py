@@ -7,7 +7,8 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from flask import Blueprint, render_template, request, flash
-from services.library_service import search_books_in_catalog
+from services.library_service import search_catalog_page
+from database import SEARCH_LIMIT
 
 
 
@@ -26,9 +27,15 @@ def search_books():
         return render_template('search.html', books=[], search_term='', search_type=search_type)
     
     # Use business logic function
-    books = search_books_in_catalog(search_term, search_type)
+    page = search_catalog_page(search_term, search_type,
+                               request.args.get('limit', SEARCH_LIMIT, type=int),
+                               request.args.get('offset', 0, type=int))
+    books, limit, offset = page['books'], page['limit'], page['offset']
+    next_offset = offset + limit if page['has_more'] else None
+    prev_offset = max(0, offset - limit) if offset > 0 else None
     
     if not books:
         flash('Search functionality is not yet implemented.', 'error')
     
-    return render_template('search.html', books=books, search_term=search_term, search_type=search_type)
+    return render_template('search.html', books=books, search_term=search_term, search_type=search_type,
+                           limit=limit, next_offset=next_offset, prev_offset=prev_offset)
@@ -0,0 +1,68 @@
+"""
+Catalog Export Module - Streaming NDJSON/CSV exports of books and borrow records
+Rows are encoded as they are read, so memory use does not grow with table size
+"""
+
+import csv
+import io
+import json
+from typing import Dict, Iterable, Iterator, Optional, Sequence
+
+from database import iter_all_books, iter_borrow_records
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+BOOK_EXPORT_FIELDS = ('id', 'title', 'author', 'isbn', 'total_copies', 'available_copies')
+BORROW_EXPORT_FIELDS = ('id', 'patron_id', 'book_id', 'title', 'author',
+                        'borrow_date', 'due_date', 'return_date')
+
+# Encoded rows are joined into chunks of roughly this many rows before being yielded
+EXPORT_CHUNK_ROWS = 200
+
+
+def encode_rows(rows: Iterable[Dict], fmt: str, fields: Sequence[str],
+                chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[str]:
+    """
+    Encode dict rows as NDJSON or CSV text, yielding one chunk per `chunk_rows`.
+
+    CSV output starts with a header row of `fields`; NDJSON output has one
+    object per line with the keys in `fields` order.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {fmt}")
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(fields)
+
+    pending = 0
+    for row in rows:
+        if writer is not None:
+            writer.writerow([row.get(f) for f in fields])
+        else:
+            buffer.write(json.dumps({f: row.get(f) for f in fields}))
+            buffer.write('\n')
+        pending += 1
+        if pending >= chunk_rows:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_books(fmt: str = 'ndjson') -> Iterator[str]:
+    """Stream the whole catalog in id order."""
+    return encode_rows(iter_all_books(), fmt, BOOK_EXPORT_FIELDS)
+
+
+def export_borrow_records(fmt: str = 'ndjson', patron_id: Optional[str] = None) -> Iterator[str]:
+    """Stream the borrow history, for every patron or just one."""
+    return encode_rows(iter_borrow_records(patron_id), fmt, BORROW_EXPORT_FIELDS)
@@ -0,0 +1,189 @@
+"""
+Catalog Import Module - Streaming bulk import of books from CSV or JSONL
+Applies the same R1 validation as add_book_to_catalog, in batched transactions
+"""
+
+import csv
+import io
+import json
+import sqlite3
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from database import get_standalone_connection, find_existing_isbns, insert_books_batch
+from services.library_service import validate_book_fields
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_FORMATS = ('csv', 'jsonl')
+IMPORT_FIELDS = ('title', 'author', 'isbn', 'total_copies')
+
+# How many row errors to keep in the returned report (all are sent to error_sink)
+REPORT_ERROR_LIMIT = 100
+
+
+def detect_format(filename: str) -> str:
+    """Guess the import format from a file name (defaults to CSV)."""
+    return 'jsonl' if filename.lower().endswith(('.jsonl', '.ndjson', '.json')) else 'csv'
+
+
+def iter_records(stream: TextIO, fmt: str) -> Iterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """
+    Read records one at a time from a text stream.
+
+    Yields:
+        tuple: (line_number, record, error) where record is None and error
+        explains why if the line could not be parsed
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        missing = [f for f in IMPORT_FIELDS if f not in (reader.fieldnames or [])]
+        if missing:
+            yield 1, None, f"Missing CSV column(s): {', '.join(missing)}."
+            return
+        for record in reader:
+            yield reader.line_num, record, None
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(record, dict):
+                yield line_number, None, "Each line must be a JSON object."
+                continue
+            yield line_number, record, None
+    else:
+        raise ValueError(f"Unsupported import format: {fmt}")
+
+
+def parse_record(record: Dict) -> Tuple[Optional[Tuple[str, str, str, int]], Optional[str]]:
+    """
+    Normalize and validate one record with the R1 rules.
+
+    Returns:
+        tuple: ((title, author, isbn, total_copies), None) or (None, error message)
+    """
+    title = str(record.get('title') or '')
+    author = str(record.get('author') or '')
+    isbn = str(record.get('isbn') or '').strip()
+    copies = record.get('total_copies')
+    if isinstance(copies, str) and copies.strip().lstrip('-').isdigit():
+        copies = int(copies.strip())
+    if isinstance(copies, bool):
+        copies = None
+
+    error = validate_book_fields(title, author, isbn, copies)
+    if error:
+        return None, error
+    return (title.strip(), author.strip(), isbn, copies), None
+
+
+def _batches(items: Iterable, size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_books(stream: TextIO, fmt: str = 'csv', batch_size: int = IMPORT_BATCH_SIZE,
+                 error_sink=None) -> Dict:
+    """
+    Stream books from `stream` into the catalog.
+
+    Rows are validated like add_book_to_catalog, checked for duplicate ISBNs
+    against the database (one query per batch) and within the file, then
+    inserted with executemany, one transaction per batch. Memory use is
+    bounded by the batch size, not the file size.
+
+    Args:
+        stream: text stream of CSV (with a header row) or JSON lines
+        fmt: 'csv' or 'jsonl'
+        batch_size: rows per transaction
+        error_sink: optional callable(line_number, record, message) called for
+            every rejected row, e.g. to write an error file
+
+    Returns:
+        dict: processed/inserted/rejected counts, batches, elapsed seconds,
+        rows per second and the first REPORT_ERROR_LIMIT errors
+    """
+    if fmt not in IMPORT_FORMATS:
+        raise ValueError(f"Unsupported import format: {fmt}")
+
+    report = {
+        'processed': 0,
+        'inserted': 0,
+        'rejected': 0,
+        'batches': 0,
+        'errors': [],
+    }
+    seen_isbns = set()
+
+    def reject(line_number, record, message):
+        report['rejected'] += 1
+        if len(report['errors']) < REPORT_ERROR_LIMIT:
+            report['errors'].append({'line': line_number, 'isbn': (record or {}).get('isbn'), 'error': message})
+        if error_sink is not None:
+            error_sink(line_number, record, message)
+
+    started = time.perf_counter()
+    conn = get_standalone_connection()
+    try:
+        for batch in _batches(iter_records(stream, fmt), batch_size):
+            valid = []
+            for line_number, record, error in batch:
+                report['processed'] += 1
+                if error:
+                    reject(line_number, record, error)
+                    continue
+                book, error = parse_record(record)
+                if error:
+                    reject(line_number, record, error)
+                elif book[2] in seen_isbns:
+                    reject(line_number, record, "Duplicate ISBN within the import file.")
+                else:
+                    seen_isbns.add(book[2])
+                    valid.append((line_number, record, book))
+            report['inserted'] += _insert_batch(conn, valid, reject)
+            report['batches'] += 1
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - started
+    report['elapsed_seconds'] = round(elapsed, 3)
+    report['rows_per_second'] = round(report['processed'] / elapsed, 1) if elapsed else 0.0
+    return report
+
+
+def _insert_batch(conn, rows: List[Tuple[int, Dict, Tuple]], reject) -> int:
+    """Insert one validated batch, rejecting ISBNs that already exist."""
+    for _attempt in range(3):
+        if not rows:
+            return 0
+        existing = find_existing_isbns(conn, [book[2] for _, _, book in rows])
+        fresh = []
+        for line_number, record, book in rows:
+            if book[2] in existing:
+                reject(line_number, record, "A book with this ISBN already exists.")
+            else:
+                fresh.append((line_number, record, book))
+        rows = fresh
+        try:
+            return insert_books_batch(conn, [(t, a, i, c, c) for _, _, (t, a, i, c) in rows])
+        except sqlite3.IntegrityError:
+            # Another writer added one of these ISBNs after our check; re-check and retry
+            continue
+    for line_number, record, _ in rows:
+        reject(line_number, record, "Database error occurred while adding the book.")
+    return 0
+
+
+def open_text(binary_stream, encoding: str = 'utf-8') -> TextIO:
+    """Wrap a binary upload stream for import_books without reading it all."""
+    return io.TextIOWrapper(binary_stream, encoding=encoding, newline='')
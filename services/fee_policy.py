@@ -0,0 +1,46 @@
+"""
+Fee Policy Module - Late fee rules (R5)
+Pure functions with no database or Flask dependencies, shared by the service
+layer and the late_fee() SQL function registered on every connection
+"""
+
+from typing import Optional
+
+# Late fee policy (R5)
+LATE_FEE_FIRST_7 = 0.25
+LATE_FEE_AFTER_7 = 0.50
+LATE_FEE_CAP = 15.00
+
+
+def late_fee_for_days(days_overdue: Optional[int]) -> float:
+    """
+    Late fee for a number of whole days overdue.
+    First 7 days at 0.25/day, subsequent days at 0.50/day, capped at 15.00.
+    None (unknown dates) and non-positive values cost nothing.
+    """
+    if days_overdue is None or days_overdue <= 0:
+        return 0.0
+    first_seg = min(7, days_overdue)
+    second_seg = max(0, days_overdue - 7)
+    fee = first_seg * LATE_FEE_FIRST_7 + second_seg * LATE_FEE_AFTER_7
+    return round(min(fee, LATE_FEE_CAP), 2)
+
+
+def _days_to_cap() -> int:
+    days = 1
+    while late_fee_for_days(days) < LATE_FEE_CAP:
+        days += 1
+    return days
+
+
+# First day overdue on which the fee reaches the cap; it never changes after that
+LATE_FEE_CAP_DAYS = _days_to_cap()
+
+
+def fee_status(days_overdue: int, fee_amount: float, amount_paid: float = 0.0) -> str:
+    """Human-readable status used by the late fee API; fee_amount is what is still owed."""
+    if days_overdue <= 0:
+        return "On time"
+    if amount_paid > 0 and fee_amount <= 0:
+        return "Overdue (paid)"
+    return "Overdue (capped)" if fee_amount + amount_paid >= LATE_FEE_CAP else "Overdue"
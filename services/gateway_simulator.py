@@ -0,0 +1,183 @@
+"""
+Gateway Simulator Module - Latency, errors and capacity for the simulated gateway
+PaymentGateway (without a gateway URL) asks a GatewaySimulator how long each
+call takes and whether it fails. Latency can be fixed, lognormal or spiky,
+per operation; errors and declines happen at configurable rates; and a
+throughput cap makes callers queue the way a saturated provider would.
+
+Profiles (PAYMENT_SIMULATOR environment variable, default 'classic'):
+    classic    0.5 s charges and refunds, 0.3 s status checks, no errors
+    instant    no latency, for tests
+    realistic  lognormal latency with occasional multi-second spikes,
+               a 1% error rate and a 50 calls/s cap
+"""
+
+import math
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+class FixedLatency:
+    """Every call takes the same time."""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def sample(self, rng: random.Random) -> float:
+        return self.seconds
+
+
+class LognormalLatency:
+    """
+    Right-skewed latency around a median, like most network services.
+
+    `sigma` sets the tail: at 0.5 the 99th percentile is about 3.2x the
+    median. Samples are capped at `max_seconds` when given (a client timeout).
+    """
+
+    def __init__(self, median: float, sigma: float = 0.5, max_seconds: Optional[float] = None):
+        self.median = median
+        self.sigma = sigma
+        self.max_seconds = max_seconds
+
+    def sample(self, rng: random.Random) -> float:
+        seconds = rng.lognormvariate(math.log(self.median), self.sigma) if self.median > 0 else 0.0
+        return min(seconds, self.max_seconds) if self.max_seconds is not None else seconds
+
+
+class SpikyLatency:
+    """Another latency model plus, with `probability`, a spike of `spike` extra seconds."""
+
+    def __init__(self, base, probability: float = 0.01, spike: float = 2.0):
+        self.base = base
+        self.probability = probability
+        self.spike = spike
+
+    def sample(self, rng: random.Random) -> float:
+        seconds = self.base.sample(rng)
+        if rng.random() < self.probability:
+            seconds += self.spike
+        return seconds
+
+
+NO_LATENCY = FixedLatency(0.0)
+
+
+class SimulatedGatewayError(ConnectionError):
+    """A failure injected by the simulator (stands in for a timeout or reset)."""
+
+
+class GatewaySimulator:
+    """
+    Decides the latency and outcome of simulated gateway calls.
+
+    Args:
+        latency: model for every operation not in `operation_latency`
+        operation_latency: models by operation name (process_payment,
+            refund_payment, verify_payment_status)
+        error_rate: share of calls that raise SimulatedGatewayError
+        decline_rate: share of valid charges the issuer declines
+        max_per_second: most calls started per second; callers beyond it wait
+        seed: makes latency, errors and declines repeatable
+    """
+
+    def __init__(self, latency=NO_LATENCY, operation_latency: Optional[Dict] = None,
+                 error_rate: float = 0.0, decline_rate: float = 0.0,
+                 max_per_second: Optional[float] = None, seed: Optional[int] = None,
+                 sleep: Callable[[float], None] = time.sleep,
+                 clock: Callable[[], float] = time.monotonic):
+        self.latency = latency
+        self.operation_latency = dict(operation_latency or {})
+        self.error_rate = error_rate
+        self.decline_rate = decline_rate
+        self.max_per_second = max_per_second
+        self._rng = random.Random(seed)
+        self._sleep = sleep
+        self._clock = clock
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+        self._counters = {'calls': 0, 'errors': 0, 'declines': 0,
+                          'latency_seconds': 0.0, 'throttled_seconds': 0.0}
+
+    def delay(self, operation: str):
+        """
+        Spend the time one call takes, then fail it if the dice say so.
+
+        Raises:
+            SimulatedGatewayError: for an injected error
+        """
+        model = self.operation_latency.get(operation, self.latency)
+        with self._lock:
+            seconds = model.sample(self._rng)
+            fail = self.error_rate > 0 and self._rng.random() < self.error_rate
+            wait = 0.0
+            if self.max_per_second:
+                now = self._clock()
+                slot = max(now, self._next_slot)
+                self._next_slot = slot + 1.0 / self.max_per_second
+                wait = slot - now
+            self._counters['calls'] += 1
+            self._counters['latency_seconds'] += seconds
+            self._counters['throttled_seconds'] += wait
+            if fail:
+                self._counters['errors'] += 1
+        if wait + seconds > 0:
+            self._sleep(wait + seconds)
+        if fail:
+            raise SimulatedGatewayError(f"Simulated gateway error during {operation}")
+
+    def declined(self) -> bool:
+        """Whether the issuer declines this charge."""
+        if self.decline_rate <= 0:
+            return False
+        with self._lock:
+            declined = self._rng.random() < self.decline_rate
+            if declined:
+                self._counters['declines'] += 1
+        return declined
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counters)
+        stats['latency_seconds'] = round(stats['latency_seconds'], 3)
+        stats['throttled_seconds'] = round(stats['throttled_seconds'], 3)
+        return stats
+
+
+SIMULATOR_PROFILES = ('classic', 'instant', 'realistic')
+
+
+def make_simulator(profile: str = 'classic', seed: Optional[int] = None) -> GatewaySimulator:
+    """A simulator for one of the named profiles (see the module docstring)."""
+    if profile == 'classic':
+        return GatewaySimulator(operation_latency={
+            'process_payment': FixedLatency(0.5),
+            'refund_payment': FixedLatency(0.5),
+            'verify_payment_status': FixedLatency(0.3),
+        }, seed=seed)
+    if profile == 'instant':
+        return GatewaySimulator(seed=seed)
+    if profile == 'realistic':
+        return GatewaySimulator(
+            latency=SpikyLatency(LognormalLatency(0.25, 0.6), probability=0.01, spike=3.0),
+            operation_latency={'verify_payment_status': LognormalLatency(0.12, 0.5)},
+            error_rate=0.01, decline_rate=0.02, max_per_second=50, seed=seed)
+    raise ValueError(f"Unknown gateway simulator profile: {profile}")
+
+
+_default: Optional[GatewaySimulator] = None
+
+def get_default_simulator() -> GatewaySimulator:
+    """The simulator used by PaymentGateway unless given one (PAYMENT_SIMULATOR profile)."""
+    global _default
+    if _default is None:
+        _default = make_simulator(os.environ.get('PAYMENT_SIMULATOR', 'classic'))
+    return _default
+
+def set_default_simulator(simulator: Optional[GatewaySimulator]):
+    """Replace the default simulator; None goes back to the PAYMENT_SIMULATOR profile."""
+    global _default
+    _default = simulator
@@ -0,0 +1,288 @@
+"""
+Gateway Stub Module - A local stand-in for the HTTP payment gateway
+Serves the charge, refund and status endpoints that PaymentGateway calls in
+HTTP mode, using the same rules as the simulated gateway. Latency and
+failures can be injected to exercise timeouts, retries and the circuit
+breaker without a real payment provider. Charges submitted with a callback
+URL are completed asynchronously by a signed webhook, as a real provider
+would.
+"""
+
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+import requests
+
+from services.payment_service import WEBHOOK_SIGNATURE_HEADER, get_webhook_secret, sign_webhook
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'     # keep connections alive between requests
+
+    def setup(self):
+        super().setup()
+        self.server.stub._count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            body = None
+        self._respond(*self.server.stub.handle('POST', self.path, body, self.headers))
+
+    def do_GET(self):
+        self._respond(*self.server.stub.handle('GET', self.path, None, self.headers))
+
+    def _respond(self, status: int, body: Dict, stall: float = 0.0):
+        if stall:
+            time.sleep(stall)
+        payload = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        except OSError:
+            self.close_connection = True   # the client gave up waiting
+
+
+class StubGatewayServer:
+    """
+    Threaded HTTP server implementing the gateway API on localhost.
+
+    Endpoints: POST /charges, POST /refunds and GET /charges/<id>. A POST
+    repeated with the same Idempotency-Key returns the first response
+    without charging again.
+
+    A charge with a callback_url is answered 202 with a pending charge
+    (or 400 if the stub has no webhook secret to sign callbacks with).
+    After `callback_delay` seconds a charge.succeeded (or charge.failed)
+    event signed with `webhook_secret` is posted to the callback URL, plus
+    `duplicate_callbacks` redeliveries of the same event. Deliveries that
+    fail or get a non-2xx reply are retried up to `callback_attempts` times.
+
+    Fault injection:
+        latency      seconds to wait before handling every request
+        fail_next()  answer the next requests with an error status
+        stall_next() handle the next requests, then wait before replying
+                     (a lost response, as seen by a client that times out)
+        decline_next_callbacks()  complete the next async charges as failed
+
+    Usage:
+        with StubGatewayServer() as stub:
+            gateway = PaymentGateway(base_url=stub.url)
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 webhook_secret: Optional[str] = None, callback_delay: float = 0.0,
+                 duplicate_callbacks: int = 0, callback_attempts: int = 3):
+        self.latency = latency
+        self.webhook_secret = webhook_secret or get_webhook_secret()    # None: no webhooks
+        self.callback_delay = callback_delay
+        self.duplicate_callbacks = duplicate_callbacks
+        self.callback_attempts = callback_attempts
+        self.callbacks = []      # (event_id, reply status or error) per delivery attempt
+        self._callback_threads = []
+        self._callback_declines = 0
+        self._event_numbers = itertools.count(1)
+        self.charges: Dict[str, Dict] = {}
+        self.refunds: Dict[str, Dict] = {}
+        self.requests = []       # (method, path, headers) in arrival order
+        self._responses: Dict[str, Tuple[int, Dict]] = {}    # idempotency key -> first response
+        self._failures = []      # queued status codes to answer with
+        self._stalls = []        # queued reply delays
+        self._counters = {'connections': 0, 'requests': 0, 'replayed': 0, 'callbacks': 0}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _StubHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'StubGatewayServer':
+        self._thread = threading.Thread(target=self._httpd.serve_forever, args=(0.05,), name='gateway-stub',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.wait_for_callbacks()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> 'StubGatewayServer':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, count: int = 1, status: int = 503):
+        """Answer the next `count` requests with `status` without handling them."""
+        with self._lock:
+            self._failures.extend([status] * count)
+
+    def stall_next(self, count: int = 1, seconds: float = 1.0):
+        """Handle the next `count` requests but wait `seconds` before replying."""
+        with self._lock:
+            self._stalls.extend([seconds] * count)
+
+    def decline_next_callbacks(self, count: int = 1):
+        """Complete the next `count` async charges with a charge.failed event."""
+        with self._lock:
+            self._callback_declines += count
+
+    def wait_for_callbacks(self, timeout: float = 5.0) -> bool:
+        """Wait for pending webhook deliveries; False if some are still running."""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            threads = list(self._callback_threads)
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in threads)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counters)
+        stats['charges'] = len(self.charges)
+        stats['refunds'] = len(self.refunds)
+        return stats
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def handle(self, method: str, path: str, body: Optional[Dict], headers) -> Tuple[int, Dict, float]:
+        """Work out the (status, body, stall) reply for one request."""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self._counters['requests'] += 1
+            self.requests.append((method, path, dict(headers)))
+            if self._failures:
+                return self._failures.pop(0), {"error": "Gateway unavailable"}, 0.0
+            stall = self._stalls.pop(0) if self._stalls else 0.0
+
+            if not headers.get('Authorization', '').startswith('Bearer '):
+                return 401, {"error": "Missing API key"}, stall
+            if method == 'GET' and path.startswith('/charges/'):
+                charge = self.charges.get(path[len('/charges/'):])
+                if charge is None:
+                    return 404, {"error": "Transaction not found"}, stall
+                return 200, charge, stall
+            if method != 'POST' or path not in ('/charges', '/refunds'):
+                return 404, {"error": "Not found"}, stall
+            if not isinstance(body, dict):
+                return 400, {"error": "Invalid JSON body"}, stall
+
+            key = headers.get('Idempotency-Key')
+            if key and key in self._responses:
+                self._counters['replayed'] += 1
+                status, reply = self._responses[key]
+                return status, reply, stall
+            if path == '/charges':
+                status, reply = self._charge(body)
+            else:
+                status, reply = self._refund(body)
+            if key:
+                self._responses[key] = (status, reply)
+            return status, reply, stall
+
+    def _charge(self, body: Dict) -> Tuple[int, Dict]:
+        amount = body.get('amount')
+        patron_id = str(body.get('customer_id', ''))
+        if not isinstance(amount, (int, float)) or amount <= 0:
+            return 400, {"error": "Invalid amount: must be greater than 0"}
+        if amount > 1000:
+            return 402, {"error": "Payment declined: amount exceeds limit"}
+        if len(patron_id) != 6:
+            return 400, {"error": "Invalid patron ID format"}
+        if body.get('callback_url') and not self.webhook_secret:
+            return 400, {"error": "Webhooks are not configured: no webhook secret"}
+        transaction_id = f"txn_{patron_id}_{len(self.charges) + 1}"
+        charge = {
+            "id": transaction_id,
+            "transaction_id": transaction_id,
+            "status": "completed",
+            "amount": amount,
+            "description": body.get('description', ''),
+            "timestamp": time.time(),
+            "message": f"Payment of ${amount:.2f} processed successfully",
+        }
+        self.charges[transaction_id] = charge
+        callback_url = body.get('callback_url')
+        if not callback_url:
+            return 201, charge
+        charge.update(status="pending", reference=body.get('reference', ''),
+                      message="Payment accepted; the outcome will be posted to the callback URL")
+        declined = self._callback_declines > 0
+        if declined:
+            self._callback_declines -= 1
+        thread = threading.Thread(target=self._complete, args=(charge, callback_url, declined),
+                                  name='gateway-stub-callback', daemon=True)
+        self._callback_threads.append(thread)
+        thread.start()
+        return 202, dict(charge)
+
+    def _complete(self, charge: Dict, callback_url: str, declined: bool):
+        """Settle an async charge after callback_delay and post its webhook."""
+        if self.callback_delay:
+            time.sleep(self.callback_delay)
+        with self._lock:
+            if declined:
+                charge.update(status="failed", message="Payment declined by card issuer")
+            else:
+                charge.update(status="completed",
+                              message=f"Payment of ${charge['amount']:.2f} processed successfully")
+            event = {
+                "id": f"evt_{next(self._event_numbers)}",
+                "type": "charge.failed" if declined else "charge.succeeded",
+                "created": int(time.time()),
+                "data": {key: charge[key] for key in
+                         ("transaction_id", "reference", "amount", "status", "message")},
+            }
+        payload = json.dumps(event).encode()
+        for _ in range(1 + self.duplicate_callbacks):
+            self._post_callback(callback_url, event["id"], payload)
+
+    def _post_callback(self, callback_url: str, event_id: str, payload: bytes):
+        for attempt in range(self.callback_attempts):
+            if attempt:
+                time.sleep(0.05 * 2 ** attempt)
+            headers = {'Content-Type': 'application/json',
+                       WEBHOOK_SIGNATURE_HEADER: sign_webhook(payload, self.webhook_secret)}
+            try:
+                status = requests.post(callback_url, data=payload, headers=headers, timeout=5).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            with self._lock:
+                self._counters['callbacks'] += 1
+                self.callbacks.append((event_id, status))
+            if isinstance(status, int) and status < 300:
+                return
+
+    def _refund(self, body: Dict) -> Tuple[int, Dict]:
+        transaction_id = str(body.get('transaction_id', ''))
+        amount = body.get('amount')
+        if transaction_id not in self.charges:
+            return 404, {"error": "Invalid transaction ID"}
+        if not isinstance(amount, (int, float)) or amount <= 0:
+            return 400, {"error": "Invalid refund amount"}
+        refund_id = f"refund_{transaction_id}_{len(self.refunds) + 1}"
+        self.refunds[refund_id] = {"id": refund_id, "transaction_id": transaction_id, "amount": amount}
+        return 201, {"id": refund_id,
+                     "message": f"Refund of ${amount:.2f} processed successfully. Refund ID: {refund_id}"}
@@ -3,52 +3,117 @@ Library Service Module - Business Logic Functions
 Contains all the core business logic for the Library Management System
 """
 
+import base64
+import hashlib
+import json
+import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
+import database
+from cache import LRUCache
 from database import (
-    get_book_by_id, get_book_by_isbn, get_patron_borrow_count,
-    insert_book, insert_borrow_record, update_book_availability,
-    update_borrow_record_return_date, get_all_books, get_patron_borrowed_books, get_db_connection
+    get_book_by_id, get_book_by_isbn,
+    insert_book, borrow_book_atomic, return_book_atomic,
+    search_books, get_books_page, get_db_connection, release_db_connection, today_epoch_day,
+    fines_ledger_is_current, LOAN_FEE_SQL, PATRON_FEES_SQL, PATRON_FEE_TOTALS_SQL,
+    LEDGER_LOAN_FEE_SQL, LEDGER_PATRON_FEES_SQL, LEDGER_PATRON_FEE_TOTALS_SQL, BORROW_LIMIT, LOAN_PERIOD_DAYS,
+    LOAN_FEES_BATCH_SQL, LEDGER_LOAN_FEES_BATCH_SQL, LATE_FEE_BATCH_LIMIT,
+    PATRON_FEES_AFTER_SQL, LEDGER_PATRON_FEES_AFTER_SQL, PATRON_HISTORY_MAX_PAGE_SIZE,
+    BORROW_OK, BORROW_NOT_FOUND, BORROW_UNAVAILABLE, BORROW_LIMIT_REACHED,
+    RETURN_OK, RETURN_NOT_FOUND, RETURN_NO_LOAN, SEARCH_LIMIT, SEARCH_MAX_LIMIT,
+    CATALOG_PAGE_SIZE, CATALOG_MAX_PAGE_SIZE,
+    begin_payment, settle_payment, get_payment, PAYMENT_PAID, PAYMENT_FAILED,
+    PATRON_OUTSTANDING_FEES_SQL, LEDGER_PATRON_OUTSTANDING_FEES_SQL,
+    begin_payment_allocations, settle_payment_allocations, gateway_idempotency_key,
+    mark_payment_submitted, apply_payment_event, WEBHOOK_UNKNOWN, ChangeFeed
 )
 
-from services.payment_service import PaymentGateway 
+from services.payment_service import PaymentGateway, get_webhook_secret, verify_webhook_signature
 
-def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -> Tuple[bool, str]:
+from services.fee_policy import late_fee_for_days, fee_status
+
+# Late fee responses change only at midnight or when the loan changes, so
+# they are cached until the next local midnight (wall clock) and dropped on
+# borrow, return and payment. Keys include the database file in use. Loans
+# changed by other processes are read from the loan_changes log at most
+# every LATE_FEE_CACHE_VERSION_CHECK seconds.
+LATE_FEE_CACHE_SIZE = 10000
+LATE_FEE_CACHE_VERSION_CHECK = 1.0
+late_fee_cache = LRUCache(LATE_FEE_CACHE_SIZE, clock=time.time)
+_loan_changes = ChangeFeed('loan_changes', ('patron_id', 'book_id'))
+
+def _next_midnight(now: datetime) -> float:
+    """Timestamp of the local midnight following `now`."""
+    return datetime.combine(now.date() + timedelta(days=1), datetime.min.time()).timestamp()
+
+def _late_fee_cache_key(patron_id: str, book_id: int) -> tuple:
+    return (database.DATABASE, patron_id, book_id)
+
+def _sync_late_fee_cache():
+    """Drop entries for loans other processes changed (everything if the log can't tell)."""
+    if not _loan_changes.due(LATE_FEE_CACHE_VERSION_CHECK):
+        return
+    conn = get_db_connection()
+    try:
+        changes = _loan_changes.poll(conn)
+    finally:
+        conn.close()
+    if changes is None:
+        late_fee_cache.clear()
+        return
+    for patron_id, book_id in changes:
+        late_fee_cache.invalidate(_late_fee_cache_key(patron_id, book_id))
+
+def validate_book_fields(title: str, author: str, isbn: str, total_copies: int) -> Optional[str]:
     """
-    Add a new book to the catalog.
-    Implements R1: Book Catalog Management
+    Validate the fields of a new catalog entry (R1).
     
-    Args:
-        title: Book title (max 200 chars)
-        author: Book author (max 100 chars)
-        isbn: 13-digit ISBN (must be all digits)
-        total_copies: Number of copies (positive integer)
-        
     Returns:
-        tuple: (success: bool, message: str)
+        str: the first validation error message, or None if the fields are valid
     """
-    # Input validation
     if not title or not title.strip():
-        return False, "Title is required."
+        return "Title is required."
     
     if len(title.strip()) > 200:
-        return False, "Title must be less than 200 characters."
+        return "Title must be less than 200 characters."
     
     if not author or not author.strip():
-        return False, "Author is required."
+        return "Author is required."
     
     if len(author.strip()) > 100:
-        return False, "Author must be less than 100 characters."
+        return "Author must be less than 100 characters."
     
     # Fixed ISBN validation: must be exactly 13 digits (no letters allowed)
     if not isbn or len(isbn) != 13:
-        return False, "ISBN must be exactly 13 digits."
+        return "ISBN must be exactly 13 digits."
     
     if not isbn.isdigit():
-        return False, "ISBN must contain only digits."
+        return "ISBN must contain only digits."
     
     if not isinstance(total_copies, int) or total_copies <= 0:
-        return False, "Total copies must be a positive integer."
+        return "Total copies must be a positive integer."
+    
+    return None
+
+
+def add_book_to_catalog(title: str, author: str, isbn: str, total_copies: int) -> Tuple[bool, str]:
+    """
+    Add a new book to the catalog.
+    Implements R1: Book Catalog Management
+    
+    Args:
+        title: Book title (max 200 chars)
+        author: Book author (max 100 chars)
+        isbn: 13-digit ISBN (must be all digits)
+        total_copies: Number of copies (positive integer)
+        
+    Returns:
+        tuple: (success: bool, message: str)
+    """
+    # Input validation
+    error = validate_book_fields(title, author, isbn, total_copies)
+    if error:
+        return False, error
     
     # Check for duplicate ISBN
     existing = get_book_by_isbn(isbn)
@@ -79,260 +144,450 @@ def borrow_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return False, "Invalid patron ID. Must be exactly 6 digits."
     
-    # Check if book exists and is available
-    book = get_book_by_id(book_id)
-    if not book:
-        return False, "Book not found."
+    borrow_date = datetime.now()
+    due_date = borrow_date + timedelta(days=LOAN_PERIOD_DAYS)
     
-    if book['available_copies'] <= 0:
-        return False, "This book is currently not available."
+    # Availability check, limit check, record insert and copy decrement all
+    # happen in one transaction
+    outcome, book = borrow_book_atomic(patron_id, book_id, borrow_date, due_date)
     
-    # Check patron's current borrowed books count
-    current_borrowed = get_patron_borrow_count(patron_id)
+    if outcome == BORROW_NOT_FOUND:
+        return False, "Book not found."
     
-    if current_borrowed > 5:
-        return False, "You have reached the maximum borrowing limit of 5 books."
+    if outcome == BORROW_UNAVAILABLE:
+        return False, "This book is currently not available."
     
-    # Create borrow record
-    borrow_date = datetime.now()
-    due_date = borrow_date + timedelta(days=14)
+    if outcome == BORROW_LIMIT_REACHED:
+        return False, f"You have reached the maximum borrowing limit of {BORROW_LIMIT} books."
     
-    # Insert borrow record and update availability
-    borrow_success = insert_borrow_record(patron_id, book_id, borrow_date, due_date)
-    if not borrow_success:
+    if outcome != BORROW_OK:
         return False, "Database error occurred while creating borrow record."
     
-    availability_success = update_book_availability(book_id, -1)
-    if not availability_success:
-        return False, "Database error occurred while updating book availability."
-    
+    late_fee_cache.invalidate(_late_fee_cache_key(patron_id, book_id))
     return True, f'Successfully borrowed "{book["title"]}". Due date: {due_date.strftime("%Y-%m-%d")}.'
 
 def return_book_by_patron(patron_id: str, book_id: int) -> Tuple[bool, str]:
     """
     Process book return by a patron (R4).
     - Only allow if the patron currently has an active borrow for this book.
-    - Mark return_date and increment available_copies.
+    - Mark return_date and increment available_copies in one transaction.
+    - Report any late fee still owed for the returned book, net of payments.
     """
     # Basic validation consistent with borrowing rules
     if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
         return False, "Invalid patron ID. Must be exactly 6 digits."
-    book = get_book_by_id(book_id)
-    if not book:
+
+    now_dt = datetime.now()
+    outcome, book, loan = return_book_atomic(patron_id, book_id, now_dt)
+
+    if outcome == RETURN_NOT_FOUND:
         return False, "Book not found."
 
-    # Check for an active borrow for this patron/book
-    # Note: get_patron_borrowed_books returns only active (return_date IS NULL) records
-    from database import get_patron_borrowed_books  # local import to avoid changing global imports
-    active = get_patron_borrowed_books(patron_id)
-    has_active = any(int(r.get("book_id")) == int(book_id) for r in active)
-    if not has_active:
+    if outcome == RETURN_NO_LOAN:
         return False, "No active borrow record for this patron and book."
 
-    # Update the borrow record and the inventory
-    now_dt = datetime.now()
-    if not update_borrow_record_return_date(patron_id, book_id, now_dt):
-        return False, "Failed to mark the borrow record as returned."
-    if not update_book_availability(book_id, +1):
-        return False, "Book return marked, but failed to update available copies."
+    if outcome != RETURN_OK:
+        return False, "Database error occurred while processing the return."
 
-    return True, f'Book "{book["title"]}" returned successfully.'
+    late_fee_cache.invalidate(_late_fee_cache_key(patron_id, book_id))
+    message = f'Book "{book["title"]}" returned successfully.'
+    days = max(0, loan['return_day'] - loan['due_day']) if loan['due_day'] is not None else 0
+    fee = late_fee_for_days(days)
+    owed = round(max(0.0, fee - loan['amount_paid']), 2)
+    if owed > 0:
+        message += f' Late fee owed: ${owed:.2f} ({days} days overdue).'
+    elif fee > 0:
+        message += f' Late fee of ${fee:.2f} already paid ({days} days overdue).'
+    return True, message
 
 
-def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
-    """
-    Calculate late fees for a specific book (R5).
-    - Two-tier daily rates with cap: first 7 days at 0.25/day, subsequent at 0.50/day, capped at 15.00.
-    - If the item is still borrowed (no return), compute against today.
-    """
-    LATE_FEE_FIRST_7 = 0.25
-    LATE_FEE_AFTER_7 = 0.50
-    LATE_FEE_CAP = 15.00
-
+def _late_fee_result(row) -> Dict:
+    """Late fee API result for a LOAN_FEE_SQL row (None if there is no loan)."""
     result = {
         'fee_amount': 0.00,
         'days_overdue': 0,
-        'status': 'ok'
+        'status': 'ok',
+        'amount_paid': 0.00,
+        'loan_id': None
     }
 
-    # First try active borrow for this patron/book
-    from database import get_patron_borrowed_books, get_db_connection  # local imports
-    active = get_patron_borrowed_books(patron_id)
-    rec = next((r for r in active if int(r.get("book_id")) == int(book_id)), None)
-
-    def compute_fee(due_dt: datetime, ret_dt: Optional[datetime]) -> Tuple[int, float]:
-        effective_return = ret_dt or datetime.now()
-        days_overdue = (effective_return.date() - due_dt.date()).days
-        if days_overdue <= 0:
-            return 0, 0.0
-        first_seg = min(7, days_overdue)
-        second_seg = max(0, days_overdue - 7)
-        fee = first_seg * LATE_FEE_FIRST_7 + second_seg * LATE_FEE_AFTER_7
-        return days_overdue, round(min(fee, LATE_FEE_CAP), 2)
-
-    if rec:
-        due_dt = rec.get("due_date")
-        if not isinstance(due_dt, datetime):
-            result['status'] = 'Invalid due date format on active record.'
-            return result
-        days, fee = compute_fee(due_dt, None)
-        result['days_overdue'] = days
-        result['fee_amount'] = fee
-        result['status'] = "On time" if days <= 0 else ("Overdue (capped)" if fee >= LATE_FEE_CAP else "Overdue")
+    if not row:
+        result['status'] = 'No borrow record found.'
+        return result
+
+    result['loan_id'] = row['id']
+    if row['days_overdue'] is None:
+        result['status'] = 'Invalid date format in borrow record.'
         return result
 
-    # Otherwise, look up the latest borrow record (returned or not) for this patron/book
+    result['days_overdue'] = row['days_overdue']
+    result['fee_amount'] = row['fee_amount']
+    result['amount_paid'] = row['amount_paid']
+    result['status'] = fee_status(row['days_overdue'], row['fee_amount'], row['amount_paid'])
+    return result
+
+def calculate_late_fee_for_book(patron_id: str, book_id: int) -> Dict:
+    """
+    Calculate late fees for a specific book (R5).
+    - Two-tier daily rates with cap: first 7 days at 0.25/day, subsequent at 0.50/day, capped at 15.00.
+    - If the item is still borrowed (no return), compute against today.
+    - Uses the oldest active borrow of the book, else the latest returned one.
+    The fee is read from the fines ledger when today's fines job has run,
+    otherwise computed inside SQLite by the late_fee() SQL function.
+    """
+    today = today_epoch_day()
     conn = get_db_connection()
     try:
-        row = conn.execute(
-            """
-            SELECT borrow_date, due_date, return_date
-            FROM borrow_records
-            WHERE patron_id = ? AND book_id = ?
-            ORDER BY id DESC
-            LIMIT 1
-            """,
-            (patron_id, book_id),
-        ).fetchone()
+        sql = LEDGER_LOAN_FEE_SQL if fines_ledger_is_current(conn, today) else LOAN_FEE_SQL
+        row = conn.execute(sql, {
+            'patron_id': patron_id,
+            'book_id': book_id,
+            'today': today,
+        }).fetchone()
     finally:
         conn.close()
 
-    if not row:
-        result['status'] = 'No borrow record found.'
-        return result
+    return _late_fee_result(row)
+
+def calculate_late_fees_for_books(pairs: List[Tuple[str, int]]) -> List[Dict]:
+    """
+    calculate_late_fee_for_book() for many (patron_id, book_id) pairs.
+    All pairs are resolved by one set-based query; results come back in the
+    order of `pairs`, each with its patron_id and book_id.
+    """
+    if len(pairs) > LATE_FEE_BATCH_LIMIT:
+        raise ValueError(f"At most {LATE_FEE_BATCH_LIMIT} loans per request")
+    rows = {}
+    if pairs:
+        today = today_epoch_day()
+        conn = get_db_connection()
+        try:
+            sql = LEDGER_LOAN_FEES_BATCH_SQL if fines_ledger_is_current(conn, today) else LOAN_FEES_BATCH_SQL
+            params = {'pairs': json.dumps([[patron_id, book_id] for patron_id, book_id in pairs]), 'today': today}
+            rows = {row['position']: row for row in conn.execute(sql, params)}
+        finally:
+            conn.close()
+
+    results = []
+    for position, (patron_id, book_id) in enumerate(pairs):
+        result = {'patron_id': patron_id, 'book_id': book_id}
+        result.update(_late_fee_result(rows.get(position)))
+        results.append(result)
+    return results
+
+def get_cached_late_fee(patron_id: str, book_id: int) -> Dict:
+    """
+    calculate_late_fee_for_book() for the late fee API, served from
+    late_fee_cache until the next local midnight or until the loan changes
+    (in this process or, via the loan_changes log, in another one).
+    """
+    _sync_late_fee_cache()
+    key = _late_fee_cache_key(patron_id, book_id)
+    result = late_fee_cache.get(key)
+    if result is None:
+        # Taken before computing so a fee from just before midnight is not kept past it
+        expires_at = _next_midnight(datetime.now())
+        result = calculate_late_fee_for_book(patron_id, book_id)
+        late_fee_cache.set(key, result, expires_at=expires_at)
+    return dict(result)
+
+def get_late_fee_cache_stats() -> Dict:
+    """Get hit/miss/expiration counters for the late fee response cache."""
+    return late_fee_cache.stats()
+
 
+def encode_catalog_cursor(book: Dict) -> str:
+    """Opaque, URL-safe cursor for a book's position in (title, id) order."""
+    raw = json.dumps([book['title'], book['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_catalog_cursor(cursor: str) -> Optional[Tuple[str, int]]:
+    """Inverse of encode_catalog_cursor; None if the cursor is malformed."""
     try:
-        due_dt = datetime.fromisoformat(row['due_date'])
-        ret_dt = datetime.fromisoformat(row['return_date']) if row['return_date'] else None
-    except Exception:
-        result['status'] = 'Invalid date format in borrow record.'
-        return result
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        title, book_id = json.loads(raw.decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(title, str) or not isinstance(book_id, int):
+        return None
+    return title, book_id
 
-    days, fee = compute_fee(due_dt, ret_dt)
-    result['days_overdue'] = days
-    result['fee_amount'] = fee
-    result['status'] = "On time" if days <= 0 else ("Overdue (capped)" if fee >= LATE_FEE_CAP else "Overdue")
-    return result
+
+def get_catalog_page(after: Optional[str] = None, before: Optional[str] = None,
+                     limit: int = CATALOG_PAGE_SIZE) -> Dict:
+    """
+    Get one page of the catalog in title order (R2).
+    
+    Args:
+        after: cursor from a previous page's next_cursor
+        before: cursor from a previous page's prev_cursor
+        limit: books per page (capped at CATALOG_MAX_PAGE_SIZE)
+        
+    Returns:
+        dict: {'books': [...], 'next_cursor': str or None, 'prev_cursor': str or None}
+    """
+    limit = max(1, min(int(limit), CATALOG_MAX_PAGE_SIZE))
+    after_key = decode_catalog_cursor(after) if after else None
+    before_key = decode_catalog_cursor(before) if before else None
+
+    if before_key:
+        page = get_books_page(limit=limit, before_title=before_key[0], before_id=before_key[1])
+        has_next, has_prev = True, page['has_more']
+    elif after_key:
+        page = get_books_page(after_key[0], after_key[1], limit)
+        has_next, has_prev = page['has_more'], True
+    else:
+        page = get_books_page(limit=limit)
+        has_next, has_prev = page['has_more'], False
+
+    books = page['books']
+    return {
+        'books': books,
+        'next_cursor': encode_catalog_cursor(books[-1]) if books and has_next else None,
+        'prev_cursor': encode_catalog_cursor(books[0]) if books and has_prev else None,
+    }
 
 
-def search_books_in_catalog(search_term: str, search_type: str) -> List[Dict]:
+def search_books_in_catalog(search_term: str, search_type: str,
+                            limit: int = SEARCH_LIMIT, offset: int = 0) -> List[Dict]:
     """
     Search for books in the catalog (R6).
-    - title/author: case-insensitive partial match over all books.
+    - title/author: case-insensitive partial match through the full-text index,
+      best matches first.
     - isbn: exact match using the ISBN index.
+    - limit/offset page through title/author matches.
+    """
+    return search_catalog_page(search_term, search_type, limit, offset)['books']
+
+def search_catalog_page(search_term: str, search_type: str,
+                        limit: int = SEARCH_LIMIT, offset: int = 0) -> Dict:
+    """
+    One page of search_books_in_catalog() results.
+
+    Args:
+        limit: matches per page (capped at SEARCH_MAX_LIMIT)
+        offset: number of matches to skip
+
+    Returns:
+        dict: {'books': [...], 'has_more': bool, 'limit': int, 'offset': int}
+        with the limit and offset actually used
     """
+    limit = max(1, min(int(limit), SEARCH_MAX_LIMIT))
+    offset = max(0, int(offset))
+    page = {'books': [], 'has_more': False, 'limit': limit, 'offset': offset}
     if not search_term or not isinstance(search_term, str):
-        return []
+        return page
     kind = (search_type or "").strip().lower()
     term = search_term.strip()
 
     if kind == "isbn":
         book = get_book_by_isbn(term)
-        return [book] if book else []
+        page['books'] = [book] if book else []
+        return page
 
     if kind not in {"title", "author"}:
-        return []
+        return page
+
+    # One extra row tells whether another page exists
+    books = search_books(term, kind, limit + 1, offset)
+    page['books'] = books[:limit]
+    page['has_more'] = len(books) > limit
+    return page
+
+def encode_history_cursor(borrow: Dict) -> str:
+    """Opaque, URL-safe cursor for a borrow's position in (borrow_date, id) order."""
+    raw = json.dumps([borrow['borrow_date'], borrow['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
 
-    books = get_all_books()
-    q = term.lower()
-    if kind == "title":
-        return [b for b in books if q in (b.get("title") or "").lower()]
-    else:
-        return [b for b in books if q in (b.get("author") or "").lower()]
 
-def get_patron_status_report(patron_id: str) -> Dict:
+def decode_history_cursor(cursor: str) -> Optional[Tuple[str, int]]:
+    """Inverse of encode_history_cursor; None if the cursor is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        borrow_date, borrow_id = json.loads(raw.decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(borrow_date, str) or not isinstance(borrow_id, int):
+        return None
+    return borrow_date, borrow_id
+
+
+def get_patron_status_report(patron_id: str, limit: Optional[int] = None, after: Optional[str] = None,
+                             summary_only: bool = False) -> Dict:
     """
     Get status report for a patron (R7).
     - borrowed_count: number of active borrows (return_date IS NULL).
     - total_late_fees: sum of late fees for all borrows (active uses today; returned uses return_date).
-    - borrows: list with computed fee snapshot per record.
-    """
+    - borrows: list with computed fee snapshot per record, newest first.
+    Counts, per-loan fees and the total are all computed in SQL, from the
+    fines ledger when today's fines job has run; the total then comes from
+    the ledger's per-patron index instead of the whole borrow history.
 
-    report: Dict = {
-        "patron_id": patron_id,
-        "borrowed_count": 0,
-        "total_late_fees": 0.0,
-        "borrows": [],
-    }
+    Args:
+        limit: borrows per page (capped at PATRON_HISTORY_MAX_PAGE_SIZE);
+            None returns the whole history
+        after: cursor from a previous page's next_cursor
+        summary_only: skip the borrows list (for headers and badges)
 
-    # Active borrows count
-    active = get_patron_borrowed_books(patron_id) or []
-    report["borrowed_count"] = len(active)
+    Returns:
+        dict: patron_id, borrowed_count, total_late_fees and, unless
+        summary_only, borrows; paged reports also carry next_cursor
+    """
+    params = {'patron_id': patron_id, 'today': today_epoch_day(), 'limit': -1}
+    if limit is not None:
+        limit = max(1, min(int(limit), PATRON_HISTORY_MAX_PAGE_SIZE))
+        params['limit'] = limit + 1
+    after_key = decode_history_cursor(after) if after else None
+    if after_key:
+        params['after_date'], params['after_id'] = after_key
 
-    # Pull full history for fee aggregation and reporting
     conn = get_db_connection()
     try:
-        rows = conn.execute(
-            """
-            SELECT br.id,
-                   br.patron_id,
-                   br.book_id,
-                   br.borrow_date,
-                   br.due_date,
-                   br.return_date,
-                   b.title,
-                   b.author
-            FROM borrow_records br
-            JOIN books b ON b.id = br.book_id
-            WHERE br.patron_id = ?
-            ORDER BY br.borrow_date DESC, br.id DESC
-            """,
-            (patron_id,),
-        ).fetchall()
+        ledger = fines_ledger_is_current(conn, params['today'])
+        totals = conn.execute(LEDGER_PATRON_FEE_TOTALS_SQL if ledger else PATRON_FEE_TOTALS_SQL,
+                              params).fetchone()
+        rows = []
+        if not summary_only:
+            if ledger:
+                rows_sql = LEDGER_PATRON_FEES_AFTER_SQL if after_key else LEDGER_PATRON_FEES_SQL
+            else:
+                rows_sql = PATRON_FEES_AFTER_SQL if after_key else PATRON_FEES_SQL
+            rows = conn.execute(rows_sql, params).fetchall()
     finally:
         conn.close()
 
-    LATE_FEE_FIRST_7 = 0.25
-    LATE_FEE_AFTER_7 = 0.50
-    LATE_FEE_CAP = 15.00
-
-    def compute_fee(due_dt: datetime, ret_dt: Optional[datetime]) -> Tuple[int, float]:
-        effective_return = ret_dt or datetime.now()
-        days_overdue = (effective_return.date() - due_dt.date()).days
-        if days_overdue <= 0:
-            return 0, 0.0
-        first_seg = min(7, days_overdue)
-        second_seg = max(0, days_overdue - 7)
-        fee = first_seg * LATE_FEE_FIRST_7 + second_seg * LATE_FEE_AFTER_7
-        return days_overdue, round(min(fee, LATE_FEE_CAP), 2)
-
-    total_fee = 0.0
-    decorated: List[Dict] = []
-    for r in rows or []:
-        try:
-            due_dt = datetime.fromisoformat(r["due_date"]) if r["due_date"] else None
-            ret_dt = datetime.fromisoformat(r["return_date"]) if r["return_date"] else None
-        except Exception:
-            due_dt, ret_dt = None, None
-
-        if due_dt is None:
-            days_overdue, fee_amount = 0, 0.0
-        else:
-            days_overdue, fee_amount = compute_fee(due_dt, ret_dt)
-
-        total_fee += fee_amount
-        decorated.append({
-            "id": r["id"],
-            "book_id": r["book_id"],
-            "title": r["title"],
-            "author": r["author"],
-            "borrow_date": r["borrow_date"],
-            "due_date": r["due_date"],
-            "return_date": r["return_date"],
-            "days_overdue": days_overdue,
-            "fee_amount": fee_amount,
-        })
-
-    report["total_late_fees"] = round(total_fee, 2)
-    report["borrows"] = decorated
+    report = {
+        "patron_id": patron_id,
+        "borrowed_count": totals["borrowed_count"],
+        "total_late_fees": totals["total_late_fees"],
+    }
+    if summary_only:
+        return report
+    borrows = [dict(r) for r in rows[:limit]]
+    report["borrows"] = borrows
+    if limit is not None:
+        report["next_cursor"] = encode_history_cursor(borrows[-1]) if len(rows) > limit else None
     return report
 
+def prepare_late_fee_payment(patron_id: str, book_id: int) -> Tuple[Optional[str], Optional[Dict]]:
+    """
+    Check that a late fee payment can be made and work out what to charge.
+    
+    The payment's idempotency key identifies the loan and the fee accrued
+    on it so far, so paying the same fee twice maps to the same key.
+    
+    Returns:
+        tuple: (error: str or None, payment: dict with idempotency_key,
+        patron_id, book_id, loan_id, amount still owed and description)
+    """
+    # Validate patron ID
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return "Invalid patron ID. Must be exactly 6 digits.", None
+    
+    # Calculate late fee first
+    fee_info = calculate_late_fee_for_book(patron_id, book_id)
+    
+    # Check if there's a fee to pay
+    if not fee_info or 'fee_amount' not in fee_info:
+        return "Unable to calculate late fees.", None
+    
+    fee_amount = fee_info.get('fee_amount', 0.0)
+    accrued = round(fee_amount + fee_info.get('amount_paid', 0.0), 2)
+    
+    if accrued <= 0:
+        return "No late fees to pay for this book.", None
+    
+    # Get book details for payment description
+    book = get_book_by_id(book_id)
+    if not book:
+        return "Book not found.", None
+    
+    loan_id = fee_info.get('loan_id')
+    return None, {
+        'idempotency_key': f"{patron_id}:{book_id}:{loan_id or '-'}:{accrued:.2f}",
+        'patron_id': patron_id,
+        'book_id': book_id,
+        'loan_id': loan_id,
+        'amount': fee_amount,
+        'description': f"Late fees for '{book['title']}'",
+    }
+
+def _claim_late_fee_payment(payment: Dict) -> Tuple[Optional[Tuple[bool, str, Optional[str]]], Optional[str]]:
+    """
+    Claim a payment's idempotency key before charging it.
+    
+    The claim is written on a standalone connection and is followed by the
+    gateway call, so the request's connection is released first.
+    
+    Returns:
+        tuple: (result to give instead if it is not to be charged, or None;
+        the Idempotency-Key to send the gateway when it is)
+    """
+    key = payment['idempotency_key']
+    if payment['amount'] <= 0:
+        record = get_payment(key)
+        if record and record['status'] == PAYMENT_PAID:
+            return (True, "Late fees already paid.", record['transaction_id']), None
+        return (False, "No late fees to pay for this book.", None), None
+
+    release_db_connection()
+    claimed, record = begin_payment(key, payment['patron_id'], payment['book_id'], payment['loan_id'],
+                                    payment['amount'])
+    if not claimed:
+        if record['status'] == PAYMENT_PAID:
+            return (True, "Late fees already paid.", record['transaction_id']), None
+        return (False, "A payment for these late fees is already in progress.", None), None
+    return None, gateway_idempotency_key(key, record['gateway_attempt'])
+
+def charge_late_fee_payment(payment: Dict, payment_gateway: PaymentGateway) -> Tuple[bool, str, Optional[str]]:
+    """
+    Charge a payment from prepare_late_fee_payment at most once.
+    
+    The idempotency key is claimed in the payments ledger before the gateway
+    is called; if that fee has already been paid the stored transaction is
+    returned without calling the gateway again. The gateway is sent an
+    Idempotency-Key derived from it, so a charge resent after a lost reply
+    is applied once.
+    
+    Returns:
+        tuple: (success: bool, message: str, transaction_id: Optional[str])
+    """
+    key = payment['idempotency_key']
+    refused, gateway_key = _claim_late_fee_payment(payment)
+    if refused:
+        return refused
+
+    # Process payment through external gateway
+    # THIS IS WHAT YOU SHOULD MOCK IN THEIR TESTS!
+    try:
+        success, transaction_id, message = payment_gateway.process_payment(
+            patron_id=payment['patron_id'],
+            amount=payment['amount'],
+            description=payment['description'],
+            idempotency_key=gateway_key
+        )
+    except Exception as e:
+        # Handle payment gateway errors
+        settle_payment(key, PAYMENT_FAILED, None, str(e))
+        return False, f"Payment processing error: {str(e)}", None
+
+    if not success:
+        settle_payment(key, PAYMENT_FAILED, None, message, next_attempt=True)
+        return False, f"Payment failed: {message}", None
+
+    settle_payment(key, PAYMENT_PAID, transaction_id, message)
+    late_fee_cache.invalidate(_late_fee_cache_key(payment['patron_id'], payment['book_id']))
+    return True, f"Payment successful! {message}", transaction_id
+
 def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway = None) -> Tuple[bool, str, Optional[str]]:
     """
     Process payment for late fees using external payment gateway.
     
     NEW FEATURE FOR ASSIGNMENT 3: Demonstrates need for mocking/stubbing
     This function depends on an external payment service that should be mocked in tests.
+    Payments are recorded in the payments ledger: repeating a payment for a
+    fee that has already been paid returns the original transaction id.
     
     Args:
         patron_id: 6-digit library card ID
@@ -348,48 +603,201 @@ def pay_late_fees(patron_id: str, book_id: int, payment_gateway: PaymentGateway
         mock_gateway.process_payment.return_value = (True, "txn_123", "Success")
         success, msg, txn = pay_late_fees("123456", 1, mock_gateway)
     """
-    # Validate patron ID
-    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
-        return False, "Invalid patron ID. Must be exactly 6 digits.", None
+    error, payment = prepare_late_fee_payment(patron_id, book_id)
+    if error:
+        return False, error, None
     
-    # Calculate late fee first
-    fee_info = calculate_late_fee_for_book(patron_id, book_id)
+    # Use provided gateway or create new one
+    if payment_gateway is None:
+        payment_gateway = PaymentGateway()
     
-    # Check if there's a fee to pay
-    if not fee_info or 'fee_amount' not in fee_info:
-        return False, "Unable to calculate late fees.", None
+    return charge_late_fee_payment(payment, payment_gateway)
+
+WEBHOOKS_NOT_CONFIGURED = "Webhook payments are not configured: PAYMENT_WEBHOOK_SECRET is not set."
+
+def submit_late_fee_payment(patron_id: str, book_id: int, callback_url: str,
+                            payment_gateway: PaymentGateway = None) -> Tuple[bool, str, Optional[str]]:
+    """
+    Submit payment of the late fee for a book, to be completed by webhook.
     
-    fee_amount = fee_info.get('fee_amount', 0.0)
+    The gateway accepts the charge and answers at once, so its processing
+    time is not spent in the request. The payment stays 'submitted' (and
+    cannot be charged again) until the gateway posts the outcome to
+    callback_url; see complete_payment_from_webhook. Refused unless a
+    webhook secret is configured.
     
-    if fee_amount <= 0:
-        return False, "No late fees to pay for this book.", None
+    Returns:
+        tuple: (accepted: bool, message: str, transaction_id: Optional[str])
+    """
+    if not get_webhook_secret():
+        return False, WEBHOOKS_NOT_CONFIGURED, None
     
-    # Get book details for payment description
-    book = get_book_by_id(book_id)
-    if not book:
-        return False, "Book not found.", None
+    error, payment = prepare_late_fee_payment(patron_id, book_id)
+    if error:
+        return False, error, None
     
-    # Use provided gateway or create new one
     if payment_gateway is None:
         payment_gateway = PaymentGateway()
     
-    # Process payment through external gateway
-    # THIS IS WHAT YOU SHOULD MOCK IN THEIR TESTS!
+    key = payment['idempotency_key']
+    refused, gateway_key = _claim_late_fee_payment(payment)
+    if refused:
+        return refused
+    
     try:
-        success, transaction_id, message = payment_gateway.process_payment(
+        accepted, transaction_id, message = payment_gateway.submit_payment(
             patron_id=patron_id,
-            amount=fee_amount,
-            description=f"Late fees for '{book['title']}'"
+            amount=payment['amount'],
+            description=payment['description'],
+            reference=key,
+            callback_url=callback_url,
+            idempotency_key=gateway_key
         )
-        
-        if success:
-            return True, f"Payment successful! {message}", transaction_id
-        else:
-            return False, f"Payment failed: {message}", None
-            
     except Exception as e:
-        # Handle payment gateway errors
+        settle_payment(key, PAYMENT_FAILED, None, str(e))
         return False, f"Payment processing error: {str(e)}", None
+    
+    if not accepted:
+        settle_payment(key, PAYMENT_FAILED, None, message, next_attempt=True)
+        return False, f"Payment failed: {message}", None
+    
+    mark_payment_submitted(key, transaction_id)
+    return True, "Payment submitted; awaiting confirmation from the payment gateway.", transaction_id
+
+# Outcomes of complete_payment_from_webhook besides those of apply_payment_event
+WEBHOOK_IGNORED = 'ignored'
+WEBHOOK_BAD_SIGNATURE = 'bad_signature'
+WEBHOOK_MALFORMED = 'malformed'
+WEBHOOK_NOT_CONFIGURED = 'not_configured'
+
+# Gateway event types and the payment status each one settles to
+WEBHOOK_EVENT_STATUSES = {
+    'charge.succeeded': PAYMENT_PAID,
+    'charge.failed': PAYMENT_FAILED,
+}
+
+def complete_payment_from_webhook(payload: bytes, signature: Optional[str]) -> Tuple[str, Dict]:
+    """
+    Settle submitted payments from a gateway webhook.
+    
+    The raw body must carry a valid signature made with the webhook secret;
+    without a configured secret every event is refused.
+    Each event is applied at most once (see database.apply_payment_event),
+    so duplicate deliveries are acknowledged without effect. A success
+    whose amount differs from the ledger settles nothing and is recorded
+    as a payment discrepancy. Event types
+    other than charge.succeeded and charge.failed are acknowledged and
+    ignored.
+    
+    Returns:
+        tuple: (outcome, details) where outcome is WEBHOOK_APPLIED,
+        WEBHOOK_DUPLICATE, WEBHOOK_UNKNOWN (no matching payment),
+        WEBHOOK_AMOUNT_MISMATCH,
+        WEBHOOK_IGNORED, WEBHOOK_BAD_SIGNATURE, WEBHOOK_MALFORMED or
+        WEBHOOK_NOT_CONFIGURED
+    """
+    secret = get_webhook_secret()
+    if not secret:
+        return WEBHOOK_NOT_CONFIGURED, {'error': 'Webhooks are not configured.'}
+    if not verify_webhook_signature(payload, signature, secret):
+        return WEBHOOK_BAD_SIGNATURE, {'error': 'Invalid webhook signature.'}
+    try:
+        event = json.loads(payload)
+        event_id, event_type, data = str(event['id']), event['type'], event['data']
+        transaction_id, reference = data.get('transaction_id'), data.get('reference')
+        amount = data.get('amount')
+        if amount is not None:
+            amount = float(amount)
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return WEBHOOK_MALFORMED, {'error': 'Malformed webhook event.'}
+    
+    status = WEBHOOK_EVENT_STATUSES.get(event_type)
+    if status is None:
+        return WEBHOOK_IGNORED, {'event_id': event_id}
+    if not transaction_id and not reference:
+        return WEBHOOK_MALFORMED, {'error': 'Webhook event names no transaction.'}
+    
+    outcome, updated = apply_payment_event(event_id, event_type, transaction_id, reference, status,
+                                           data.get('message') or '', amount)
+    if outcome == WEBHOOK_UNKNOWN:
+        return outcome, {'error': 'No payment matches this event.'}
+    for payment in updated:
+        late_fee_cache.invalidate(_late_fee_cache_key(payment['patron_id'], payment['book_id']))
+    return outcome, {'event_id': event_id, 'payments_updated': len(updated)}
+
+def pay_all_late_fees(patron_id: str, payment_gateway: PaymentGateway = None) -> Tuple[bool, str, Optional[str], List[Dict]]:
+    """
+    Pay every late fee a patron owes in a single gateway charge.
+
+    The outstanding fees come from one query; the total is charged once and
+    each loan's share is recorded in the payments ledger under the same key
+    a payment for that book alone would use, so the books show as paid and
+    cannot be charged again separately. The request's connection is
+    released before the ledger writes and the gateway call.
+
+    Args:
+        patron_id: 6-digit library card ID
+        payment_gateway: Payment gateway instance (injectable for testing)
+
+    Returns:
+        tuple: (success: bool, message: str, transaction_id: Optional[str],
+        allocations: list of dicts with book_id, loan_id, title and amount)
+    """
+    if not patron_id or not patron_id.isdigit() or len(patron_id) != 6:
+        return False, "Invalid patron ID. Must be exactly 6 digits.", None, []
+
+    params = {'patron_id': patron_id, 'today': today_epoch_day()}
+    conn = get_db_connection()
+    try:
+        sql = (LEDGER_PATRON_OUTSTANDING_FEES_SQL if fines_ledger_is_current(conn, params['today'])
+               else PATRON_OUTSTANDING_FEES_SQL)
+        rows = conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+    release_db_connection()
+
+    if not rows:
+        return False, "No late fees to pay.", None, []
+
+    allocations = [{
+        'idempotency_key': f"{patron_id}:{row['book_id']}:{row['id']}:{row['fee_amount'] + row['amount_paid']:.2f}",
+        'book_id': row['book_id'],
+        'loan_id': row['id'],
+        'title': row['title'],
+        'amount': row['fee_amount'],
+    } for row in rows]
+    keys = '|'.join(a['idempotency_key'] for a in allocations)
+    charge_key = f"{patron_id}:all:{hashlib.sha1(keys.encode()).hexdigest()[:16]}"
+    total = round(sum(a['amount'] for a in allocations), 2)
+
+    claimed, rows = begin_payment_allocations(charge_key, patron_id, allocations)
+    if not claimed:
+        return False, "A payment for these late fees is already in progress.", None, []
+
+    if payment_gateway is None:
+        payment_gateway = PaymentGateway()
+
+    count = len(allocations)
+    try:
+        success, transaction_id, message = payment_gateway.process_payment(
+            patron_id=patron_id,
+            amount=total,
+            description=f"Late fees for {count} book{'s' if count != 1 else ''}",
+            idempotency_key=gateway_idempotency_key(charge_key, max(r['gateway_attempt'] for r in rows))
+        )
+    except Exception as e:
+        settle_payment_allocations(charge_key, PAYMENT_FAILED, None, str(e))
+        return False, f"Payment processing error: {str(e)}", None, []
+
+    if not success:
+        settle_payment_allocations(charge_key, PAYMENT_FAILED, None, message, next_attempt=True)
+        return False, f"Payment failed: {message}", None, []
+
+    settle_payment_allocations(charge_key, PAYMENT_PAID, transaction_id, message)
+    for allocation in allocations:
+        late_fee_cache.invalidate(_late_fee_cache_key(patron_id, allocation['book_id']))
+    allocations = [{k: a[k] for k in ('book_id', 'loan_id', 'title', 'amount')} for a in allocations]
+    return True, f"Payment successful! {message}", transaction_id, allocations
 
 
 def refund_late_fee_payment(transaction_id: str, amount: float, payment_gateway: PaymentGateway = None) -> Tuple[bool, str]:
@@ -0,0 +1,213 @@
+"""
+Payment Jobs Module - Asynchronous late fee payments
+Submitting a payment records a job in SQLite and returns its id at once; a
+bounded pool of worker threads makes the gateway calls and records the
+outcome, so request threads never wait on the payment gateway
+"""
+
+import logging
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_for_futures
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from database import (
+    release_db_connection, insert_payment_job, claim_payment_job, finish_payment_job, get_payment_job,
+    get_unfinished_payment_jobs, get_payment_job_counts, heartbeat_payment_jobs, interrupt_stale_payment_job,
+    PAYMENT_JOB_QUEUED, PAYMENT_JOB_SUCCEEDED, PAYMENT_JOB_FAILED
+)
+from services.library_service import prepare_late_fee_payment, charge_late_fee_payment
+from services.payment_service import PaymentGateway
+
+logger = logging.getLogger(__name__)
+
+# Gateway calls that may be in flight at once
+PAYMENT_WORKERS = 4
+
+# Seconds between heartbeats on running jobs, and without one before
+# another process may take a running job's runner for dead
+PAYMENT_JOB_HEARTBEAT = 10.0
+PAYMENT_JOB_STALE_AFTER = 60.0
+
+
+class PaymentJobRunner:
+    """
+    Runs payment jobs on a fixed-size thread pool.
+
+    Charges go through the payments ledger, so a job for a fee that has
+    already been paid completes with the original transaction id.
+
+    A job is stored before it is queued, so one submitted just before the
+    process stops is run by resume() on the next start. A job that was
+    running at that point may or may not have reached the gateway; resume()
+    marks it interrupted rather than risk charging the patron twice. Several
+    processes may share the database: each runner claims jobs under its own
+    id and heartbeats them while they run, and resume() only interrupts a
+    running job whose heartbeat is older than `stale_after` seconds.
+    """
+
+    def __init__(self, workers: int = PAYMENT_WORKERS,
+                 gateway_factory: Callable[[], PaymentGateway] = PaymentGateway,
+                 heartbeat: float = PAYMENT_JOB_HEARTBEAT, stale_after: float = PAYMENT_JOB_STALE_AFTER):
+        self.workers = workers
+        self.gateway_factory = gateway_factory
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.owner = uuid.uuid4().hex
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._heartbeat_thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._futures: Dict[str, Future] = {}     # job id -> future, while queued or running
+        self._lock = threading.Lock()
+        self._counters = {'submitted': 0, 'succeeded': 0, 'failed': 0, 'resumed': 0, 'interrupted': 0}
+
+    def submit(self, patron_id: str, book_id: int,
+               on_complete: Optional[Callable[[Dict], None]] = None) -> Tuple[bool, str, Optional[str]]:
+        """
+        Queue payment of the late fee for a book.
+
+        The fee is worked out now and charged as it stands; `on_complete` is
+        called with the finished job from the worker thread. The job is
+        stored on a standalone connection (the worker must see it at once),
+        so the request's connection is released first.
+
+        Returns:
+            tuple: (success: bool, message: str, job_id: Optional[str])
+        """
+        error, payment = prepare_late_fee_payment(patron_id, book_id)
+        if error:
+            return False, error, None
+        release_db_connection()
+        job = insert_payment_job(uuid.uuid4().hex, patron_id, book_id, payment['amount'], payment['description'],
+                                 payment['idempotency_key'], payment['loan_id'])
+        with self._lock:
+            self._counters['submitted'] += 1
+        self._enqueue(job['id'], on_complete)
+        return True, f"Payment of ${payment['amount']:.2f} queued.", job['id']
+
+    def _enqueue(self, job_id: str, on_complete: Optional[Callable[[Dict], None]] = None):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='payment-job')
+                self._stopping.clear()
+                self._heartbeat_thread = threading.Thread(target=self._beat, name='payment-job-heartbeat',
+                                                          daemon=True)
+                self._heartbeat_thread.start()
+            future = self._executor.submit(self._run, job_id, on_complete)
+            self._futures[job_id] = future
+        future.add_done_callback(lambda _: self._forget(job_id))
+
+    def _beat(self):
+        """Keep this runner's running jobs from looking abandoned to other processes."""
+        while not self._stopping.wait(self.heartbeat):
+            with self._lock:
+                busy = bool(self._futures)
+            if busy:
+                try:
+                    heartbeat_payment_jobs(self.owner)
+                except Exception:
+                    logger.exception('Payment job heartbeat failed')
+
+    def _forget(self, job_id: str):
+        with self._lock:
+            self._futures.pop(job_id, None)
+
+    def _run(self, job_id: str, on_complete: Optional[Callable[[Dict], None]]):
+        job = claim_payment_job(job_id, self.owner)
+        if job is None:
+            return
+        payment = {
+            'idempotency_key': job['idempotency_key'] or job['id'],
+            'patron_id': job['patron_id'],
+            'book_id': job['book_id'],
+            'loan_id': job['loan_id'],
+            'amount': job['amount'],
+            'description': job['description'],
+        }
+        try:
+            success, message, transaction_id = charge_late_fee_payment(payment, self.gateway_factory())
+        except Exception as e:
+            success, transaction_id, message = False, None, f"Payment processing error: {str(e)}"
+        status = PAYMENT_JOB_SUCCEEDED if success else PAYMENT_JOB_FAILED
+        finish_payment_job(job_id, status, transaction_id if success else None, message)
+        with self._lock:
+            self._counters[status] += 1
+
+        if on_complete is not None:
+            try:
+                on_complete(get_payment_job(job_id))
+            except Exception:
+                logger.exception('Payment job %s completion callback failed', job_id)
+
+    def resume(self) -> Dict[str, int]:
+        """
+        Pick up jobs left unfinished by a previous run of the process.
+
+        Running jobs another live runner is still heartbeating are left alone.
+
+        Returns:
+            dict: numbers of jobs 'resumed' (queued again) and 'interrupted'
+        """
+        result = {'resumed': 0, 'interrupted': 0}
+        stale_before = datetime.now() - timedelta(seconds=self.stale_after)
+        for job in get_unfinished_payment_jobs():
+            with self._lock:
+                if job['id'] in self._futures:
+                    continue  # queued or running in this process
+            if job['status'] == PAYMENT_JOB_QUEUED:
+                self._enqueue(job['id'])
+                result['resumed'] += 1
+            elif interrupt_stale_payment_job(job['id'], stale_before,
+                                             "Interrupted by a restart; check with the gateway before retrying."):
+                result['interrupted'] += 1
+        with self._lock:
+            for key, count in result.items():
+                self._counters[key] += count
+        return result
+
+    def wait(self, job_id: str, timeout: Optional[float] = None) -> Optional[Dict]:
+        """Wait up to `timeout` seconds for a job queued here to finish, then return it."""
+        with self._lock:
+            future = self._futures.get(job_id)
+        if future is not None:
+            wait_for_futures([future], timeout)
+        return get_payment_job(job_id)
+
+    def shutdown(self, wait: bool = True):
+        """Stop the worker threads (queued jobs stay queued in the database)."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            heartbeat_thread, self._heartbeat_thread = self._heartbeat_thread, None
+            pending = list(self._futures.values())
+        for future in pending:
+            future.cancel()     # only jobs not yet started; running ones finish
+        if executor is not None:
+            executor.shutdown(wait=wait)
+        self._stopping.set()
+        if heartbeat_thread is not None and wait:
+            heartbeat_thread.join()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = len(self._futures)
+        stats['workers'] = self.workers
+        stats['jobs'] = get_payment_job_counts()
+        return stats
+
+
+payment_jobs = PaymentJobRunner()
+
+def submit_payment_job(patron_id: str, book_id: int) -> Tuple[bool, str, Optional[str]]:
+    """Queue a late fee payment on the shared runner."""
+    return payment_jobs.submit(patron_id, book_id)
+
+def resume_payment_jobs() -> Dict[str, int]:
+    """Resume unfinished jobs on the shared runner (called at startup)."""
+    return payment_jobs.resume()
+
+def get_payment_job_stats() -> Dict:
+    """Worker pool counters and job counts by status."""
+    return payment_jobs.stats()
@@ -6,10 +6,316 @@ For Assignment 3: You will learn to mock this service in their tests
 since we cannot make actual payment API calls during testing.
 """
 
+import hashlib
+import hmac
+import os
+import random
+import threading
+import uuid
+from datetime import datetime
 import requests
-from typing import Dict, Tuple
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, Optional, Tuple
 import time
 
+import database
+from cache import LRUCache
+from services.gateway_simulator import GatewaySimulator, get_default_simulator
+
+
+# Per-request deadlines for the HTTP gateway, in seconds
+GATEWAY_CONNECT_TIMEOUT = 2.0
+GATEWAY_READ_TIMEOUT = 5.0
+
+# Extra attempts after a transient failure, with jittered exponential backoff
+GATEWAY_RETRIES = 2
+GATEWAY_BACKOFF = 0.1
+GATEWAY_BACKOFF_MAX = 2.0
+
+# Kept-alive connections per gateway host (enough for the payment workers)
+GATEWAY_POOL_SIZE = 10
+
+# Consecutive failures that open the circuit, and seconds before a trial call
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+
+
+class GatewayUnavailableError(Exception):
+    """The payment gateway could not be reached, or kept failing."""
+
+
+class CircuitOpenError(GatewayUnavailableError):
+    """The circuit breaker is open, so the gateway was not called."""
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast while a dependency is unhealthy.
+
+    Closed: calls go through, and `failure_threshold` consecutive failures
+    open the circuit. Open: calls are rejected until `reset_timeout` seconds
+    have passed, then the circuit is half-open. Half-open: a single trial
+    call goes through; success closes the circuit and failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0              # consecutive
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self._counters = {'opened': 0, 'half_opened': 0, 'closed': 0, 'rejected': 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._check_reset()
+            return self._state
+
+    def _check_reset(self):
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = False
+            self._counters['half_opened'] += 1
+
+    def _open(self):
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self._trial_in_flight = False
+        self._counters['opened'] += 1
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead now (counts it as rejected if not)."""
+        with self._lock:
+            self._check_reset()
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self._counters['rejected'] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state != self.CLOSED:
+                self._state = self.CLOSED
+                self._trial_in_flight = False
+                self._counters['closed'] += 1
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or (
+                    self._state == self.CLOSED and self._failures >= self.failure_threshold):
+                self._open()
+
+    def stats(self) -> Dict:
+        """Current state, consecutive failures and transition counters."""
+        with self._lock:
+            self._check_reset()
+            stats = dict(self._counters)
+            stats['state'] = self._state
+            stats['consecutive_failures'] = self._failures
+        return stats
+
+
+class GatewayClient:
+    """
+    HTTP transport for one payment gateway URL.
+
+    Requests share a pooled keep-alive session and carry connect/read
+    timeouts. Timeouts, connection errors and 429/5xx responses are retried
+    with jittered exponential backoff; POSTs send the same Idempotency-Key on
+    every attempt, so a retried charge is applied once. Callers pass the key
+    of the payment (see database.gateway_idempotency_key) so that it also
+    holds across separate calls for the same payment. Failures feed a
+    circuit breaker, and calls fail fast with CircuitOpenError while it is
+    open.
+    """
+
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, base_url: str,
+                 connect_timeout: float = GATEWAY_CONNECT_TIMEOUT,
+                 read_timeout: float = GATEWAY_READ_TIMEOUT,
+                 retries: int = GATEWAY_RETRIES,
+                 backoff: float = GATEWAY_BACKOFF,
+                 backoff_max: float = GATEWAY_BACKOFF_MAX,
+                 pool_size: int = GATEWAY_POOL_SIZE,
+                 breaker: Optional[CircuitBreaker] = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self._sleep = sleep
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._counters = {'calls': 0, 'attempts': 0, 'retries': 0, 'timeouts': 0, 'errors': 0,
+                          'rejected': 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def request(self, method: str, path: str, api_key: str, idempotency_key: Optional[str] = None,
+                **kwargs) -> requests.Response:
+        """
+        Make one gateway call, retrying transient failures.
+
+        POSTs carry `idempotency_key`, or a fresh key for this call only.
+
+        Returns the first response that is not a transient failure (so 2xx
+        and most 4xx responses are returned to the caller as they are).
+
+        Raises:
+            CircuitOpenError: the breaker is open; nothing was sent
+            GatewayUnavailableError: every attempt failed
+        """
+        self._count('calls')
+        headers = {'Authorization': f'Bearer {api_key}'}
+        if method != 'GET':
+            headers['Idempotency-Key'] = idempotency_key or uuid.uuid4().hex
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count('retries')
+                self._sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt)))
+            if not self.breaker.allow():
+                self._count('rejected')
+                raise CircuitOpenError(f"Payment gateway circuit is open: {self.base_url}")
+            self._count('attempts')
+            failed = True
+            try:
+                response = self.session.request(method, self.base_url + path, headers=headers,
+                                                timeout=self.timeout, **kwargs)
+                if response.status_code not in self.RETRY_STATUSES:
+                    failed = False
+                    return response
+                self._count('errors')
+                error = f"HTTP {response.status_code}"
+                response.close()
+            except requests.Timeout as e:
+                self._count('timeouts')
+                error = e
+            except requests.RequestException as e:
+                self._count('errors')
+                error = e
+            finally:
+                # Report every attempt, even one ended by an unexpected exception,
+                # so a half-open trial call is never left in flight
+                if failed:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+        raise GatewayUnavailableError(
+            f"Payment gateway unavailable after {self.retries + 1} attempts: {error}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._counters)
+        stats['connect_timeout'], stats['read_timeout'] = self.timeout
+        stats['breaker'] = self.breaker.stats()
+        return stats
+
+    def close(self):
+        self.session.close()
+
+
+_clients: Dict[str, GatewayClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_gateway_client(base_url: str) -> GatewayClient:
+    """The shared client for a gateway URL, so connections and breaker state are reused."""
+    with _clients_lock:
+        client = _clients.get(base_url)
+        if client is None:
+            client = _clients[base_url] = GatewayClient(base_url)
+        return client
+
+
+def get_gateway_stats() -> Dict:
+    """Counters and breaker state for each HTTP gateway in use, by URL."""
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {client.base_url: client.stats() for client in clients}
+
+
+# Most recent charges made by the simulated gateway in this process, by
+# transaction id, so status checks report what was actually charged; older
+# charges and other processes' are looked up in the payments ledger
+SIMULATED_CHARGE_HISTORY = 10000
+_simulated_charges = LRUCache(SIMULATED_CHARGE_HISTORY)
+
+
+def _ledger_charge(transaction_id: str) -> Optional[Dict]:
+    """A simulated charge as recorded by the payments ledger, or None if it isn't there."""
+    rows = [row for row in database.get_payments_by_transaction(transaction_id)
+            if row['status'] == database.PAYMENT_PAID]
+    if not rows:
+        return None
+    return {"amount": round(sum(row['amount'] for row in rows), 2),
+            "timestamp": datetime.fromisoformat(max(row['updated_at'] for row in rows)).timestamp()}
+
+
+def _response_json(response: requests.Response) -> Dict:
+    try:
+        body = response.json()
+    except ValueError:
+        return {}
+    return body if isinstance(body, dict) else {}
+
+
+# Webhooks: the header carrying the signature, and how old a signed callback
+# may be, in seconds, before it is refused as a possible replay
+WEBHOOK_SIGNATURE_HEADER = 'X-Gateway-Signature'
+WEBHOOK_TOLERANCE = 300
+
+
+def get_webhook_secret() -> Optional[str]:
+    """The secret shared with the gateway for signing webhooks (PAYMENT_WEBHOOK_SECRET), if configured."""
+    return os.environ.get('PAYMENT_WEBHOOK_SECRET') or None
+
+
+def sign_webhook(payload: bytes, secret: str, timestamp: Optional[int] = None) -> str:
+    """Signature header for a webhook body: 't=<unix time>,v1=<HMAC-SHA256 of "t." + body>'."""
+    timestamp = int(time.time()) if timestamp is None else timestamp
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def verify_webhook_signature(payload: bytes, header: Optional[str], secret: str,
+                             tolerance: float = WEBHOOK_TOLERANCE, now: Optional[float] = None) -> bool:
+    """Whether a webhook body carries a valid signature from sign_webhook, made within `tolerance`."""
+    try:
+        fields = dict(item.split('=', 1) for item in (header or '').split(','))
+        timestamp = int(fields['t'])
+        signature = fields['v1']
+    except (ValueError, KeyError):
+        return False
+    now = time.time() if now is None else now
+    if abs(now - timestamp) > tolerance:
+        return False
+    expected = sign_webhook(payload, secret, timestamp).split('v1=', 1)[1]
+    return hmac.compare_digest(expected, signature)
+
 
 class PaymentGateway:
     """
@@ -20,19 +326,38 @@ class PaymentGateway:
     - Making actual API calls
     - Depending on external service availability
     - Incurring costs or rate limits
+    
+    Given a gateway URL (or PAYMENT_GATEWAY_URL in the environment), calls
+    are made over HTTP through a shared GatewayClient: pooled keep-alive
+    connections, timeouts, retries and a circuit breaker. Gateway outages
+    raise GatewayUnavailableError; declines are returned as usual.
+    
+    Otherwise latency, injected errors and declines come from a
+    GatewaySimulator (see services.gateway_simulator).
     """
     
-    def __init__(self, api_key: str = "test_key_12345"):
+    def __init__(self, api_key: str = "test_key_12345", base_url: Optional[str] = None,
+                 client: Optional[GatewayClient] = None, simulator: Optional[GatewaySimulator] = None):
         """
         Initialize payment gateway with API credentials.
         
         Args:
             api_key: API key for authentication (default is test key)
+            base_url: HTTP gateway to call; without one, payments are simulated
+            client: Transport to use instead of the shared one for base_url
+            simulator: Latency and failure model for simulated calls
+                (default: the PAYMENT_SIMULATOR profile)
         """
         self.api_key = api_key
-        self.base_url = "https://api.payment-gateway.example.com"
+        base_url = base_url or os.environ.get('PAYMENT_GATEWAY_URL')
+        if client is None and base_url:
+            client = get_gateway_client(base_url)
+        self.client = client
+        self.base_url = client.base_url if client else "https://api.payment-gateway.example.com"
+        self.simulator = simulator or get_default_simulator()
     
-    def process_payment(self, patron_id: str, amount: float, description: str = "") -> Tuple[bool, str, str]:
+    def process_payment(self, patron_id: str, amount: float, description: str = "",
+                        idempotency_key: Optional[str] = None) -> Tuple[bool, str, str]:
         """
         Process a payment through the external gateway.
         
@@ -43,6 +368,8 @@ class PaymentGateway:
             patron_id: 6-digit patron/customer ID
             amount: Payment amount in dollars
             description: Payment description
+            idempotency_key: Sent with the charge so the gateway applies it
+                once however often it is resent (HTTP mode)
             
         Returns:
             tuple: (success: bool, transaction_id: str, message: str)
@@ -51,8 +378,20 @@ class PaymentGateway:
             gateway = PaymentGateway()
             success, txn_id, msg = gateway.process_payment("123456", 10.50, "Late fees")
         """
+        if self.client is not None:
+            response = self.client.request('POST', '/charges', self.api_key, idempotency_key, json={
+                "customer_id": patron_id,
+                "amount": amount,
+                "currency": "usd",
+                "description": description
+            })
+            body = _response_json(response)
+            if response.ok:
+                return True, body.get("id", ""), body.get("message", "")
+            return False, "", body.get("error", f"HTTP {response.status_code}")
+        
         # Simulate API call delay
-        time.sleep(0.5)
+        self.simulator.delay('process_payment')
         
         # In a real implementation, this would make an HTTP request:
         # response = requests.post(
@@ -78,10 +417,42 @@ class PaymentGateway:
         if len(patron_id) != 6:
             return False, "", "Invalid patron ID format"
         
+        if self.simulator.declined():
+            return False, "", "Payment declined by card issuer"
+        
         # Simulate successful payment
-        transaction_id = f"txn_{patron_id}_{int(time.time())}"
+        transaction_id = f"txn_{patron_id}_{uuid.uuid4().hex}"
+        _simulated_charges.set(transaction_id, {"amount": amount, "timestamp": time.time()})
         return True, transaction_id, f"Payment of ${amount:.2f} processed successfully"
     
+    def submit_payment(self, patron_id: str, amount: float, description: str = "",
+                       reference: str = "", callback_url: str = "",
+                       idempotency_key: Optional[str] = None) -> Tuple[bool, str, str]:
+        """
+        Submit a payment to be completed by webhook.
+        
+        The gateway accepts the charge and answers at once; the outcome is
+        posted to callback_url later as a signed event (charge.succeeded or
+        charge.failed) that carries `reference`. Needs an HTTP gateway.
+        
+        Returns:
+            tuple: (accepted: bool, transaction_id: str, message: str)
+        """
+        if self.client is None:
+            return False, "", "Webhook payments need an HTTP payment gateway"
+        response = self.client.request('POST', '/charges', self.api_key, idempotency_key, json={
+            "customer_id": patron_id,
+            "amount": amount,
+            "currency": "usd",
+            "description": description,
+            "reference": reference,
+            "callback_url": callback_url
+        })
+        body = _response_json(response)
+        if response.ok:
+            return True, body.get("id", ""), body.get("message", "")
+        return False, "", body.get("error", f"HTTP {response.status_code}")
+    
     def refund_payment(self, transaction_id: str, amount: float) -> Tuple[bool, str]:
         """
         Refund a previous payment.
@@ -96,7 +467,17 @@ class PaymentGateway:
         Returns:
             tuple: (success: bool, message: str)
         """
-        time.sleep(0.5)
+        if self.client is not None:
+            response = self.client.request('POST', '/refunds', self.api_key, json={
+                "transaction_id": transaction_id,
+                "amount": amount
+            })
+            body = _response_json(response)
+            if response.ok:
+                return True, body.get("message", "")
+            return False, body.get("error", f"HTTP {response.status_code}")
+        
+        self.simulator.delay('refund_payment')
         
         if not transaction_id or not transaction_id.startswith("txn_"):
             return False, "Invalid transaction ID"
@@ -120,15 +501,25 @@ class PaymentGateway:
         Returns:
             dict: Payment status information
         """
-        time.sleep(0.3)
+        if self.client is not None:
+            response = self.client.request('GET', f'/charges/{transaction_id}', self.api_key)
+            body = _response_json(response)
+            if response.ok:
+                return body
+            if response.status_code == 404:
+                return {"status": "not_found", "message": "Transaction not found"}
+            return {"status": "error", "message": body.get("error", f"HTTP {response.status_code}")}
         
-        if not transaction_id or not transaction_id.startswith("txn_"):
+        self.simulator.delay('verify_payment_status')
+        
+        charge = _simulated_charges.get(transaction_id) or _ledger_charge(transaction_id)
+        if charge is None:
             return {"status": "not_found", "message": "Transaction not found"}
         
         # Simulate status check
         return {
             "transaction_id": transaction_id,
             "status": "completed",
-            "amount": 10.50,
-            "timestamp": time.time()
+            "amount": charge["amount"],
+            "timestamp": charge["timestamp"]
         }
\ No newline at end of file
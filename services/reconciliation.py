@@ -0,0 +1,121 @@
+"""
+Reconciliation Module - Confirm settled late fee payments with the gateway
+Walks the gateway transaction ids in the payments ledger that have not been
+confirmed yet and checks each with verify_payment_status on a bounded
+thread pool. Terminal statuses are remembered so a transaction is only
+checked until the gateway gives a final answer; mismatches with the ledger
+are written to the payment_discrepancies table.
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from database import (
+    get_unverified_transactions, count_verified_transactions, record_reconciliation_run,
+    DISCREPANCY_NOT_FOUND, DISCREPANCY_STATUS, DISCREPANCY_AMOUNT
+)
+from services.payment_service import PaymentGateway
+
+logger = logging.getLogger(__name__)
+
+# Status checks in flight at once. Each takes about 0.3 s, so 16 workers
+# confirm ~50 transactions a second: a day of 10,000 charges in under four
+# minutes, where checking them one by one takes 50.
+RECONCILE_WORKERS = 16
+RECONCILE_TARGET_PER_SECOND = 40
+
+# Gateway statuses that will not change, and the one a settled charge should have
+TERMINAL_STATUSES = frozenset({'completed', 'failed', 'refunded', 'not_found'})
+SETTLED_STATUS = 'completed'
+
+
+def reconcile_payments(gateway_factory: Callable[[], PaymentGateway] = PaymentGateway,
+                       workers: int = RECONCILE_WORKERS, since: Optional[datetime] = None) -> Dict:
+    """
+    Check unconfirmed paid transactions against the gateway and record the run.
+
+    One gateway instance is shared by the worker threads. A check that
+    raises, or comes back without a terminal status, is left for the next
+    run; a terminal status is stored, together with a discrepancy if the
+    gateway does not show the charge as completed for the amount in the
+    ledger.
+
+    Args:
+        gateway_factory: builds the gateway to query
+        workers: most status checks in flight at once
+        since: only check payments settled at or after this time
+
+    Returns:
+        dict: run_id, checked, verified, pending, errors, discrepancies,
+        already_verified, elapsed_seconds and per_second
+    """
+    started_at = datetime.now()
+    started = time.perf_counter()
+    transactions = get_unverified_transactions(since.isoformat() if since else '')
+    gateway = gateway_factory()
+
+    verifications, discrepancies = [], []
+    pending = errors = 0
+    if transactions:
+        with ThreadPoolExecutor(min(workers, len(transactions)), thread_name_prefix='reconcile') as executor:
+            futures = {executor.submit(gateway.verify_payment_status, t['transaction_id']): t
+                       for t in transactions}
+            for future in as_completed(futures):
+                txn = futures[future]
+                try:
+                    result = future.result() or {}
+                except Exception as e:
+                    logger.warning('Could not verify %s: %s', txn['transaction_id'], e)
+                    errors += 1
+                    continue
+
+                status = result.get('status')
+                if status not in TERMINAL_STATUSES:
+                    if status == 'error' or status is None:
+                        errors += 1
+                    else:
+                        pending += 1
+                    continue
+                amount = result.get('amount')
+                verifications.append((txn['transaction_id'], status, amount))
+                discrepancy = _discrepancy(txn, status, amount, result.get('message'))
+                if discrepancy:
+                    discrepancies.append(discrepancy)
+
+    elapsed = time.perf_counter() - started
+    stats = {
+        'checked': len(transactions),
+        'verified': len(verifications),
+        'pending': pending,
+        'errors': errors,
+        'already_verified': count_verified_transactions(),
+        'elapsed_seconds': round(elapsed, 3),
+    }
+    stats['run_id'] = record_reconciliation_run(started_at, stats, verifications, discrepancies)
+    stats['discrepancies'] = len(discrepancies)
+    stats['per_second'] = round(len(transactions) / elapsed, 1) if elapsed > 0 else 0.0
+    return stats
+
+
+def _discrepancy(txn: Dict, status: str, amount: Optional[float], message: Optional[str]) -> Optional[Dict]:
+    """The discrepancy between a ledger transaction and the gateway's answer, if any."""
+    kind = None
+    if status == 'not_found':
+        kind = DISCREPANCY_NOT_FOUND
+    elif status != SETTLED_STATUS:
+        kind = DISCREPANCY_STATUS
+    elif amount is not None and abs(amount - txn['amount']) >= 0.005:
+        kind = DISCREPANCY_AMOUNT
+    if kind is None:
+        return None
+    return {
+        'transaction_id': txn['transaction_id'],
+        'kind': kind,
+        'expected_amount': txn['amount'],
+        'gateway_status': status,
+        'gateway_amount': amount,
+        'detail': message,
+    }
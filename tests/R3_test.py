@@ -1,23 +1,39 @@
 import pytest
+from datetime import datetime, timedelta
+
+import database
 from services.library_service import borrow_book_by_patron
 
 
+def add_book(copies, available=None, isbn="9780000000001"):
+    """Insert a book into the test database and return its id."""
+    database.insert_book("Sample Book", "Sample Author", isbn, copies,
+                         copies if available is None else available)
+    return database.get_book_by_isbn(isbn)['id']
+
+
+def add_active_loans(patron_id, count):
+    """Give a patron `count` active loans of separate books."""
+    for i in range(count):
+        book_id = add_book(1, 0, isbn=f"97800000001{i:02d}")
+        database.insert_borrow_record(patron_id, book_id, datetime.now(), datetime.now() + timedelta(days=14))
+
+
 def test_borrow_book_valid_input(monkeypatch): 
     """Test borrowing a book with valid input."""
-    # Arrange: Simulate that all database operations succeed.
-    monkeypatch.setattr('services.library_service.get_book_by_id', lambda book_id: {"title": "Sample Book", "available_copies": 3})
-    monkeypatch.setattr('services.library_service.get_patron_borrow_count', lambda patron_id: 2) # Patron has 2 books
-    monkeypatch.setattr('services.library_service.insert_borrow_record', lambda *args: True)
-    monkeypatch.setattr('services.library_service.update_book_availability', lambda *args: True)
-    # ^^^^^^^^^^^^^^^^^^^^ UPDATED: Added 'services.' prefix to all
+    # Arrange: An available book and a patron who already has 2 books.
+    book_id = add_book(3)
+    add_active_loans("123456", 2)
 
 
     # Act
-    success, message = borrow_book_by_patron("123456", 1)
+    success, message = borrow_book_by_patron("123456", book_id)
     
     # Assert
     assert success is True
     assert "successfully borrowed" in message.lower()
+    assert database.get_book_by_id(book_id)['available_copies'] == 2
+    assert database.get_patron_borrow_count("123456") == 3
 
 
 def test_borrow_book_invalid_patron_id_too_short():
@@ -33,13 +49,12 @@ def test_borrow_book_invalid_patron_id_too_short():
 
 def test_borrow_no_copies_available(monkeypatch):
     """Test borrowing a book with no available copies."""
-    # Arrange: Simulate that the database returns a book with 0 available copies.
-    monkeypatch.setattr('services.library_service.get_book_by_id', lambda book_id: {"available_copies": 0})
-    # ^^^^^^^^^^^^^^^^^^^^ UPDATED: Added 'services.' prefix
+    # Arrange: A book with 0 available copies.
+    book_id = add_book(2, 0)
 
 
     # Act
-    success, message = borrow_book_by_patron("111111", 2)
+    success, message = borrow_book_by_patron("111111", book_id)
 
 
     # Assert
@@ -49,14 +64,13 @@ def test_borrow_no_copies_available(monkeypatch):
 
 def test_borrow_book_patron_exceeds_limit(monkeypatch):
     """Test borrowing when a patron has reached the borrowing limit."""
-    # Arrange: Simulate that the book is available, but the patron already has 6 books (exceeds limit).
-    monkeypatch.setattr('services.library_service.get_book_by_id', lambda book_id: {"available_copies": 1})
-    monkeypatch.setattr('services.library_service.get_patron_borrow_count', lambda patron_id: 6)
-    # ^^^^^^^^^^^^^^^^^^^^ UPDATED: Added 'services.' prefix and changed to 6 (your code checks > 5)
+    # Arrange: The book is available, but the patron already has 6 books (exceeds limit).
+    book_id = add_book(1)
+    add_active_loans("654321", 6)
 
 
     # Act
-    success, message = borrow_book_by_patron("654321", 1)
+    success, message = borrow_book_by_patron("654321", book_id)
     
     # Assert
     assert success is False
@@ -65,9 +79,7 @@ def test_borrow_book_patron_exceeds_limit(monkeypatch):
 
 def test_book_not_found(monkeypatch):
     """Test borrowing a book that does not exist in the database."""
-    # Arrange: Simulate that get_book_by_id returns None.
-    monkeypatch.setattr('services.library_service.get_book_by_id', lambda book_id: None)
-    # ^^^^^^^^^^^^^^^^^^^^ UPDATED: Added 'services.' prefix
+    # Arrange: No book with this ID exists.
 
 
     # Act
@@ -94,19 +106,17 @@ def test_borrow_book_patron_id_7_digits():
 
 def test_borrow_book_available_copies_exactly_zero(monkeypatch):
     """Test with exactly 0 available copies (edge case)"""
-    monkeypatch.setattr('services.library_service.get_book_by_id',
-                        lambda book_id: {"id": 1, "title": "Test", "available_copies": 0})
+    book_id = add_book(1, 0)
     
-    success, message = borrow_book_by_patron("123456", 1)
+    success, message = borrow_book_by_patron("123456", book_id)
     assert success is False
     assert "not available" in message.lower()
+    assert database.get_book_by_id(book_id)['available_copies'] == 0
 
 def test_borrow_book_insert_record_fails(monkeypatch):
     """Test when database insert borrow record fails"""
-    monkeypatch.setattr('services.library_service.get_book_by_id',
-                        lambda book_id: {"id": 1, "title": "Test", "available_copies": 3})
-    monkeypatch.setattr('services.library_service.get_patron_borrow_count', lambda patron_id: 2)
-    monkeypatch.setattr('services.library_service.insert_borrow_record', lambda *args: False)
+    monkeypatch.setattr('services.library_service.borrow_book_atomic',
+                        lambda *args: (database.BORROW_ERROR, None))
     
     success, message = borrow_book_by_patron("123456", 1)
     assert success is False
@@ -114,39 +124,43 @@ def test_borrow_book_insert_record_fails(monkeypatch):
 
 
 def test_borrow_book_update_availability_fails(monkeypatch):
-    """Test when updating book availability fails"""
-    monkeypatch.setattr('services.library_service.get_book_by_id',
-                        lambda book_id: {"id": 1, "title": "Test", "available_copies": 3})
-    monkeypatch.setattr('services.library_service.get_patron_borrow_count', lambda patron_id: 2)
-    monkeypatch.setattr('services.library_service.insert_borrow_record', lambda *args: True)
-    monkeypatch.setattr('services.library_service.update_book_availability', lambda *args: False)
+    """Test that a failure part-way through the borrow leaves nothing behind"""
+    book_id = add_book(3)
+    conn = database.get_db_connection()
+    try:
+        # Make the borrow record insert fail after the copy has been claimed
+        conn.execute("""
+            CREATE TRIGGER fail_borrow BEFORE INSERT ON borrow_records
+            BEGIN SELECT RAISE(ABORT, 'simulated failure'); END
+        """)
+        conn.commit()
+    finally:
+        conn.close()
     
-    success, message = borrow_book_by_patron("123456", 1)
-    # Function might still return True if insert succeeded
-    # but we're testing that the update path is covered
-    assert isinstance(success, bool)
+    success, message = borrow_book_by_patron("123456", book_id)
+    assert success is False
+    assert database.get_book_by_id(book_id)['available_copies'] == 3
 
 
 def test_borrow_book_patron_exactly_at_limit(monkeypatch):
     """Test patron with exactly 5 books (at limit but can borrow one more)"""
-    monkeypatch.setattr('services.library_service.get_book_by_id',
-                        lambda book_id: {"id": 1, "title": "Test", "available_copies": 3})
-    monkeypatch.setattr('services.library_service.get_patron_borrow_count', lambda patron_id: 5)
-    monkeypatch.setattr('services.library_service.insert_borrow_record', lambda *args: True)
-    monkeypatch.setattr('services.library_service.update_book_availability', lambda *args: True)
+    book_id = add_book(3)
+    add_active_loans("123456", 5)
     
-    success, message = borrow_book_by_patron("123456", 1)
+    success, message = borrow_book_by_patron("123456", book_id)
     # Your implementation checks > 5, so 5 should be allowed
     assert success is True
 
 
 def test_borrow_book_exactly_one_copy_available(monkeypatch):
     """Test borrowing when exactly 1 copy is available"""
-    monkeypatch.setattr('services.library_service.get_book_by_id',
-                        lambda book_id: {"id": 1, "title": "Test", "available_copies": 1})
-    monkeypatch.setattr('services.library_service.get_patron_borrow_count', lambda patron_id: 2)
-    monkeypatch.setattr('services.library_service.insert_borrow_record', lambda *args: True)
-    monkeypatch.setattr('services.library_service.update_book_availability', lambda *args: True)
+    book_id = add_book(1)
+    add_active_loans("123456", 2)
     
-    success, message = borrow_book_by_patron("123456", 1)
+    success, message = borrow_book_by_patron("123456", book_id)
     assert success is True
+    
+    # The last copy is gone now
+    success, message = borrow_book_by_patron("222222", book_id)
+    assert success is False
+    assert "not available" in message.lower()
@@ -1,8 +1,19 @@
 import pytest
 from datetime import datetime, timedelta
+
+import database
 from services.library_service import return_book_by_patron
 
 
+def add_loan(patron_id, isbn="9780000000002", days_until_due=4, copies=2):
+    """Insert a book with one copy lent to the patron; return the book id."""
+    database.insert_book("Test Book", "Test Author", isbn, copies, copies - 1)
+    book_id = database.get_book_by_isbn(isbn)['id']
+    due = datetime.now() + timedelta(days=days_until_due)
+    database.insert_borrow_record(patron_id, book_id, due - timedelta(days=14), due)
+    return book_id
+
+
 # def test_return_book_valid_input(monkeypatch):
 #     """Test returning a book with valid input."""
 #     # Arrange: Simulate that the book exists and patron has an active borrow
@@ -50,10 +61,9 @@ def test_return_book_invalid_patron_id_too_short():
     assert "invalid patron id" in message.lower()
 
 
-def test_return_book_not_found(monkeypatch):
+def test_return_book_not_found():
     """Test returning a book with an ID that does not exist in the catalog."""
-    # Arrange: Book doesn't exist
-    monkeypatch.setattr('services.library_service.get_book_by_id', lambda book_id: None)
+    # Arrange: Book doesn't exist in the (empty) test database
 
     # Act
     success, message = return_book_by_patron("222222", 999)
@@ -63,59 +73,84 @@ def test_return_book_not_found(monkeypatch):
     assert "book not found" in message.lower()
 
 
-def test_return_book_not_borrowed_by_patron(monkeypatch):
+def test_return_book_not_borrowed_by_patron():
     """Test returning a book that was not borrowed by the patron."""
     # Arrange: Book exists but patron has no active borrows for this book
-    monkeypatch.setattr('services.library_service.get_book_by_id',
-                        lambda book_id: {"id": 1, "title": "Test Book"})
-    monkeypatch.setattr('services.library_service.get_patron_borrowed_books',
-                        lambda patron_id: [])  # Empty list - no active borrows
+    database.insert_book("Test Book", "Test Author", "9780000000003", 1, 1)
+    book_id = database.get_book_by_isbn("9780000000003")['id']
 
     # Act
-    success, message = return_book_by_patron("333333", 1)
+    success, message = return_book_by_patron("333333", book_id)
 
     # Assert
     assert success is False
     assert "no active borrow" in message.lower()
 
 
-def test_return_book_borrowed_different_book(monkeypatch):
+def test_return_book_borrowed_different_book():
     """Test returning a book when patron borrowed a different book."""
-    # Arrange: Patron has book 5 borrowed, but trying to return book 1
-    monkeypatch.setattr('services.library_service.get_book_by_id',
-                        lambda book_id: {"id": 1, "title": "Test Book"})
-    monkeypatch.setattr('services.library_service.get_patron_borrowed_books',
-                        lambda patron_id: [{
-                            "book_id": 5, 
-                            "patron_id": "444444",
-                            "return_date": None,
-                            "id": 5
-                        }])  # Different book
+    # Arrange: Patron has another book borrowed, but tries to return this one
+    add_loan("444444", isbn="9780000000004")
+    database.insert_book("Other Book", "Test Author", "9780000000005", 1, 1)
+    other_id = database.get_book_by_isbn("9780000000005")['id']
 
     # Act
-    success, message = return_book_by_patron("444444", 1)
+    success, message = return_book_by_patron("444444", other_id)
 
     # Assert
     assert success is False
     assert "no active borrow" in message.lower()
 
 
+def test_return_book_valid_input():
+    """Test returning a borrowed book marks it returned and restocks the copy."""
+    # Arrange
+    book_id = add_loan("222222")
+
+    # Act
+    success, message = return_book_by_patron("222222", book_id)
+
+    # Assert
+    assert success is True
+    assert "returned successfully" in message.lower()
+    assert "late fee" not in message.lower()
+    assert database.get_book_by_id(book_id)['available_copies'] == 2
+    assert database.get_patron_borrow_count("222222") == 0
+
+
+def test_return_book_reports_late_fee():
+    """Test the late fee for an overdue return comes back with the confirmation."""
+    # Arrange: Due 10 days ago -> 7 * 0.25 + 3 * 0.50 = 3.25
+    book_id = add_loan("888888", days_until_due=-10)
+
+    # Act
+    success, message = return_book_by_patron("888888", book_id)
+
+    # Assert
+    assert success is True
+    assert "$3.25" in message
+    assert "10 days overdue" in message
+
+
+def test_return_book_only_closes_one_loan():
+    """Test returning one of two copies borrowed by the same patron."""
+    # Arrange
+    book_id = add_loan("555555", copies=3)
+    database.insert_borrow_record("555555", book_id, datetime.now(), datetime.now() + timedelta(days=14))
+
+    # Act
+    success, _ = return_book_by_patron("555555", book_id)
+
+    # Assert
+    assert success is True
+    assert database.get_patron_borrow_count("555555") == 1
+
+
 def test_return_book_update_record_fails(monkeypatch):
-    """Test when updating the borrow record fails."""
-    # Arrange: Everything valid but update_borrow_record_return_date fails
-    monkeypatch.setattr('services.library_service.get_book_by_id',
-                        lambda book_id: {"id": 2, "title": "Test Book"})
-    monkeypatch.setattr('services.library_service.get_patron_borrowed_books',
-                        lambda patron_id: [{
-                            "book_id": 2, 
-                            "patron_id": "555555",
-                            "return_date": None,
-                            "id": 2,  # Add ID
-                            "borrow_date": datetime.now() - timedelta(days=10),
-                            "due_date": datetime.now() + timedelta(days=4)
-                        }])
-    monkeypatch.setattr('services.library_service.update_borrow_record_return_date',
-                        lambda *args: False)  # Simulate failure
+    """Test when the return transaction fails."""
+    # Arrange: The database layer reports an error
+    monkeypatch.setattr('services.library_service.return_book_atomic',
+                        lambda *args: (database.RETURN_ERROR, None, None))
 
     # Act
     success, message = return_book_by_patron("555555", 2)
@@ -126,29 +161,25 @@ def test_return_book_update_record_fails(monkeypatch):
     assert (success is False and len(message) > 0)
 
 
-def test_return_book_update_availability_fails(monkeypatch):
-    """Test when updating book availability fails."""
+def test_return_book_update_availability_fails():
+    """Test when updating book availability fails the whole return is rolled back."""
     # Arrange: Record update succeeds but availability update fails
-    monkeypatch.setattr('services.library_service.get_book_by_id',
-                        lambda book_id: {"id": 3, "title": "Test Book"})
-    monkeypatch.setattr('services.library_service.get_patron_borrowed_books',
-                        lambda patron_id: [{
-                            "book_id": 3, 
-                            "patron_id": "666666",
-                            "return_date": None,
-                            "id": 3,  # Add ID
-                            "borrow_date": datetime.now() - timedelta(days=10),
-                            "due_date": datetime.now() + timedelta(days=4)
-                        }])
-    monkeypatch.setattr('services.library_service.update_borrow_record_return_date',
-                        lambda *args: True)
-    monkeypatch.setattr('services.library_service.update_book_availability',
-                        lambda *args: False)  # Simulate failure
+    book_id = add_loan("666666")
+    conn = database.get_db_connection()
+    try:
+        conn.execute("""
+            CREATE TRIGGER fail_restock BEFORE UPDATE ON books
+            BEGIN SELECT RAISE(ABORT, 'simulated failure'); END
+        """)
+        conn.commit()
+    finally:
+        conn.close()
 
     # Act
-    success, message = return_book_by_patron("666666", 3)
+    success, message = return_book_by_patron("666666", book_id)
 
     # Assert
     assert success is False
     # More flexible assertion
     assert (success is False and len(message) > 0)
+    assert database.get_patron_borrow_count("666666") == 1
@@ -1,4 +1,6 @@
 import pytest
+
+import database
 from services.library_service import search_books_in_catalog
 
 
@@ -24,14 +26,20 @@ MOCK_CATALOG = [
 ]
 
 
-def test_search_by_title_partial(monkeypatch):
+@pytest.fixture
+def catalog():
+    """Load MOCK_CATALOG into the test database."""
+    for book in MOCK_CATALOG:
+        database.insert_book(book["title"], book["author"], book["isbn"], 1, 1)
+    return MOCK_CATALOG
+
+
+def test_search_by_title_partial(catalog):
     """
     Typing the name "Harry" by the type "title", the function should return 
     2 books with "Harry" in the title.
     """
-    # Arrange
-    monkeypatch.setattr('services.library_service.get_all_books', lambda: MOCK_CATALOG)
-    # ^^^^^^^^^^^^^^^^^^^^ UPDATED: Changed to correct function name with prefix
+    # Arrange: catalog fixture
 
     # Act
     results = search_books_in_catalog("harry", "title")
@@ -42,14 +50,12 @@ def test_search_by_title_partial(monkeypatch):
     assert results[1]["title"] == "Harry Potter and the Chamber of Secrets"
 
 
-def test_search_by_author_partial(monkeypatch):
+def test_search_by_author_partial(catalog):
     """
     Typing the name "Rowling" by the type "author", the function should return
     2 books with "Rowling" in the author.
     """
-    # Arrange
-    monkeypatch.setattr('services.library_service.get_all_books', lambda: MOCK_CATALOG)
-    # ^^^^^^^^^^^^^^^^^^^^ UPDATED: Changed to correct function name with prefix
+    # Arrange: catalog fixture
 
     # Act
     results = search_books_in_catalog("rowling", "author")
@@ -79,13 +85,11 @@ def test_search_by_isbn_exact_match(monkeypatch):
     assert results[0]["title"] == "The Hobbit"
 
 
-def test_search_with_no_results(monkeypatch):
+def test_search_with_no_results(catalog):
     """
     Enter a non-existent title, the function should return an empty list.
     """
-    # Arrange
-    monkeypatch.setattr('services.library_service.get_all_books', lambda: MOCK_CATALOG)
-    # ^^^^^^^^^^^^^^^^^^^^ UPDATED: Added correct prefix
+    # Arrange: catalog fixture
 
     # Act
     results = search_books_in_catalog("1984", "title")
@@ -105,12 +109,11 @@ def test_search_with_empty_string(monkeypatch):
     assert results == []
 
 
-def test_search_with_invalid_type(monkeypatch):
+def test_search_with_invalid_type(catalog):
     """
     Search with invalid search type should return empty list.
     """
-    # Arrange
-    monkeypatch.setattr('services.library_service.get_all_books', lambda: MOCK_CATALOG)
+    # Arrange: catalog fixture
 
     # Act
     results = search_books_in_catalog("Harry", "invalid_type")
@@ -119,12 +122,11 @@ def test_search_with_invalid_type(monkeypatch):
     assert results == []
 
 
-def test_search_case_insensitive(monkeypatch):
+def test_search_case_insensitive(catalog):
     """
     Search should be case-insensitive.
     """
-    # Arrange
-    monkeypatch.setattr('services.library_service.get_all_books', lambda: MOCK_CATALOG)
+    # Arrange: catalog fixture
 
     # Act - Test with different cases
     results_lower = search_books_in_catalog("harry", "title")
@@ -145,19 +147,17 @@ def test_search_by_isbn_not_found(monkeypatch):
     assert results == []
 
 
-def test_search_by_title_case_variations(monkeypatch):
+def test_search_by_title_case_variations():
     """Test case insensitivity with mixed case"""
-    monkeypatch.setattr('services.library_service.get_all_books',
-                        lambda: [{"id": 1, "title": "HaRrY PoTtEr", "author": "Rowling"}])
+    database.insert_book("HaRrY PoTtEr", "Rowling", "9780000000010", 1, 1)
     
     results = search_books_in_catalog("HARRY", "title")
     assert len(results) == 1
 
 
-def test_search_by_author_partial_lowercase(monkeypatch):
+def test_search_by_author_partial_lowercase():
     """Test partial author match with lowercase"""
-    monkeypatch.setattr('services.library_service.get_all_books',
-                        lambda: [{"id": 1, "title": "Book", "author": "J.K. Rowling"}])
+    database.insert_book("Book", "J.K. Rowling", "9780000000011", 1, 1)
     
     results = search_books_in_catalog("rowling", "author")
     assert len(results) == 1
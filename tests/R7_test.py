@@ -1,44 +1,29 @@
 import pytest
 from datetime import datetime, timedelta
+
+import database
 from services.library_service import get_patron_status_report
 
 
-def test_patron_report_structure(monkeypatch):
+def add_loan(patron_id, isbn, title, borrowed_days_ago, due_in_days, returned_days_ago=None):
+    """Insert a book and a borrow record for it, optionally already returned."""
+    database.insert_book(title, "Test Author", isbn, 1, 0 if returned_days_ago is None else 1)
+    book_id = database.get_book_by_isbn(isbn)['id']
+    now = datetime.now()
+    database.insert_borrow_record(patron_id, book_id,
+                                  now - timedelta(days=borrowed_days_ago), now + timedelta(days=due_in_days))
+    if returned_days_ago is not None:
+        database.update_borrow_record_return_date(patron_id, book_id, now - timedelta(days=returned_days_ago))
+    return book_id
+
+
+def test_patron_report_structure():
     """
     A valid patron ID should return a report with the correct structure.
     """
-    # Arrange: Mock the database connection and query
-    class MockConnection:
-        def execute(self, query, params):
-            class MockResult:
-                def fetchall(self):
-                    # Return mock borrow records
-                    return [
-                        {
-                            'id': 1,
-                            'book_id': 101,
-                            'title': 'The Hobbit',
-                            'author': 'J.R.R. Tolkien',
-                            'borrow_date': (datetime.now() - timedelta(days=10)).isoformat(),
-                            'due_date': (datetime.now() + timedelta(days=4)).isoformat(),
-                            'return_date': None  # Active borrow
-                        },
-                        {
-                            'id': 2,
-                            'book_id': 102,
-                            'title': '1984',
-                            'author': 'George Orwell',
-                            'borrow_date': (datetime.now() - timedelta(days=30)).isoformat(),
-                            'due_date': (datetime.now() - timedelta(days=16)).isoformat(),
-                            'return_date': (datetime.now() - timedelta(days=10)).isoformat()  # Returned
-                        }
-                    ]
-            return MockResult()
-        
-        def close(self):
-            pass
-    
-    monkeypatch.setattr('services.library_service.get_db_connection', lambda: MockConnection())
+    # Arrange: one active borrow and one returned borrow
+    add_loan("111111", "9780000000101", "The Hobbit", borrowed_days_ago=10, due_in_days=4)
+    add_loan("111111", "9780000000102", "1984", borrowed_days_ago=30, due_in_days=-16, returned_days_ago=10)
 
     # Act
     report = get_patron_status_report("111111")
@@ -52,104 +37,44 @@ def test_patron_report_structure(monkeypatch):
     assert len(report["borrows"]) == 2  # Check we got the 2 records
 
 
-def test_patron_report_with_active_borrows(monkeypatch):
+def test_patron_report_with_active_borrows():
     """
     Test patron with 2 active borrows (not overdue).
     """
     # Arrange
-    class MockConnection:
-        def execute(self, query, params):
-            class MockResult:
-                def fetchall(self):
-                    return [
-                        {
-                            'id': 1,
-                            'book_id': 1,
-                            'title': 'Book 1',
-                            'author': 'Author 1',
-                            'borrow_date': (datetime.now() - timedelta(days=5)).isoformat(),
-                            'due_date': (datetime.now() + timedelta(days=9)).isoformat(),
-                            'return_date': None
-                        },
-                        {
-                            'id': 2,
-                            'book_id': 2,
-                            'title': 'Book 2',
-                            'author': 'Author 2',
-                            'borrow_date': (datetime.now() - timedelta(days=3)).isoformat(),
-                            'due_date': (datetime.now() + timedelta(days=11)).isoformat(),
-                            'return_date': None
-                        }
-                    ]
-            return MockResult()
-        
-        def close(self):
-            pass
-    
-    monkeypatch.setattr('services.library_service.get_db_connection', lambda: MockConnection())
+    add_loan("222222", "9780000000201", "Book 1", borrowed_days_ago=5, due_in_days=9)
+    add_loan("222222", "9780000000202", "Book 2", borrowed_days_ago=3, due_in_days=11)
 
     # Act
     report = get_patron_status_report("222222")
 
-    # Assert - More flexible assertions
+    # Assert
     assert len(report["borrows"]) == 2  # Got 2 borrow records
     assert report["total_late_fees"] == 0.0  # Not overdue
-    # Don't assert exact borrowed_count - depends on DB query implementation
+    assert report["borrowed_count"] == 2
 
 
-def test_patron_report_with_overdue_books(monkeypatch):
+def test_patron_report_with_overdue_books():
     """
     Test patron with overdue books - should calculate late fees.
     """
     # Arrange: One book 5 days overdue
-    class MockConnection:
-        def execute(self, query, params):
-            class MockResult:
-                def fetchall(self):
-                    return [
-                        {
-                            'id': 1,
-                            'book_id': 1,
-                            'title': 'Overdue Book',
-                            'author': 'Test Author',
-                            'borrow_date': (datetime.now() - timedelta(days=19)).isoformat(),
-                            'due_date': (datetime.now() - timedelta(days=5)).isoformat(),  # 5 days overdue
-                            'return_date': None  # Still borrowed
-                        }
-                    ]
-            return MockResult()
-        
-        def close(self):
-            pass
-    
-    monkeypatch.setattr('services.library_service.get_db_connection', lambda: MockConnection())
+    add_loan("333333", "9780000000301", "Overdue Book", borrowed_days_ago=19, due_in_days=-5)
 
     # Act
     report = get_patron_status_report("333333")
 
-    # Assert - More flexible
+    # Assert
     assert len(report["borrows"]) == 1  # Got 1 borrow record
-    assert report["total_late_fees"] > 0  # Should have fees
+    assert report["total_late_fees"] == 1.25  # 5 days * $0.25
     assert report["borrows"][0]["days_overdue"] == 5
+    assert report["borrows"][0]["fee_amount"] == 1.25
 
 
-def test_patron_report_with_no_borrows(monkeypatch):
+def test_patron_report_with_no_borrows():
     """
     Test new patron with no borrowing history.
     """
-    # Arrange: Empty result
-    class MockConnection:
-        def execute(self, query, params):
-            class MockResult:
-                def fetchall(self):
-                    return []
-            return MockResult()
-        
-        def close(self):
-            pass
-    
-    monkeypatch.setattr('services.library_service.get_db_connection', lambda: MockConnection())
-
     # Act
     report = get_patron_status_report("444444")
 
@@ -159,109 +84,41 @@ def test_patron_report_with_no_borrows(monkeypatch):
     assert report["borrows"] == []
 
 
-def test_patron_report_includes_returned_books(monkeypatch):
+def test_patron_report_includes_returned_books():
     """
     Test that report includes both active and returned books.
     """
     # Arrange
-    class MockConnection:
-        def execute(self, query, params):
-            class MockResult:
-                def fetchall(self):
-                    return [
-                        {
-                            'id': 1,
-                            'book_id': 1,
-                            'title': 'Active Book',
-                            'author': 'Author 1',
-                            'borrow_date': (datetime.now() - timedelta(days=5)).isoformat(),
-                            'due_date': (datetime.now() + timedelta(days=9)).isoformat(),
-                            'return_date': None  # Active
-                        },
-                        {
-                            'id': 2,
-                            'book_id': 2,
-                            'title': 'Returned Book',
-                            'author': 'Author 2',
-                            'borrow_date': (datetime.now() - timedelta(days=20)).isoformat(),
-                            'due_date': (datetime.now() - timedelta(days=6)).isoformat(),
-                            'return_date': (datetime.now() - timedelta(days=5)).isoformat()  # Returned
-                        }
-                    ]
-            return MockResult()
-        
-        def close(self):
-            pass
-    
-    monkeypatch.setattr('services.library_service.get_db_connection', lambda: MockConnection())
+    add_loan("555555", "9780000000501", "Active Book", borrowed_days_ago=5, due_in_days=9)
+    add_loan("555555", "9780000000502", "Returned Book", borrowed_days_ago=20, due_in_days=-6, returned_days_ago=5)
 
     # Act
     report = get_patron_status_report("555555")
 
-    # Assert - More flexible
+    # Assert
     assert len(report["borrows"]) == 2  # Got both records
-    # Don't assert exact borrowed_count - depends on implementation
-    # Check that records have the expected structure
+    assert report["borrowed_count"] == 1
     assert any(b.get("return_date") is None for b in report["borrows"])  # At least one active
     assert any(b.get("return_date") is not None for b in report["borrows"])  # At least one returned
+    assert report["borrows"][0]["title"] == "Active Book"  # Most recent borrow first
 
-def test_patron_report_calculates_fees_correctly(monkeypatch):
+def test_patron_report_calculates_fees_correctly():
     """Test that late fees are calculated for overdue books"""
-    class MockConnection:
-        def execute(self, query, params):
-            class MockResult:
-                def fetchall(self):
-                    return [{
-                        'id': 1,
-                        'book_id': 1,
-                        'title': 'Late Book',
-                        'author': 'Author',
-                        'borrow_date': (datetime.now() - timedelta(days=20)).isoformat(),
-                        'due_date': (datetime.now() - timedelta(days=6)).isoformat(),
-                        'return_date': None
-                    }]
-            return MockResult()
-        def close(self):
-            pass
-    
-    monkeypatch.setattr('services.library_service.get_db_connection', lambda: MockConnection())
+    add_loan("666666", "9780000000601", "Late Book", borrowed_days_ago=20, due_in_days=-6)
+
     report = get_patron_status_report("666666")
     
-    assert report["total_late_fees"] > 0
+    assert report["total_late_fees"] == 1.50  # 6 days * $0.25
     assert len(report["borrows"]) == 1
 
 
-def test_patron_report_with_multiple_returned_books(monkeypatch):
+def test_patron_report_with_multiple_returned_books():
     """Test report with only returned books"""
-    class MockConnection:
-        def execute(self, query, params):
-            class MockResult:
-                def fetchall(self):
-                    return [
-                        {
-                            'id': 1,
-                            'book_id': 1,
-                            'title': 'Returned 1',
-                            'author': 'Author 1',
-                            'borrow_date': (datetime.now() - timedelta(days=30)).isoformat(),
-                            'due_date': (datetime.now() - timedelta(days=16)).isoformat(),
-                            'return_date': (datetime.now() - timedelta(days=14)).isoformat()
-                        },
-                        {
-                            'id': 2,
-                            'book_id': 2,
-                            'title': 'Returned 2',
-                            'author': 'Author 2',
-                            'borrow_date': (datetime.now() - timedelta(days=40)).isoformat(),
-                            'due_date': (datetime.now() - timedelta(days=26)).isoformat(),
-                            'return_date': (datetime.now() - timedelta(days=20)).isoformat()
-                        }
-                    ]
-            return MockResult()
-        def close(self):
-            pass
-    
-    monkeypatch.setattr('services.library_service.get_db_connection', lambda: MockConnection())
+    add_loan("777777", "9780000000701", "Returned 1", borrowed_days_ago=30, due_in_days=-16, returned_days_ago=14)
+    add_loan("777777", "9780000000702", "Returned 2", borrowed_days_ago=40, due_in_days=-26, returned_days_ago=20)
+
     report = get_patron_status_report("777777")
     
     assert len(report["borrows"]) == 2
+    assert report["borrowed_count"] == 0
+    assert report["total_late_fees"] == 2.00  # 2 days + 6 days at $0.25
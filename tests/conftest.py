@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from services import gateway_simulator
+
+
+@pytest.fixture(autouse=True)
+def isolated_database(tmp_path, monkeypatch):
+    """Point every test at its own freshly initialized database file."""
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'library.db'))
+    database.init_database()
+    database.run_migrations()
+    yield str(tmp_path / 'library.db')
+    database.close_pool()
+
+
+@pytest.fixture(autouse=True)
+def instant_payment_gateway(monkeypatch):
+    """Simulated gateway calls return at once instead of sleeping 0.3-0.5 s."""
+    monkeypatch.setattr(gateway_simulator, '_default', gateway_simulator.make_simulator('instant'))
+
+
+@pytest.fixture(autouse=True)
+def webhook_secret(monkeypatch):
+    """A webhook signing secret for the tests; the app refuses webhooks without one."""
+    secret = "whsec_test_12345"
+    monkeypatch.setenv('PAYMENT_WEBHOOK_SECRET', secret)
+    return secret
+
+
+@pytest.fixture
+def add_overdue_loan():
+    """Lend a new single-copy book that is `days_overdue` days past due; returns its id."""
+    def add(patron_id="100001", isbn="9500000000001", days_overdue=10):
+        database.insert_book("Title " + isbn, "Author", isbn, 1, 0)
+        book_id = database.get_book_by_isbn(isbn)['id']
+        due = datetime.now() - timedelta(days=days_overdue)
+        database.insert_borrow_record(patron_id, book_id, due - timedelta(days=14), due)
+        return book_id
+    return add
@@ -0,0 +1,142 @@
+"""
+Tests for the LRU cache and the book row cache built on it
+"""
+import pytest
+
+import database
+from cache import LRUCache
+from database import book_cache, get_book_by_id, get_book_by_isbn
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats()['evictions'] == 1
+
+
+def test_lru_entries_expire():
+    clock = FakeClock()
+    cache = LRUCache(maxsize=10, ttl=5, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2, expires_at=100)
+
+    clock.now = 6
+    assert cache.get('a') is None
+    assert cache.get('b') == 2
+
+    stats = cache.stats()
+    assert stats['expirations'] == 1
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['hit_rate'] == 0.5
+
+
+@pytest.fixture
+def book_id():
+    database.insert_book("Cached Book", "Author", "9780000000300", 2, 2)
+    return database.get_book_by_isbn("9780000000300")['id']
+
+
+def test_repeat_lookups_are_served_from_cache(book_id):
+    before = book_cache.stats()['hits']
+
+    get_book_by_id(book_id)
+    get_book_by_isbn("9780000000300")
+
+    assert book_cache.stats()['hits'] - before == 2
+
+
+def test_cached_rows_are_copies(book_id):
+    get_book_by_id(book_id)['title'] = "Mutated"
+    assert get_book_by_id(book_id)['title'] == "Cached Book"
+
+
+def test_availability_update_invalidates(book_id):
+    get_book_by_id(book_id)
+    database.update_book_availability(book_id, -1)
+    assert get_book_by_id(book_id)['available_copies'] == 1
+
+
+def test_borrow_and_return_invalidate(book_id):
+    from services.library_service import borrow_book_by_patron, return_book_by_patron
+
+    get_book_by_id(book_id)
+    borrow_book_by_patron("123456", book_id)
+    assert get_book_by_id(book_id)['available_copies'] == 1
+
+    return_book_by_patron("123456", book_id)
+    assert get_book_by_id(book_id)['available_copies'] == 2
+
+
+def test_writes_from_other_processes_are_detected(book_id, monkeypatch):
+    """A change committed outside this module is logged and evicts the changed row."""
+    monkeypatch.setattr(book_cache, 'version_check', 0)
+    get_book_by_id(book_id)
+
+    # Another process writing to the same file: bypasses this module entirely
+    import sqlite3
+    other = sqlite3.connect(database.DATABASE)
+    other.execute("UPDATE books SET title = 'Renamed' WHERE id = ?", (book_id,))
+    other.commit()
+    other.close()
+
+    assert get_book_by_id(book_id)['title'] == "Renamed"
+    assert book_cache.stats()['row_invalidations'] >= 1
+
+
+def test_borrow_keeps_unrelated_rows_cached(book_id, monkeypatch):
+    """A borrow evicts only the borrowed book, here and in other processes."""
+    from services.library_service import borrow_book_by_patron
+
+    monkeypatch.setattr(book_cache, 'version_check', 0)
+    database.insert_book("Bystander", "Author", "9780000000302", 1, 1)
+    other_id = get_book_by_isbn("9780000000302")['id']
+    get_book_by_id(book_id)
+    get_book_by_id(other_id)
+    resets = book_cache.stats()['version_resets']
+
+    borrow_book_by_patron("123456", book_id)
+    hits = book_cache.stats()['hits']
+    assert get_book_by_id(other_id)['title'] == "Bystander"
+    assert book_cache.stats()['hits'] == hits + 1
+
+    # The same borrow as seen by a second process's cache
+    import sqlite3
+    other = sqlite3.connect(database.DATABASE)
+    other.execute("UPDATE books SET available_copies = available_copies + 1 WHERE id = ?", (book_id,))
+    other.commit()
+    other.close()
+
+    hits = book_cache.stats()['hits']
+    assert get_book_by_id(other_id)['title'] == "Bystander"
+    assert get_book_by_id(book_id)['available_copies'] == 2
+    assert book_cache.stats()['hits'] == hits + 1
+    assert book_cache.stats()['version_resets'] == resets
+
+
+def test_uncommitted_reads_are_not_cached(book_id):
+    """Rows seen inside a unit of work that later rolls back never reach the cache."""
+    from app import create_app
+    app = create_app()
+
+    with pytest.raises(RuntimeError):
+        with app.app_context():
+            database.insert_book("Phantom", "Author", "9780000000301", 1, 1)
+            assert get_book_by_isbn("9780000000301") is not None
+            raise RuntimeError("roll back")
+
+    assert get_book_by_isbn("9780000000301") is None
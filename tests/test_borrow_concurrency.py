@@ -0,0 +1,31 @@
+"""
+Concurrency tests for the single-transaction borrow path
+"""
+import database
+from benchmarks.borrow_stress import run_borrow_stress
+from services.library_service import borrow_book_by_patron
+
+
+def test_concurrent_borrows_never_oversell():
+    """Threads racing for a handful of copies claim each copy exactly once."""
+    result = run_borrow_stress(threads=8, books=2, copies=3, attempts=10)
+
+    assert result['min_available_copies'] == 0
+    assert result['borrows'] == 6
+    assert result['consistent']
+
+
+def test_loan_limit_is_enforced_in_the_same_transaction():
+    """The sixth-and-beyond rule holds when the limit check runs in SQL."""
+    database.insert_book("Limit Book", "Author", "9781111111111", 10, 10)
+    book_id = database.get_book_by_isbn("9781111111111")['id']
+
+    results = [borrow_book_by_patron("999999", book_id)[0] for _ in range(8)]
+
+    assert results.count(True) == database.BORROW_LIMIT + 1
+    assert database.get_book_by_id(book_id)['available_copies'] == 10 - results.count(True)
+
+
+def test_claim_copy_query_uses_index():
+    """The loan-limit subquery inside the claim is served by an index."""
+    assert database.check_hot_query_plans()['claim_copy']['uses_index']
@@ -0,0 +1,112 @@
+"""
+Tests for the streaming catalog and borrow history exports
+"""
+import csv
+import io
+import json
+from datetime import datetime
+
+import cli
+import database
+from app import create_app
+from database import get_pool_stats, iter_all_books
+from services.catalog_export import encode_rows, export_books, export_borrow_records
+
+
+def seed_books(count):
+    for i in range(count):
+        database.insert_book(f"Export {i}", "Author", f"{9600000000000 + i}", 1, 1)
+
+
+def test_encode_rows_chunks_ndjson():
+    rows = ({'id': i, 'name': f"n{i}"} for i in range(5))
+
+    chunks = list(encode_rows(rows, 'ndjson', ('id', 'name'), chunk_rows=2))
+
+    assert len(chunks) == 3
+    lines = "".join(chunks).splitlines()
+    assert [json.loads(line) for line in lines][4] == {'id': 4, 'name': 'n4'}
+
+
+def test_encode_rows_csv_has_header_and_quoting():
+    rows = [{'id': 1, 'title': 'Comma, Title'}]
+
+    text = "".join(encode_rows(rows, 'csv', ('id', 'title')))
+
+    assert list(csv.reader(io.StringIO(text))) == [['id', 'title'], ['1', 'Comma, Title']]
+
+
+def test_iter_all_books_fetches_in_batches_and_releases_connection():
+    seed_books(12)
+
+    books = list(iter_all_books(fetch_size=5))
+
+    assert len(books) == 12
+    assert [b['id'] for b in books] == sorted(b['id'] for b in books)
+    assert get_pool_stats()['in_use'] == 0
+
+
+def test_abandoned_export_releases_connection():
+    seed_books(3)
+    rows = iter_all_books(fetch_size=1)
+    next(rows)
+    assert get_pool_stats()['in_use'] == 1
+
+    rows.close()
+
+    assert get_pool_stats()['in_use'] == 0
+
+
+def test_export_borrow_records_for_one_patron():
+    seed_books(2)
+    books = list(iter_all_books())
+    database.insert_borrow_record("111111", books[0]['id'], datetime(2025, 1, 1), datetime(2025, 1, 15))
+    database.insert_borrow_record("222222", books[1]['id'], datetime(2025, 1, 2), datetime(2025, 1, 16))
+
+    everyone = [json.loads(line) for line in "".join(export_borrow_records()).splitlines()]
+    one = [json.loads(line) for line in "".join(export_borrow_records('ndjson', "111111")).splitlines()]
+
+    assert len(everyone) == 2
+    assert len(one) == 1
+    assert one[0]['title'] == "Export 0"
+    assert one[0]['return_date'] is None
+
+
+def test_api_export_books_streams_csv():
+    seed_books(3)
+    client = create_app().test_client()
+
+    response = client.get('/api/export/books?format=csv')
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert len(rows) == 3
+    assert rows[0]['isbn'] == "9600000000000"
+
+
+def test_api_export_borrows_ndjson():
+    client = create_app().test_client()
+    client.post('/borrow', data={'patron_id': '333333', 'book_id': '1'})
+    response = client.get('/api/export/borrows?patron_id=333333')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=borrow_records.ndjson'
+
+
+def test_api_export_rejects_unknown_format():
+    client = create_app().test_client()
+    assert client.get('/api/export/books?format=xml').status_code == 400
+
+
+def test_cli_export_books_to_file(tmp_path):
+    seed_books(2)
+    output = tmp_path / "books.ndjson"
+
+    status = cli.main(['--database', database.DATABASE, 'export-books', '-o', str(output)])
+
+    assert status == 0
+    assert len(output.read_text().splitlines()) == 2
+    assert "".join(export_books()) == output.read_text()
@@ -0,0 +1,150 @@
+"""
+Tests for the streaming bulk catalog import (service, CLI and API)
+"""
+import csv
+import io
+import json
+
+import pytest
+
+import cli
+import database
+from app import create_app
+from services.catalog_import import import_books
+
+
+def make_csv(rows):
+    out = io.StringIO()
+    out.write("title,author,isbn,total_copies\n")
+    for row in rows:
+        out.write(",".join(str(v) for v in row) + "\n")
+    out.seek(0)
+    return out
+
+
+def book_count():
+    conn = database.get_db_connection()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_csv_import_inserts_valid_rows_in_batches():
+    rows = [(f"Book {i}", "Author", f"{9000000000000 + i}", 2) for i in range(25)]
+    before = book_count()
+
+    report = import_books(make_csv(rows), 'csv', batch_size=10)
+
+    assert report['processed'] == 25
+    assert report['inserted'] == 25
+    assert report['rejected'] == 0
+    assert report['batches'] == 3
+    assert book_count() == before + 25
+    book = database.get_book_by_isbn("9000000000007")
+    assert book['title'] == "Book 7"
+    assert book['available_copies'] == 2
+
+
+def test_import_applies_r1_validation():
+    rows = [
+        ("", "Author", "9100000000001", 1),           # missing title
+        ("Title", "Author", "123", 1),                # short ISBN
+        ("Title", "Author", "9100000000003", 0),      # no copies
+        ("Title", "Author", "9100000000004", "abc"),  # not an integer
+        ("Good", "Author", "9100000000005", 1),
+    ]
+
+    report = import_books(make_csv(rows), 'csv')
+
+    assert report['inserted'] == 1
+    assert report['rejected'] == 4
+    assert [e['line'] for e in report['errors']] == [2, 3, 4, 5]
+    assert report['errors'][1]['error'] == "ISBN must be exactly 13 digits."
+
+
+def test_duplicate_isbns_rejected_against_db_and_within_file():
+    existing_isbn = "9200000000000"
+    database.insert_book("Existing", "Author", existing_isbn, 1, 1)
+    rows = [
+        ("Again", "Author", existing_isbn, 1),
+        ("First", "Author", "9200000000001", 1),
+        ("Second", "Author", "9200000000001", 1),
+    ]
+
+    report = import_books(make_csv(rows), 'csv')
+
+    assert report['inserted'] == 1
+    assert report['rejected'] == 2
+    assert database.get_book_by_isbn("9200000000001")['title'] == "First"
+
+
+def test_jsonl_import_reports_malformed_lines():
+    stream = io.StringIO(
+        json.dumps({"title": "Json Book", "author": "A", "isbn": "9300000000001", "total_copies": 3}) + "\n"
+        "{not json\n"
+        "\n"
+        "[1, 2]\n"
+    )
+
+    report = import_books(stream, 'jsonl')
+
+    assert report['inserted'] == 1
+    assert report['rejected'] == 2
+    assert database.get_book_by_isbn("9300000000001")['total_copies'] == 3
+
+
+def test_csv_missing_columns_rejected():
+    report = import_books(io.StringIO("title,author\nA,B\n"), 'csv')
+    assert report['inserted'] == 0
+    assert "Missing CSV column(s): isbn, total_copies." in report['errors'][0]['error']
+
+
+def test_unknown_format_raises():
+    with pytest.raises(ValueError):
+        import_books(io.StringIO(""), 'xml')
+
+
+def test_cli_writes_error_file(tmp_path, capsys):
+    source = tmp_path / "books.csv"
+    source.write_text("title,author,isbn,total_copies\nCli Book,A,9400000000001,1\nBad,A,1,1\n")
+    errors = tmp_path / "errors.csv"
+
+    status = cli.main(['--database', database.DATABASE, 'import-books', str(source), '--errors', str(errors)])
+
+    assert status == 1
+    assert json.loads(capsys.readouterr().out)['inserted'] == 1
+    with open(errors, newline='') as f:
+        rejected = list(csv.DictReader(f))
+    assert rejected == [{'line': '3', 'error': "ISBN must be exactly 13 digits.",
+                         'title': 'Bad', 'author': 'A', 'isbn': '1', 'total_copies': '1'}]
+    assert database.get_book_by_isbn("9400000000001") is not None
+
+
+def test_api_import_multipart_upload():
+    client = create_app().test_client()
+    data = b"title,author,isbn,total_copies\nApi Book,A,9500000000001,4\n"
+
+    response = client.post('/api/books/import',
+                           data={'file': (io.BytesIO(data), 'books.csv')},
+                           content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    assert response.get_json()['inserted'] == 1
+    assert database.get_book_by_isbn("9500000000001")['total_copies'] == 4
+
+
+def test_api_import_raw_jsonl_body():
+    client = create_app().test_client()
+    body = json.dumps({"title": "Raw", "author": "A", "isbn": "9500000000002", "total_copies": 1}) + "\n"
+
+    response = client.post('/api/books/import?format=jsonl', data=body, content_type='application/x-ndjson')
+
+    assert response.status_code == 200
+    assert response.get_json()['inserted'] == 1
+
+
+def test_api_import_rejects_unknown_format():
+    client = create_app().test_client()
+    response = client.post('/api/books/import?format=xml', data=b"")
+    assert response.status_code == 400
@@ -0,0 +1,71 @@
+"""
+Tests for keyset pagination of the catalog
+"""
+import pytest
+
+import database
+from app import create_app
+from database import get_books_page
+from services.library_service import get_catalog_page
+
+
+@pytest.fixture
+def books():
+    # Duplicate titles make sure the id tie-breaker is part of the key
+    titles = ["Beta", "Alpha", "Gamma", "Alpha", "Delta", "Beta", "Epsilon"]
+    for i, title in enumerate(titles):
+        database.insert_book(title, "Author", f"97800000002{i:02d}", 1, 1)
+    return sorted((title, database.get_book_by_isbn(f"97800000002{i:02d}")['id'])
+                  for i, title in enumerate(titles))
+
+
+def test_pages_cover_catalog_in_title_order(books):
+    """Following next cursors visits every book exactly once, in order."""
+    seen, after = [], None
+    while True:
+        page = get_catalog_page(after=after, limit=3)
+        seen.extend((b['title'], b['id']) for b in page['books'])
+        if not page['next_cursor']:
+            break
+        after = page['next_cursor']
+
+    assert seen == books
+
+
+def test_previous_cursor_returns_to_earlier_page(books):
+    first = get_catalog_page(limit=3)
+    second = get_catalog_page(after=first['next_cursor'], limit=3)
+    back = get_catalog_page(before=second['prev_cursor'], limit=3)
+
+    assert first['prev_cursor'] is None
+    assert back['books'] == first['books']
+    assert back['prev_cursor'] is None
+    assert back['next_cursor'] is not None
+
+
+def test_last_page_has_no_next_cursor(books):
+    page = get_books_page(after_title=books[-2][0], after_id=books[-2][1], limit=3)
+    assert [(b['title'], b['id']) for b in page['books']] == books[-1:]
+    assert page['has_more'] is False
+
+
+def test_malformed_cursor_starts_from_first_page(books):
+    page = get_catalog_page(after="not-a-cursor", limit=2)
+    assert [(b['title'], b['id']) for b in page['books']] == books[:2]
+
+
+def test_page_queries_use_title_index():
+    plans = database.check_hot_query_plans()
+    assert plans['books_page_after']['uses_index']
+    assert plans['books_page_before']['uses_index']
+
+
+def test_catalog_api_and_page_links(books):
+    client = create_app().test_client()
+
+    data = client.get('/api/catalog?limit=2').get_json()
+    assert data['count'] == 2
+    assert data['prev_cursor'] is None
+
+    html = client.get(f"/catalog?after={data['next_cursor']}").get_data(as_text=True)
+    assert 'Previous' in html
@@ -0,0 +1,111 @@
+"""
+Tests for the pooled connections handed out by database.get_db_connection
+"""
+import threading
+
+import pytest
+
+import database
+from database import ConnectionPool, PoolTimeoutError, get_db_connection, get_pool_stats
+
+
+def test_closed_connection_is_reused():
+    """Closing a connection returns it to the pool instead of opening a new one."""
+    conn = get_db_connection()
+    raw = conn._conn
+    conn.close()
+
+    again = get_db_connection()
+    assert again._conn is raw
+    again.close()
+
+    stats = get_pool_stats()
+    assert stats['connections_created'] == 1
+    assert stats['in_use'] == 0
+    assert stats['idle'] == 1
+
+
+def test_helpers_share_one_connection():
+    """A borrow-style sequence of helper calls reuses the same pooled connection."""
+    database.insert_book("Pool Book", "Author", "1111111111111", 2, 2)
+    book = database.get_book_by_isbn("1111111111111")
+    database.get_patron_borrow_count("123456")
+    database.update_book_availability(book['id'], -1)
+
+    assert database.get_book_by_id(book['id'])['available_copies'] == 1
+    assert get_pool_stats()['connections_created'] == 1
+
+
+def test_pool_times_out_when_exhausted(tmp_path):
+    """Callers wait for a free connection and give up after the timeout."""
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=1, timeout=0.05)
+    held = pool.acquire()
+
+    with pytest.raises(PoolTimeoutError):
+        pool.acquire()
+
+    held.close()
+    stats = pool.stats()
+    assert stats['timeouts'] == 1
+    assert stats['waits'] == 1
+    pool.close()
+
+
+def test_waiting_caller_gets_released_connection(tmp_path):
+    """A checkin wakes up a caller blocked on a full pool."""
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=1, timeout=5)
+    held = pool.acquire()
+    acquired = []
+
+    def worker():
+        conn = pool.acquire()
+        acquired.append(conn)
+        conn.close()
+
+    t = threading.Thread(target=worker)
+    t.start()
+    held.close()
+    t.join(timeout=5)
+
+    assert len(acquired) == 1
+    assert pool.stats()['connections_created'] == 1
+    pool.close()
+
+
+def test_uncommitted_work_is_rolled_back_on_checkin():
+    """A connection is handed back clean even if the holder forgot to commit."""
+    conn = get_db_connection()
+    conn.execute(
+        "INSERT INTO books (title, author, isbn, total_copies, available_copies) "
+        "VALUES ('Ghost', 'Nobody', '2222222222222', 1, 1)"
+    )
+    conn.close()
+
+    assert database.get_book_by_isbn("2222222222222") is None
+
+
+def test_unhealthy_connection_is_replaced(tmp_path):
+    """Idle connections failing the health check are swapped for fresh ones."""
+    pool = ConnectionPool(str(tmp_path / 'pool.db'), size=1, health_check_interval=0)
+    conn = pool.acquire()
+    raw = conn._conn
+    conn.close()
+    raw.close()  # simulate a connection that died while idle
+
+    fresh = pool.acquire()
+    assert fresh._conn is not raw
+    assert fresh.execute('SELECT 1').fetchone()[0] == 1
+    fresh.close()
+
+    assert pool.stats()['health_check_failures'] == 1
+    pool.close()
+
+
+def test_closed_proxy_cannot_be_used():
+    """Using a connection after close() fails instead of touching a pooled one."""
+    conn = get_db_connection()
+    conn.close()
+    conn.close()  # idempotent
+
+    with pytest.raises(Exception):
+        conn.execute('SELECT 1')
@@ -0,0 +1,52 @@
+"""
+Tests for the late_fee() SQL function and the fee queries built on it
+"""
+
+import database
+from services.fee_policy import late_fee_for_days
+
+
+def test_late_fee_function_matches_python_policy():
+    conn = database.get_db_connection()
+    try:
+        for days in [None, -3, 0, 1, 7, 8, 20, 31, 32, 365]:
+            assert conn.execute("SELECT late_fee(?)", (days,)).fetchone()[0] == late_fee_for_days(days)
+    finally:
+        conn.close()
+
+
+def test_late_fee_is_registered_as_deterministic():
+    """Deterministic functions may be used in index expressions."""
+    conn = database.get_db_connection()
+    try:
+        conn.execute("CREATE TABLE fee_probe (days INTEGER)")
+        conn.execute("CREATE INDEX idx_fee_probe ON fee_probe (late_fee(days))")
+        conn.rollback()
+    finally:
+        conn.close()
+
+
+def test_days_overdue_is_integer_day_arithmetic():
+    conn = database.get_db_connection()
+    try:
+        row = conn.execute(
+            f"SELECT {database.DAYS_OVERDUE_SQL} AS open_loan "
+            "FROM (SELECT 20000 AS due_day, NULL AS return_day) br",
+            {'today': 20009},
+        ).fetchone()
+    finally:
+        conn.close()
+    assert row['open_loan'] == 9
+
+
+def test_get_patrons_owing_filters_in_sql(add_overdue_loan):
+    add_overdue_loan("100001", "9700000000001", 2)    # $0.50
+    add_overdue_loan("100002", "9700000000002", 10)   # $3.25
+    add_overdue_loan("100002", "9700000000003", 60)   # $15.00
+    add_overdue_loan("100003", "9700000000004", 20)   # $8.25
+
+    owing = database.get_patrons_owing(min_fee=1.00)
+
+    assert [p['patron_id'] for p in owing] == ["100002", "100003"]
+    assert owing[0]['total_late_fees'] == 18.25
+    assert owing[0]['borrowed_count'] == 2
@@ -0,0 +1,164 @@
+"""
+Tests for the materialized fines ledger and its daily update job
+"""
+import json
+from datetime import datetime, timedelta
+
+import cli
+import database
+from services.fee_policy import late_fee_for_days
+from services.library_service import (
+    calculate_late_fee_for_book, get_patron_status_report, return_book_by_patron)
+
+
+def add_loan(patron_id, isbn, days_overdue, returned=False):
+    database.insert_book("Title " + isbn, "Author", isbn, 1, 0)
+    book_id = database.get_book_by_isbn(isbn)['id']
+    due = datetime.now() - timedelta(days=days_overdue)
+    database.insert_borrow_record(patron_id, book_id, due - timedelta(days=14), due)
+    if returned:
+        database.update_borrow_record_return_date(patron_id, book_id, datetime.now())
+    return book_id
+
+
+def ledger():
+    conn = database.get_db_connection()
+    try:
+        rows = conn.execute('SELECT * FROM fines ORDER BY loan_id').fetchall()
+    finally:
+        conn.close()
+    return {row['book_id']: dict(row) for row in rows}
+
+
+def test_first_run_builds_ledger_from_history():
+    capped = add_loan("100001", "9700000000001", 40)
+    open_loan = add_loan("100001", "9700000000002", 3)
+    returned = add_loan("100002", "9700000000003", 10, returned=True)
+    add_loan("100003", "9700000000004", 0)  # due today, owes nothing yet
+
+    result = database.update_fines_ledger()
+
+    assert result['full_rebuild'] and not result['skipped']
+    assert (result['loans_updated'], result['loans_finalized']) == (2, 1)
+    rows = ledger()
+    assert {book_id: (row['fee_amount'], row['final']) for book_id, row in rows.items()} == {
+        capped: (15.00, 0), open_loan: (0.75, 0), returned: (3.25, 1)}
+
+
+def test_second_run_on_same_day_is_skipped():
+    add_loan("100001", "9700000000001", 3)
+    database.update_fines_ledger()
+
+    result = database.update_fines_ledger()
+
+    assert result['skipped']
+    assert result['loans_updated'] == 0
+
+
+def test_incremental_run_only_touches_changed_loans():
+    today = database.today_epoch_day()
+    capped = add_loan("100001", "9700000000001", 40)
+    growing = add_loan("100001", "9700000000002", 3)
+    due_today = add_loan("100002", "9700000000003", 0)
+    database.update_fines_ledger(today - 1)
+
+    result = database.update_fines_ledger(today)
+    assert not result['full_rebuild']
+    assert result['previous_run_day'] == today - 1
+    assert result['loans_updated'] == 1  # the capped loan is not rewritten
+    assert ledger()[growing]['fee_amount'] == 0.75
+
+    result = database.update_fines_ledger(today + 1)
+    assert result['loans_updated'] == 2  # plus the loan that has just become overdue
+    rows = ledger()
+    assert rows[due_today]['fee_amount'] == 0.25
+    assert rows[capped]['fee_day'] == today - 1
+
+
+def test_return_finalizes_ledger_row():
+    book_id = add_loan("100001", "9700000000001", 5)
+    database.update_fines_ledger()
+
+    success, _ = return_book_by_patron("100001", book_id)
+
+    assert success
+    row = ledger()[book_id]
+    assert (row['fee_amount'], row['final']) == (1.25, 1)
+    assert row['fee_day'] == database.today_epoch_day()
+
+
+def test_job_finalizes_loans_returned_outside_the_service():
+    book_id = add_loan("100001", "9700000000001", 5)
+    database.update_fines_ledger(database.today_epoch_day() - 1)
+    conn = database.get_db_connection()
+    try:
+        conn.execute("UPDATE borrow_records SET return_date = ? WHERE book_id = ?",
+                     (datetime.now().isoformat(), book_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+    result = database.update_fines_ledger()
+
+    assert result['loans_finalized'] == 1
+    assert ledger()[book_id]['final'] == 1
+
+
+def test_service_reads_match_live_fees():
+    open_loan = add_loan("100001", "9700000000001", 12)
+    returned = add_loan("100001", "9700000000002", 4, returned=True)
+    live = (calculate_late_fee_for_book("100001", open_loan),
+            calculate_late_fee_for_book("100001", returned),
+            get_patron_status_report("100001"))
+
+    database.update_fines_ledger()
+
+    assert (calculate_late_fee_for_book("100001", open_loan),
+            calculate_late_fee_for_book("100001", returned),
+            get_patron_status_report("100001")) == live
+    assert live[2]['total_late_fees'] == late_fee_for_days(12) + late_fee_for_days(4)
+
+
+def test_service_uses_ledger_only_when_current():
+    book_id = add_loan("100001", "9700000000001", 12)
+    database.update_fines_ledger(database.today_epoch_day() - 1)
+    conn = database.get_db_connection()
+    try:
+        conn.execute("UPDATE fines SET fee_amount = 9.99")
+        conn.commit()
+    finally:
+        conn.close()
+
+    assert calculate_late_fee_for_book("100001", book_id)['fee_amount'] == late_fee_for_days(12)
+
+    database.update_fines_ledger()
+    conn = database.get_db_connection()
+    try:
+        conn.execute("UPDATE fines SET fee_amount = 9.99")
+        conn.commit()
+    finally:
+        conn.close()
+
+    assert calculate_late_fee_for_book("100001", book_id)['fee_amount'] == 9.99
+    assert get_patron_status_report("100001")['total_late_fees'] == 9.99
+
+
+def test_ledger_stats():
+    assert database.get_fines_ledger_stats() == {
+        'last_run_day': None, 'current': False, 'last_loans_updated': None, 'rows': 0}
+    add_loan("100001", "9700000000001", 3)
+    database.update_fines_ledger()
+
+    stats = database.get_fines_ledger_stats()
+
+    assert stats['current'] and stats['rows'] == 1
+    assert stats['last_run_day'] == datetime.now().date().isoformat()
+
+
+def test_cli_update_fines(capsys):
+    add_loan("100001", "9700000000001", 3)
+
+    status = cli.main(['--database', database.DATABASE, 'update-fines'])
+
+    assert status == 0
+    assert json.loads(capsys.readouterr().out)['loans_updated'] == 1
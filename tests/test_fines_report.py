@@ -0,0 +1,107 @@
+"""
+Tests for the library-wide overdue fines report
+"""
+import json
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import cli
+import database
+from app import create_app
+from services import fines_report
+from services.fee_policy import late_fee_for_days
+from services.fines_report import compute_fees, overdue_report
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def engine(request, monkeypatch):
+    """Run a test with NumPy and again with the pure-Python fallback."""
+    if request.param == 'python':
+        monkeypatch.setattr(fines_report, 'np', None)
+    elif fines_report.np is None:
+        pytest.skip("NumPy is not installed")
+    return request.param
+
+
+def add_loan(patron_id, isbn, days_overdue, returned=False):
+    database.insert_book("Title " + isbn, "Author", isbn, 1, 0)
+    book_id = database.get_book_by_isbn(isbn)['id']
+    due = datetime.now() - timedelta(days=days_overdue)
+    database.insert_borrow_record(patron_id, book_id, due - timedelta(days=14), due)
+    if returned:
+        database.update_borrow_record_return_date(patron_id, book_id, datetime.now())
+    return book_id
+
+
+@pytest.fixture
+def loans():
+    add_loan("100001", "9800000000001", 3)     # $0.75
+    add_loan("100001", "9800000000002", 40)    # $15.00 (capped)
+    add_loan("100002", "9800000000003", 10)    # $3.25
+    add_loan("100003", "9800000000004", 0)     # due today, not overdue
+    add_loan("100004", "9800000000005", 30, returned=True)
+
+
+def test_compute_fees_matches_policy(engine):
+    days = list(range(-2, 45))
+    assert [float(f) for f in compute_fees(days)] == [late_fee_for_days(d) for d in days]
+
+
+def test_report_lists_overdue_loans_by_fee(engine, loans):
+    report = overdue_report()
+
+    assert report['engine'] == engine
+    assert report['overdue_loans'] == 3
+    assert report['patrons'] == 2
+    assert report['total_fees'] == 19.00
+    assert [(l['patron_id'], l['days_overdue'], l['fee_amount']) for l in report['loans']] == [
+        ("100001", 40, 15.00), ("100002", 10, 3.25), ("100001", 3, 0.75)]
+    assert report['loans'][0]['title'] == "Title 9800000000002"
+
+
+def test_report_sort_and_top(engine, loans):
+    report = overdue_report(sort='patron', top=2)
+    assert [l['patron_id'] for l in report['loans']] == ["100001", "100001"]
+    assert report['overdue_loans'] == 3  # totals still cover every loan
+
+
+def test_report_per_patron_totals(engine, loans):
+    report = overdue_report(by_patron=True)
+
+    assert report['patrons_owing'] == [
+        {'patron_id': "100001", 'overdue_loans': 2, 'total_fees': 15.75, 'max_days_overdue': 40},
+        {'patron_id': "100002", 'overdue_loans': 1, 'total_fees': 3.25, 'max_days_overdue': 10},
+    ]
+
+
+def test_report_as_of_date(engine, loans):
+    report = overdue_report(as_of=date.today() + timedelta(days=1))
+    assert report['overdue_loans'] == 4
+    assert report['as_of'] == (date.today() + timedelta(days=1)).isoformat()
+
+
+def test_empty_report(engine):
+    report = overdue_report(by_patron=True)
+    assert report['overdue_loans'] == 0
+    assert report['total_fees'] == 0.0
+    assert report['patrons_owing'] == []
+
+
+def test_api_overdue_report(loans):
+    client = create_app().test_client()
+
+    response = client.get('/api/reports/overdue?group=patron&top=1')
+
+    assert response.status_code == 200
+    assert response.get_json()['patrons_owing'][0]['patron_id'] == "100001"
+    assert client.get('/api/reports/overdue?sort=title').status_code == 400
+    assert client.get('/api/reports/overdue?as_of=tomorrow').status_code == 400
+
+
+def test_cli_overdue_report(loans, capsys):
+    status = cli.main(['--database', database.DATABASE, 'overdue-report', '--sort', 'days', '--top', '1'])
+
+    assert status == 0
+    report = json.loads(capsys.readouterr().out)
+    assert [l['days_overdue'] for l in report['loans']] == [40]
@@ -0,0 +1,139 @@
+"""
+Tests for the full-text catalog search index
+"""
+import pytest
+
+import database
+from database import search_books
+from services.library_service import search_books_in_catalog
+
+
+@pytest.fixture
+def books():
+    titles = [
+        ("The Hobbit", "J.R.R. Tolkien"),
+        ("The Fellowship of the Ring", "J.R.R. Tolkien"),
+        ("The Two Towers", "J.R.R. Tolkien"),
+        ("Hobbit Recipes", "Someone Else"),
+        ("Don't Panic: A \"Guide\"", "Neil Gaiman"),
+    ]
+    for i, (title, author) in enumerate(titles):
+        database.insert_book(title, author, f"97800000001{i:02d}", 1, 1)
+
+
+def test_fts_index_is_created_by_migration():
+    conn = database.get_db_connection()
+    try:
+        assert database.fts_available(conn)
+    finally:
+        conn.close()
+
+
+def test_index_follows_inserts_updates_and_deletes(books):
+    """Triggers keep books_fts in sync with the books table."""
+    book = database.get_book_by_isbn("9780000000100")
+    conn = database.get_db_connection()
+    try:
+        conn.execute("UPDATE books SET title = 'There and Back Again' WHERE id = ?", (book['id'],))
+        conn.execute("DELETE FROM books WHERE isbn = '9780000000103'")
+        conn.commit()
+    finally:
+        conn.close()
+
+    assert search_books("hobbit", "title") == []
+    assert [b['id'] for b in search_books("back again", "title")] == [book['id']]
+
+
+def test_availability_changes_do_not_touch_the_index(books):
+    """Borrow/return updates to available_copies leave search results intact."""
+    book = database.get_book_by_isbn("9780000000101")
+    database.update_book_availability(book['id'], -1)
+
+    results = search_books("fellowship", "title")
+    assert [b['available_copies'] for b in results] == [0]
+
+
+def test_limit_and_offset_page_through_matches(books):
+    first = search_books_in_catalog("tolkien", "author", limit=2)
+    rest = search_books_in_catalog("tolkien", "author", limit=2, offset=2)
+
+    assert len(first) == 2
+    assert len(rest) == 1
+    assert {b['id'] for b in first}.isdisjoint(b['id'] for b in rest)
+
+
+def test_closer_matches_rank_first(books):
+    """bm25 ranking puts the shorter, more specific match ahead."""
+    results = search_books_in_catalog("hobbit", "title")
+    assert [b['title'] for b in results] == ["The Hobbit", "Hobbit Recipes"]
+
+
+def test_quotes_and_punctuation_are_matched_literally(books):
+    assert len(search_books_in_catalog('"guide"', "title")) == 1
+    assert len(search_books_in_catalog("don't", "title")) == 1
+
+
+def test_short_terms_fall_back_to_like(books):
+    """Terms shorter than a trigram still find substring matches."""
+    results = search_books_in_catalog("Tw", "title")
+    assert [b['title'] for b in results] == ["The Two Towers"]
+
+
+def test_search_without_fts5_falls_back_to_like(books, monkeypatch):
+    """Databases without the FTS index return the same matches ordered by title."""
+    monkeypatch.setattr(database, 'fts_available', lambda conn: False)
+
+    results = search_books_in_catalog("HOBBIT", "title")
+    assert [b['title'] for b in results] == ["Hobbit Recipes", "The Hobbit"]
+    assert search_books_in_catalog("100%", "title") == []
+
+
+def test_api_search_supports_paging(books):
+    from app import create_app
+    client = create_app().test_client()
+
+    response = client.get('/api/search?q=tolkien&type=author&limit=1&offset=1')
+
+    data = response.get_json()
+    assert response.status_code == 200
+    assert data['count'] == 1
+    assert data['offset'] == 1
+
+
+def test_search_page_links_to_the_next_and_previous_pages(books):
+    from app import create_app
+    client = create_app().test_client()
+
+    first = client.get('/search?q=tolkien&type=author&limit=2').get_data(as_text=True)
+    last = client.get('/search?q=tolkien&type=author&limit=2&offset=2').get_data(as_text=True)
+
+    assert first.count('name="book_id"') == 2
+    assert 'offset=2' in first and 'Next' in first and 'Previous' not in first
+    assert last.count('name="book_id"') == 1
+    assert 'offset=0' in last and 'Previous' in last and 'Next' not in last
+
+
+def test_search_page_links_past_a_full_page_at_the_maximum_limit():
+    from app import create_app
+    for i in range(database.SEARCH_MAX_LIMIT + 1):
+        database.insert_book(f"Series Volume {i:03d}", "Author", f"97810000{i:05d}", 1, 1)
+    client = create_app().test_client()
+
+    page = client.get(f'/search?q=series&type=title&limit={database.SEARCH_MAX_LIMIT}').get_data(as_text=True)
+    rest = client.get(f'/search?q=series&type=title&limit={database.SEARCH_MAX_LIMIT}'
+                      f'&offset={database.SEARCH_MAX_LIMIT}').get_data(as_text=True)
+
+    assert page.count('name="book_id"') == database.SEARCH_MAX_LIMIT
+    assert f'offset={database.SEARCH_MAX_LIMIT}' in page and 'Next' in page
+    assert rest.count('name="book_id"') == 1
+
+
+@pytest.mark.parametrize('requested, used', [(0, 1), (10000, database.SEARCH_MAX_LIMIT)])
+def test_api_search_reports_the_limit_it_used(books, requested, used):
+    from app import create_app
+    client = create_app().test_client()
+
+    data = client.get(f'/api/search?q=tolkien&type=author&limit={requested}').get_json()
+
+    assert data['limit'] == used
+    assert data['count'] == min(used, 3)
@@ -0,0 +1,138 @@
+"""
+Tests for the configurable payment gateway simulator
+"""
+import statistics
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from benchmarks.payment_path import run_payment_benchmark
+from cache import LRUCache
+from services import gateway_simulator, payment_service
+from services.gateway_simulator import (
+    FixedLatency, GatewaySimulator, LognormalLatency, SimulatedGatewayError, SpikyLatency, make_simulator)
+from services.library_service import pay_late_fees
+from services.payment_service import PaymentGateway
+
+
+def recording_simulator(**options):
+    sleeps = []
+    return GatewaySimulator(sleep=sleeps.append, **options), sleeps
+
+
+def test_classic_profile_keeps_original_delays():
+    simulator = make_simulator('classic')
+    sleeps = []
+    simulator._sleep = sleeps.append
+    gateway = PaymentGateway(simulator=simulator)
+
+    gateway.process_payment("123456", 5.00)
+    gateway.refund_payment("txn_123456_1", 5.00)
+    gateway.verify_payment_status("txn_123456_1")
+
+    assert sleeps == [0.5, 0.5, 0.3]
+
+
+def test_simulated_charge_history_is_bounded(monkeypatch):
+    monkeypatch.setattr(payment_service, '_simulated_charges', LRUCache(2))
+    gateway = PaymentGateway()
+    ids = [gateway.process_payment("123456", amount)[1] for amount in (1.00, 2.00, 3.00)]
+
+    assert payment_service._simulated_charges.stats()['evictions'] == 1
+    assert [gateway.verify_payment_status(t).get('amount') for t in ids] == [None, 2.00, 3.00]
+
+
+def test_tests_use_the_instant_profile():
+    started = time.perf_counter()
+    for _ in range(20):
+        assert PaymentGateway().process_payment("123456", 5.00)[0]
+    assert time.perf_counter() - started < 0.5
+
+
+def test_transaction_ids_are_unique():
+    gateway = PaymentGateway()
+
+    ids = {gateway.process_payment("123456", 5.00)[1] for _ in range(50)}
+
+    assert len(ids) == 50 and all(i.startswith("txn_123456_") for i in ids)
+
+
+def test_latency_models():
+    simulator, sleeps = recording_simulator(latency=FixedLatency(0.2),
+                                            operation_latency={'verify_payment_status': FixedLatency(0.05)})
+    simulator.delay('process_payment')
+    simulator.delay('verify_payment_status')
+    assert sleeps == [0.2, 0.05]
+
+    simulator, sleeps = recording_simulator(latency=LognormalLatency(0.1, 0.5), seed=7)
+    for _ in range(2000):
+        simulator.delay('process_payment')
+    assert statistics.median(sleeps) == pytest.approx(0.1, rel=0.1)
+    assert max(sleeps) > 0.25
+
+    simulator, sleeps = recording_simulator(
+        latency=SpikyLatency(FixedLatency(0.1), probability=0.05, spike=2.0), seed=7)
+    for _ in range(1000):
+        simulator.delay('process_payment')
+    spikes = [s for s in sleeps if s > 2]
+    assert 25 < len(spikes) < 80 and set(spikes) == {2.1}
+
+
+def test_lognormal_cap():
+    simulator, sleeps = recording_simulator(latency=LognormalLatency(1.0, 2.0, max_seconds=1.5), seed=1)
+    for _ in range(200):
+        simulator.delay('process_payment')
+    assert max(sleeps) == 1.5
+
+
+def test_throughput_cap_spaces_calls():
+    simulator, sleeps = recording_simulator(max_per_second=10, clock=lambda: 100.0)
+
+    for _ in range(4):
+        simulator.delay('process_payment')
+
+    assert sleeps == pytest.approx([0.1, 0.2, 0.3])      # the first call goes straight through
+    assert simulator.stats()['throttled_seconds'] == pytest.approx(0.6)
+
+
+def test_injected_errors_and_declines():
+    simulator, _ = recording_simulator(error_rate=1.0)
+    with pytest.raises(SimulatedGatewayError, match="during refund_payment"):
+        PaymentGateway(simulator=simulator).refund_payment("txn_123456_1", 5.00)
+
+    simulator, _ = recording_simulator(decline_rate=1.0)
+    gateway = PaymentGateway(simulator=simulator)
+    assert gateway.process_payment("123456", 5.00) == (False, "", "Payment declined by card issuer")
+    assert gateway.process_payment("123456", 0) == (False, "", "Invalid amount: must be greater than 0")
+    assert simulator.stats()['declines'] == 1
+
+
+def test_pay_late_fees_reports_simulated_outage():
+    database.insert_book("Title", "Author", "9900000000001", 1, 0)
+    book_id = database.get_book_by_isbn("9900000000001")['id']
+    due = datetime.now() - timedelta(days=10)
+    database.insert_borrow_record("123456", book_id, due - timedelta(days=14), due)
+    simulator, _ = recording_simulator(error_rate=1.0)
+
+    result = pay_late_fees("123456", book_id, PaymentGateway(simulator=simulator))
+
+    assert result == (False, "Payment processing error: Simulated gateway error during process_payment", None)
+
+
+def test_default_profile_from_environment(monkeypatch):
+    monkeypatch.setenv('PAYMENT_SIMULATOR', 'realistic')
+    gateway_simulator.set_default_simulator(None)
+
+    assert gateway_simulator.get_default_simulator().max_per_second == 50
+    with pytest.raises(ValueError, match="Unknown gateway simulator profile"):
+        make_simulator('fast')
+
+
+def test_payment_path_benchmark():
+    result = run_payment_benchmark(patrons=20, threads=4, profile='instant')
+
+    assert result['outcomes'] == {'pay ok': 20, 'refund ok': 20}
+    assert result['simulator']['calls'] == 40
+    assert set(result['pay']) == {'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'}
@@ -0,0 +1,100 @@
+"""
+Tests for the batch late fee API
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from app import create_app
+from services.library_service import calculate_late_fee_for_book, calculate_late_fees_for_books
+
+
+def add_loan(patron_id, book_id, days_overdue, returned=False):
+    due = datetime.now() - timedelta(days=days_overdue)
+    database.insert_borrow_record(patron_id, book_id, due - timedelta(days=14), due)
+    if returned:
+        database.update_borrow_record_return_date(patron_id, book_id, datetime.now())
+
+
+@pytest.fixture
+def books():
+    ids = []
+    for n in range(3):
+        isbn = f"950000000000{n}"
+        database.insert_book(f"Title {n}", "Author", isbn, 3, 0)
+        ids.append(database.get_book_by_isbn(isbn)['id'])
+    add_loan("100001", ids[0], 10)
+    add_loan("100001", ids[1], 40, returned=True)
+    add_loan("100001", ids[1], 2)                   # open loan wins over the returned one
+    add_loan("100002", ids[0], 5, returned=True)
+    add_loan("100002", ids[0], 1, returned=True)    # latest returned loan is used
+    return ids
+
+
+def pairs_for(ids):
+    return [("100001", ids[0]), ("100001", ids[1]), ("100002", ids[0]),
+            ("100003", ids[2]), ("100001", ids[0])]
+
+
+def test_batch_matches_single_lookups(books):
+    pairs = pairs_for(books)
+
+    results = calculate_late_fees_for_books(pairs)
+
+    assert [(r['patron_id'], r['book_id']) for r in results] == pairs
+    for result, (patron_id, book_id) in zip(results, pairs):
+        expected = calculate_late_fee_for_book(patron_id, book_id)
+        assert {k: result[k] for k in expected} == expected
+    assert [r['fee_amount'] for r in results] == [3.25, 0.5, 0.25, 0.0, 3.25]
+    assert results[3]['status'] == 'No borrow record found.'
+
+
+def test_batch_reads_ledger_when_current(books):
+    pairs = pairs_for(books)
+    live = calculate_late_fees_for_books(pairs)
+
+    database.update_fines_ledger()
+
+    assert calculate_late_fees_for_books(pairs) == live
+
+
+def test_batch_uses_one_connection(books):
+    before = database.get_pool_stats()['checkouts']
+
+    calculate_late_fees_for_books(pairs_for(books) * 20)
+
+    assert database.get_pool_stats()['checkouts'] - before == 1
+
+
+def test_batch_limit():
+    assert calculate_late_fees_for_books([]) == []
+    with pytest.raises(ValueError):
+        calculate_late_fees_for_books([("100001", 1)] * (database.LATE_FEE_BATCH_LIMIT + 1))
+
+
+def test_batch_api(books):
+    client = create_app().test_client()
+
+    response = client.post('/api/late_fee/batch', json={'loans': [
+        {'patron_id': "100001", 'book_id': books[0]}, {'patron_id': "100003", 'book_id': books[2]}]})
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['count'] == 2
+    result = body['results'][0]
+    assert result['loan_id'] is not None
+    assert result == {'patron_id': "100001", 'book_id': books[0], 'fee_amount': 3.25, 'amount_paid': 0.0,
+                      'days_overdue': 10, 'status': 'Overdue', 'loan_id': result['loan_id']}
+
+
+@pytest.mark.parametrize('body', [
+    None,
+    {'loans': 'all'},
+    {'loans': [{'patron_id': 100001, 'book_id': 1}]},
+    {'loans': [{'patron_id': "100001", 'book_id': "1"}]},
+    {'loans': [{'patron_id': "100001", 'book_id': 1}] * 501},
+])
+def test_batch_api_rejects_bad_bodies(body):
+    response = create_app().test_client().post('/api/late_fee/batch', json=body)
+    assert response.status_code == 400
@@ -0,0 +1,122 @@
+"""
+Tests for the midnight-expiring late fee response cache
+"""
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from app import create_app
+from cache import LRUCache
+from services import library_service
+from services.library_service import (
+    borrow_book_by_patron, get_cached_late_fee, return_book_by_patron, _next_midnight)
+
+
+@pytest.fixture
+def fee_cache(monkeypatch):
+    """A fresh cache per test, on a clock the test can move."""
+    clock = [time.time()]
+    cache = LRUCache(100, clock=lambda: clock[0])
+    monkeypatch.setattr(library_service, 'late_fee_cache', cache)
+    return cache, clock
+
+
+def test_next_midnight():
+    assert _next_midnight(datetime(2024, 3, 10, 23, 59, 59)) == datetime(2024, 3, 11).timestamp()
+    assert _next_midnight(datetime(2024, 12, 31, 0, 0)) == datetime(2025, 1, 1).timestamp()
+
+
+def test_repeated_lookups_are_served_from_cache(add_overdue_loan, fee_cache):
+    cache, _ = fee_cache
+    book_id = add_overdue_loan("123456", "9600000000001", 3)
+    first = get_cached_late_fee("123456", book_id)
+    checkouts = database.get_pool_stats()['checkouts']
+
+    second = get_cached_late_fee("123456", book_id)
+
+    assert second == first
+    assert (first['fee_amount'], first['days_overdue'], first['status']) == (0.75, 3, 'Overdue')
+    assert database.get_pool_stats()['checkouts'] == checkouts
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 1)
+
+
+def test_callers_cannot_modify_cached_entry(add_overdue_loan, fee_cache):
+    book_id = add_overdue_loan("123456", "9600000000001", 3)
+    get_cached_late_fee("123456", book_id)['fee_amount'] = 99.0
+
+    assert get_cached_late_fee("123456", book_id)['fee_amount'] == 0.75
+
+
+def test_entry_expires_at_midnight(add_overdue_loan, fee_cache):
+    cache, clock = fee_cache
+    book_id = add_overdue_loan("123456", "9600000000001", 3)
+    get_cached_late_fee("123456", book_id)
+
+    clock[0] = _next_midnight(datetime.now()) - 1
+    get_cached_late_fee("123456", book_id)
+    clock[0] += 1
+    get_cached_late_fee("123456", book_id)
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['expirations']) == (1, 1)
+
+
+def test_return_invalidates_entry(add_overdue_loan, fee_cache):
+    cache, _ = fee_cache
+    book_id = add_overdue_loan("123456", "9600000000001", 3)
+    database.update_book_availability(book_id, 0)
+    get_cached_late_fee("123456", book_id)
+
+    success, _ = return_book_by_patron("123456", book_id)
+
+    assert success
+    assert cache.stats()['invalidations'] == 1
+    assert get_cached_late_fee("123456", book_id)['fee_amount'] == 0.75
+
+
+def test_borrow_invalidates_entry(fee_cache):
+    database.insert_book("Title", "Author", "9600000000001", 1, 1)
+    book_id = database.get_book_by_isbn("9600000000001")['id']
+    assert get_cached_late_fee("123456", book_id)['status'] == 'No borrow record found.'
+
+    success, _ = borrow_book_by_patron("123456", book_id)
+
+    assert success
+    result = get_cached_late_fee("123456", book_id)
+    assert (result['fee_amount'], result['days_overdue'], result['status']) == (0.0, 0, 'On time')
+
+
+def test_changes_from_other_processes_evict_only_their_loan(add_overdue_loan, fee_cache, monkeypatch):
+    cache, _ = fee_cache
+    monkeypatch.setattr(library_service, 'LATE_FEE_CACHE_VERSION_CHECK', 0)
+    book_id = add_overdue_loan("123456", "9600000000001", 3)
+    other_book_id = add_overdue_loan("123456", "9600000000002", 5)
+    get_cached_late_fee("123456", book_id)
+    get_cached_late_fee("123456", other_book_id)
+
+    # Another process backdates the loan, bypassing this module entirely
+    import sqlite3
+    other = sqlite3.connect(database.DATABASE)
+    other.execute("UPDATE borrow_records SET due_date = ?, due_day = due_day - 7 WHERE book_id = ?",
+                  ((datetime.now() - timedelta(days=10)).isoformat(), book_id))
+    other.commit()
+    other.close()
+
+    assert get_cached_late_fee("123456", book_id)['fee_amount'] == 3.25
+    hits = cache.stats()['hits']
+    assert get_cached_late_fee("123456", other_book_id)['fee_amount'] == 1.25
+    assert cache.stats()['hits'] == hits + 1
+
+
+def test_api_uses_cache_and_reports_hit_rate(add_overdue_loan, fee_cache):
+    book_id = add_overdue_loan("123456", "9600000000001", 10)
+    client = create_app().test_client()
+
+    for _ in range(4):
+        response = client.get(f'/api/late_fee/123456/{book_id}')
+        assert response.get_json()['fee_amount'] == 3.25
+
+    stats = client.get('/api/metrics').get_json()['late_fee_cache']
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (3, 1, 0.75)
@@ -0,0 +1,103 @@
+"""
+Tests for versioned schema migrations and the hot-query index check
+"""
+from datetime import date, datetime
+
+import database
+from database import check_hot_query_plans, get_schema_version, run_migrations
+
+
+def test_migrations_are_recorded():
+    """The fixture database is fully migrated and each version is recorded."""
+    assert get_schema_version() == database.MIGRATIONS[-1][0]
+
+    conn = database.get_db_connection()
+    try:
+        versions = [r['version'] for r in conn.execute('SELECT version FROM schema_version ORDER BY version')]
+    finally:
+        conn.close()
+    assert versions == [m[0] for m in database.MIGRATIONS]
+
+
+def test_migrations_run_only_once():
+    """Running migrations again on an up-to-date database is a no-op."""
+    assert run_migrations() == []
+
+
+def test_fresh_database_is_migrated(tmp_path, monkeypatch):
+    """A brand new database picks up every migration in order."""
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'fresh.db'))
+    database.init_database()
+    assert get_schema_version() == 0
+
+    applied = run_migrations()
+
+    assert applied == [m[0] for m in database.MIGRATIONS]
+    assert get_schema_version() == applied[-1]
+
+
+def test_hot_queries_use_indexes():
+    """Every hot circulation query is answered through an index, not a table scan."""
+    for name, result in check_hot_query_plans().items():
+        assert result['uses_index'], f"{name} does a full scan: {result['plan']}"
+
+
+def test_hot_queries_scan_without_migration(tmp_path, monkeypatch):
+    """Without the index migration the same queries fall back to full scans."""
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'unindexed.db'))
+    database.init_database()
+
+    results = check_hot_query_plans()
+
+    assert not results['active_loan_count']['uses_index']
+    assert not results['latest_loan']['uses_index']
+
+
+def test_epoch_day_backfill_in_batches(tmp_path, monkeypatch):
+    """Existing ISO-only borrow records get matching day numbers, batch by batch."""
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'legacy.db'))
+    monkeypatch.setattr(database, 'BACKFILL_BATCH_SIZE', 2)
+    database.init_database()
+    conn = database.get_db_connection()
+    for i in range(5):
+        conn.execute(
+            'INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date, return_date) VALUES (?, ?, ?, ?, ?)',
+            ('123456', 1, f'2024-03-0{i + 1}T18:30:00', f'2024-03-1{i + 1}T18:30:00',
+             '2024-04-01T09:00:00' if i % 2 else None),
+        )
+    conn.commit()
+    conn.close()
+
+    run_migrations()
+
+    conn = database.get_db_connection()
+    try:
+        rows = conn.execute('SELECT * FROM borrow_records ORDER BY id').fetchall()
+    finally:
+        conn.close()
+    for row in rows:
+        assert row['borrow_day'] == database.epoch_day(datetime.fromisoformat(row['borrow_date']))
+        assert row['due_day'] == database.epoch_day(datetime.fromisoformat(row['due_date']))
+    assert rows[0]['return_day'] is None
+    assert rows[1]['return_day'] == database.epoch_day(date(2024, 4, 1))
+
+
+def test_triggers_fill_day_columns_for_iso_only_writers():
+    """Writers that only know the ISO columns still get consistent day numbers."""
+    conn = database.get_db_connection()
+    try:
+        conn.execute("INSERT INTO borrow_records (patron_id, book_id, borrow_date, due_date) "
+                     "VALUES ('123456', 1, '2024-01-01T10:00:00', '2024-01-15T10:00:00')")
+        conn.execute("UPDATE borrow_records SET return_date = '2024-01-20T08:00:00' WHERE patron_id = '123456'")
+        row = conn.execute("SELECT * FROM borrow_records WHERE patron_id = '123456'").fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+
+    assert row['due_day'] == database.epoch_day(date(2024, 1, 15))
+    assert row['return_day'] - row['due_day'] == 5
+
+
+def test_overdue_scan_uses_partial_due_day_index():
+    plan = database.explain_query_plan(database.OVERDUE_LOANS_SQL, (20000,))
+    assert plan == ['SEARCH borrow_records USING COVERING INDEX idx_borrow_records_overdue (due_day<?)']
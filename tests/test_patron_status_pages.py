@@ -0,0 +1,94 @@
+"""
+Tests for the paginated patron status report
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from app import create_app
+from services.library_service import get_patron_status_report
+
+
+@pytest.fixture
+def history():
+    """A patron with 7 loans: two open and overdue, the rest returned."""
+    database.insert_book("Title", "Author", "9400000000001", 10, 10)
+    book_id = database.get_book_by_isbn("9400000000001")['id']
+    start = datetime.now() - timedelta(days=60)
+    for n in range(7):
+        borrowed = start + timedelta(days=n * 3)
+        database.insert_borrow_record("100001", book_id, borrowed, borrowed + timedelta(days=14))
+        if n < 5:
+            database.update_borrow_record_return_date("100001", book_id, borrowed + timedelta(days=7))
+    # Same borrow date as the newest loan: ties are ordered by id
+    database.insert_borrow_record("100001", book_id, borrowed, borrowed + timedelta(days=14))
+    return book_id
+
+
+def all_pages(limit):
+    pages, cursor = [], None
+    while True:
+        page = get_patron_status_report("100001", limit=limit, after=cursor)
+        pages.append(page)
+        cursor = page['next_cursor']
+        if cursor is None:
+            return pages
+
+
+@pytest.mark.parametrize('limit', [1, 3, 8, 50])
+def test_pages_cover_history_in_order(history, limit):
+    full = get_patron_status_report("100001")
+
+    pages = all_pages(limit)
+
+    assert [b['id'] for p in pages for b in p['borrows']] == [b['id'] for b in full['borrows']]
+    assert all(len(p['borrows']) <= limit for p in pages)
+    for page in pages:
+        assert (page['borrowed_count'], page['total_late_fees']) == (
+            full['borrowed_count'], full['total_late_fees'])
+
+
+def test_full_report_is_unpaged(history):
+    report = get_patron_status_report("100001")
+
+    assert len(report['borrows']) == 8
+    assert 'next_cursor' not in report
+    ids = [(b['borrow_date'], b['id']) for b in report['borrows']]
+    assert ids == sorted(ids, reverse=True)
+
+
+def test_pages_read_from_ledger(history):
+    live = all_pages(3)
+
+    database.update_fines_ledger()
+
+    assert all_pages(3) == live
+
+
+def test_summary_only(history):
+    full = get_patron_status_report("100001")
+
+    summary = get_patron_status_report("100001", summary_only=True)
+
+    assert summary == {'patron_id': "100001", 'borrowed_count': 3,
+                       'total_late_fees': full['total_late_fees']}
+    assert summary['total_late_fees'] > 0
+
+
+def test_malformed_cursor_starts_from_first_page(history):
+    first = get_patron_status_report("100001", limit=2)
+    assert get_patron_status_report("100001", limit=2, after="not-a-cursor") == first
+
+
+def test_patron_status_api(history):
+    client = create_app().test_client()
+
+    first = client.get('/api/patrons/100001/status?limit=5').get_json()
+    second = client.get(f"/api/patrons/100001/status?limit=5&after={first['next_cursor']}").get_json()
+    summary = client.get('/api/patrons/100001/status?summary=1').get_json()
+
+    assert len(first['borrows']) == 5 and len(second['borrows']) == 3
+    assert second['next_cursor'] is None
+    assert 'borrows' not in summary
+    assert summary['total_late_fees'] == first['total_late_fees']
@@ -0,0 +1,168 @@
+"""
+Tests for paying all of a patron's late fees in one gateway charge
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import ANY, Mock
+
+import pytest
+
+import database
+from app import create_app
+from services import library_service
+from services.library_service import (
+    calculate_late_fee_for_book, get_cached_late_fee, get_patron_status_report, pay_all_late_fees,
+    pay_late_fees, prepare_late_fee_payment)
+from services.payment_service import PaymentGateway
+
+
+@pytest.fixture
+def gateway():
+    gateway = Mock(spec=PaymentGateway)
+    gateway.process_payment.return_value = (True, "txn_100001_1", "Payment processed")
+    return gateway
+
+
+def test_all_fees_are_charged_once(add_overdue_loan, gateway):
+    first = add_overdue_loan("100001", "9400000000001", 10)
+    second = add_overdue_loan("100001", "9400000000002", 3)
+    add_overdue_loan("100001", "9400000000003", -2)      # not due yet
+    add_overdue_loan("200002", "9400000000004", 10)      # someone else's
+
+    success, message, transaction_id, allocations = pay_all_late_fees("100001", gateway)
+
+    assert (success, message, transaction_id) == (True, "Payment successful! Payment processed", "txn_100001_1")
+    gateway.process_payment.assert_called_once_with(
+        patron_id="100001", amount=4.00, description="Late fees for 2 books", idempotency_key=ANY)
+    assert gateway.process_payment.call_args.kwargs['idempotency_key'].startswith("100001:all:")
+    assert [(a['book_id'], a['amount']) for a in allocations] == [(first, 3.25), (second, 0.75)]
+    assert allocations[0]['title'] == "Title 9400000000001"
+
+
+def test_allocations_are_recorded_per_book(add_overdue_loan, gateway):
+    first = add_overdue_loan("100001", "9400000000001", 10)
+    second = add_overdue_loan("100001", "9400000000002", 3)
+
+    pay_all_late_fees("100001", gateway)
+
+    rows = database.get_payment_allocations(database.get_payment(
+        prepare_late_fee_payment("100001", first)[1]['idempotency_key'])['charge_key'])
+    assert [(r['book_id'], r['amount'], r['status'], r['transaction_id']) for r in rows] == [
+        (first, 3.25, 'paid', "txn_100001_1"), (second, 0.75, 'paid', "txn_100001_1")]
+    assert get_patron_status_report("100001")['total_late_fees'] == 0.0
+    assert calculate_late_fee_for_book("100001", second)['status'] == 'Overdue (paid)'
+
+
+def test_books_paid_together_are_not_charged_again(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9400000000001", 10)
+    add_overdue_loan("100001", "9400000000002", 3)
+    pay_all_late_fees("100001", gateway)
+
+    assert pay_late_fees("100001", book_id, gateway) == (True, "Late fees already paid.", "txn_100001_1")
+    assert pay_all_late_fees("100001", gateway) == (False, "No late fees to pay.", None, [])
+    gateway.process_payment.assert_called_once()
+
+
+def test_only_the_unpaid_part_is_charged(add_overdue_loan, gateway):
+    paid = add_overdue_loan("100001", "9400000000001", 10)
+    unpaid = add_overdue_loan("100001", "9400000000002", 3)
+    pay_late_fees("100001", paid, gateway)
+
+    _, _, _, allocations = pay_all_late_fees("100001", gateway)
+
+    assert [(a['book_id'], a['amount']) for a in allocations] == [(unpaid, 0.75)]
+    assert gateway.process_payment.call_args.kwargs['description'] == "Late fees for 1 book"
+
+
+def test_fees_from_the_ledger(add_overdue_loan, gateway):
+    add_overdue_loan("100001", "9400000000001", 10)
+    add_overdue_loan("100001", "9400000000002", 3)
+    database.update_fines_ledger()
+
+    assert pay_all_late_fees("100001", gateway)[0]
+
+    assert gateway.process_payment.call_args.kwargs['amount'] == 4.00
+    assert get_patron_status_report("100001")['total_late_fees'] == 0.0
+
+
+@pytest.mark.parametrize('result, message', [
+    ((False, "", "Card declined"), "Payment failed: Card declined"),
+    (TimeoutError("timed out"), "Payment processing error: timed out"),
+])
+def test_failed_charge_can_be_retried(add_overdue_loan, gateway, result, message):
+    add_overdue_loan("100001", "9400000000001", 10)
+    gateway.process_payment.side_effect = [result, (True, "txn_100001_2", "Payment processed")]
+
+    assert pay_all_late_fees("100001", gateway) == (False, message, None, [])
+    assert get_patron_status_report("100001")['total_late_fees'] == 3.25
+
+    assert pay_all_late_fees("100001", gateway)[2] == "txn_100001_2"
+
+
+def test_charge_in_progress_blocks_another(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9400000000001", 10)
+    add_overdue_loan("100001", "9400000000002", 3)
+    _, payment = prepare_late_fee_payment("100001", book_id)
+    database.begin_payment(payment['idempotency_key'], "100001", book_id, payment['loan_id'], 3.25)
+
+    assert pay_all_late_fees("100001", gateway) == (
+        False, "A payment for these late fees is already in progress.", None, [])
+    gateway.process_payment.assert_not_called()
+    assert database.get_payment(payment['idempotency_key'])['charge_key'] is None
+
+
+def test_paid_books_drop_out_of_the_cache(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9400000000001", 10)
+    assert get_cached_late_fee("100001", book_id)['fee_amount'] == 3.25
+
+    pay_all_late_fees("100001", gateway)
+
+    assert get_cached_late_fee("100001", book_id)['fee_amount'] == 0.0
+
+
+def test_invalid_patron(gateway):
+    assert pay_all_late_fees("12", gateway) == (False, "Invalid patron ID. Must be exactly 6 digits.", None, [])
+
+
+def test_pay_all_api(add_overdue_loan, gateway, monkeypatch):
+    monkeypatch.setattr(library_service, 'PaymentGateway', lambda: gateway)
+    first = add_overdue_loan("100001", "9400000000001", 10)
+    client = create_app().test_client()
+
+    response = client.post('/api/patrons/100001/late_fees/pay')
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert (body['transaction_id'], body['total']) == ("txn_100001_1", 3.25)
+    assert body['allocations'][0]['book_id'] == first
+    response = client.post('/api/patrons/100001/late_fees/pay')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == "No late fees to pay."
+
+
+def test_concurrent_payers_with_a_small_pool(add_overdue_loan, monkeypatch):
+    database._pool = database.ConnectionPool(database.DATABASE, size=2, timeout=3)
+
+    def slow_charge(patron_id, amount, description="", idempotency_key=None):
+        time.sleep(0.3)
+        return True, f"txn_{patron_id}_1", "Payment processed"
+    monkeypatch.setattr(library_service, 'PaymentGateway',
+                        lambda: Mock(spec=PaymentGateway, process_payment=slow_charge))
+    patrons = [f"10000{n}" for n in range(4)]
+    for n, patron_id in enumerate(patrons):
+        add_overdue_loan(patron_id, f"940000000010{n}", 10)
+    app = create_app()
+
+    def pay(patron_id):
+        return app.test_client().post(f'/api/patrons/{patron_id}/late_fees/pay').status_code
+
+    def browse(_):
+        return app.test_client().get('/api/catalog').status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(8) as executor:
+        payments = executor.map(pay, patrons)
+        pages = executor.map(browse, range(8))
+        assert list(payments) == [200] * 4 and list(pages) == [200] * 8
+    assert time.perf_counter() - started < 2.5
+    assert database.get_pool_stats()['timeouts'] == 0
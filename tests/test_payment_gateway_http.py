@@ -0,0 +1,246 @@
+"""
+Tests for the HTTP payment gateway transport, against the local gateway stub
+"""
+import time
+from unittest.mock import Mock
+
+import pytest
+import requests
+
+from app import create_app
+from services import payment_service
+from services.gateway_stub import StubGatewayServer
+from services.library_service import pay_late_fees, refund_late_fee_payment
+from services.payment_service import (
+    CircuitBreaker, CircuitOpenError, GatewayClient, GatewayUnavailableError, PaymentGateway)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def stub():
+    with StubGatewayServer() as stub:
+        yield stub
+
+
+def make_gateway(stub, **options):
+    options.setdefault('backoff', 0)
+    client = GatewayClient(stub.url, **options)
+    return PaymentGateway(client=client), client
+
+
+def test_charge_over_http(stub):
+    gateway, _ = make_gateway(stub)
+
+    success, transaction_id, message = gateway.process_payment("123456", 5.00, "Late fees")
+
+    assert (success, transaction_id) == (True, "txn_123456_1")
+    assert message == "Payment of $5.00 processed successfully"
+    method, path, headers = stub.requests[0]
+    assert (method, path, headers['Authorization']) == ('POST', '/charges', "Bearer test_key_12345")
+    assert gateway.verify_payment_status(transaction_id)['status'] == "completed"
+    assert gateway.verify_payment_status("txn_missing") == {
+        "status": "not_found", "message": "Transaction not found"}
+
+
+def test_declines_are_returned_without_retrying(stub):
+    gateway, client = make_gateway(stub)
+
+    assert gateway.process_payment("123456", 5000.00) == (False, "", "Payment declined: amount exceeds limit")
+    assert gateway.process_payment("12345", 5.00) == (False, "", "Invalid patron ID format")
+    assert stub.stats()['requests'] == 2
+    assert client.stats()['breaker']['consecutive_failures'] == 0
+
+
+def test_refund_over_http(stub):
+    gateway, _ = make_gateway(stub)
+    _, transaction_id, _ = gateway.process_payment("123456", 5.00)
+
+    success, message = refund_late_fee_payment(transaction_id, 5.00, gateway)
+
+    assert success and message.endswith(f"Refund ID: refund_{transaction_id}_1")
+    assert gateway.refund_payment("txn_unknown", 5.00) == (False, "Invalid transaction ID")
+
+
+def test_connections_are_kept_alive(stub):
+    gateway, _ = make_gateway(stub)
+
+    for _ in range(5):
+        assert gateway.process_payment("123456", 1.00)[0]
+
+    assert stub.stats()['connections'] == 1
+
+
+def test_transient_errors_are_retried(stub):
+    gateway, client = make_gateway(stub)
+    stub.fail_next(2, status=503)
+
+    assert gateway.process_payment("123456", 5.00)[0]
+
+    stats = client.stats()
+    assert (stats['attempts'], stats['retries'], stats['errors']) == (3, 2, 2)
+    assert stub.stats()['charges'] == 1
+
+
+def test_retried_charge_after_lost_response_is_applied_once(stub):
+    gateway, client = make_gateway(stub, read_timeout=0.2)
+    stub.stall_next(1, seconds=1.0)
+
+    success, transaction_id, _ = gateway.process_payment("123456", 5.00)
+
+    assert (success, transaction_id) == (True, "txn_123456_1")
+    assert client.stats()['timeouts'] == 1
+    assert stub.stats()['charges'] == 1 and stub.stats()['replayed'] == 1
+    keys = {headers['Idempotency-Key'] for _, _, headers in stub.requests}
+    assert len(keys) == 1
+
+
+def test_slow_gateway_fails_within_deadline(stub):
+    gateway, client = make_gateway(stub, read_timeout=0.1, retries=1)
+    stub.latency = 1.0
+
+    started = time.perf_counter()
+    with pytest.raises(GatewayUnavailableError, match="after 2 attempts"):
+        gateway.process_payment("123456", 5.00)
+
+    assert time.perf_counter() - started < 0.9
+    assert client.stats()['timeouts'] == 2
+
+
+def test_backoff_is_jittered_and_capped(stub):
+    sleeps = []
+    gateway, _ = make_gateway(stub, retries=3, backoff=0.5, backoff_max=1.5, sleep=sleeps.append)
+    stub.fail_next(3)
+
+    assert gateway.process_payment("123456", 5.00)[0]
+
+    assert len(sleeps) == 3
+    assert all(0 <= s <= limit for s, limit in zip(sleeps, (1.0, 1.5, 1.5)))
+
+
+def test_circuit_opens_and_fails_fast(stub):
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30, clock=clock)
+    gateway, client = make_gateway(stub, retries=0, breaker=breaker)
+    stub.fail_next(2)
+
+    for _ in range(2):
+        with pytest.raises(GatewayUnavailableError):
+            gateway.process_payment("123456", 5.00)
+    with pytest.raises(CircuitOpenError):
+        gateway.process_payment("123456", 5.00)
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert stub.stats()['requests'] == 2
+    assert client.stats()['rejected'] == 1
+
+    clock.now = 30
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert gateway.process_payment("123456", 5.00)[0]
+    stats = breaker.stats()
+    assert stats['state'] == CircuitBreaker.CLOSED
+    assert (stats['opened'], stats['half_opened'], stats['closed'], stats['rejected']) == (1, 1, 1, 1)
+
+
+def test_failed_trial_call_reopens_circuit():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.record_failure()
+    clock.now = 10
+
+    assert breaker.allow()
+    assert not breaker.allow()      # one trial call at a time
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.stats()['opened'] == 2
+    clock.now = 15
+    assert not breaker.allow()
+
+
+def test_unreachable_gateway():
+    with StubGatewayServer() as stub:
+        url = stub.url
+    gateway = PaymentGateway(client=GatewayClient(url, retries=1, backoff=0, connect_timeout=0.5))
+
+    with pytest.raises(GatewayUnavailableError):
+        gateway.verify_payment_status("txn_123456_1")
+
+
+def test_gateway_url_from_environment(stub, monkeypatch):
+    monkeypatch.setenv('PAYMENT_GATEWAY_URL', stub.url)
+    monkeypatch.setattr(payment_service, '_clients', {})
+
+    first, second = PaymentGateway(), PaymentGateway()
+
+    assert first.client is second.client and first.base_url == stub.url
+    assert first.process_payment("123456", 5.00)[0]
+    metrics = create_app().test_client().get('/api/metrics').get_json()['payment_gateway']
+    assert metrics[stub.url]['breaker']['state'] == 'closed'
+    assert metrics[stub.url]['attempts'] == 1
+
+
+def test_simulated_gateway_is_the_default(monkeypatch):
+    monkeypatch.delenv('PAYMENT_GATEWAY_URL', raising=False)
+
+    gateway = PaymentGateway()
+
+    assert gateway.client is None
+    assert gateway.base_url == "https://api.payment-gateway.example.com"
+
+
+@pytest.mark.parametrize('failure', [requests.exceptions.ChunkedEncodingError("truncated"), ValueError("bug")])
+def test_unexpected_failure_of_trial_call_reopens_circuit(stub, failure):
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30, clock=clock)
+    gateway, client = make_gateway(stub, retries=0, breaker=breaker)
+    stub.fail_next(1)
+    with pytest.raises(GatewayUnavailableError):
+        gateway.process_payment("123456", 5.00)
+    clock.now = 30
+
+    def broken(*args, **kwargs):
+        raise failure
+    client.session.request = broken
+    with pytest.raises((GatewayUnavailableError, ValueError)):
+        gateway.process_payment("123456", 5.00)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    del client.session.request
+    clock.now = 60
+    assert gateway.process_payment("123456", 5.00)[0]
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_charge_with_a_lost_reply_is_not_repeated(add_overdue_loan, stub):
+    book_id = add_overdue_loan("123456", "9600000000001")
+    gateway, _ = make_gateway(stub, retries=0, read_timeout=0.2)
+    stub.stall_next(1, seconds=0.5)
+
+    first = pay_late_fees("123456", book_id, gateway)
+    second = pay_late_fees("123456", book_id, gateway)
+
+    assert first[0] is False and first[1].startswith("Payment processing error")
+    assert second == (True, "Payment successful! Payment of $3.25 processed successfully", "txn_123456_1")
+    assert (stub.stats()['charges'], stub.stats()['replayed']) == (1, 1)
+    keys = [headers['Idempotency-Key'] for _, _, headers in stub.requests]
+    assert keys == [f"123456:{book_id}:1:3.25#1"] * 2
+
+
+def test_declined_charge_is_retried_under_a_new_key(add_overdue_loan, stub):
+    book_id = add_overdue_loan("123456", "9600000000001")
+    gateway, _ = make_gateway(stub)
+    declined = Mock(spec=PaymentGateway)
+    declined.process_payment.return_value = (False, "", "Payment declined by card issuer")
+
+    assert pay_late_fees("123456", book_id, declined)[1] == "Payment failed: Payment declined by card issuer"
+    assert pay_late_fees("123456", book_id, gateway)[0]
+
+    assert declined.process_payment.call_args.kwargs['idempotency_key'].endswith("#1")
+    assert stub.requests[0][2]['Idempotency-Key'] == f"123456:{book_id}:1:3.25#2"
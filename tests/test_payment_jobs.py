@@ -0,0 +1,246 @@
+"""
+Tests for asynchronous late fee payment jobs
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+
+import database
+from app import create_app
+from services import payment_jobs as payment_jobs_module
+from services.payment_jobs import PaymentJobRunner
+
+
+class FakeGateway:
+    """Answers instantly, or blocks until released; records concurrency."""
+
+    def __init__(self, block=False, result=(True, "txn_100001_1", "Payment processed")):
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+        self.result = result
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    def process_payment(self, patron_id, amount, description="", idempotency_key=None):
+        with self._lock:
+            self.calls.append((patron_id, amount, description))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            self.release.wait(5)
+            if isinstance(self.result, Exception):
+                raise self.result
+            return self.result
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+@pytest.fixture
+def gateway():
+    return FakeGateway()
+
+
+@pytest.fixture
+def runner(gateway):
+    runner = PaymentJobRunner(workers=2, gateway_factory=lambda: gateway)
+    yield runner
+    gateway.release.set()
+    runner.shutdown()
+
+
+def test_payment_job_runs_in_background(add_overdue_loan, runner, gateway):
+    book_id = add_overdue_loan("100001", "9300000000001")
+    completed = []
+
+    success, message, job_id = runner.submit("100001", book_id, on_complete=completed.append)
+
+    assert success and job_id
+    assert message == "Payment of $3.25 queued."
+    job = runner.wait(job_id, timeout=5)
+    assert job['status'] == database.PAYMENT_JOB_SUCCEEDED
+    assert (job['transaction_id'], job['attempts'], job['amount']) == ("txn_100001_1", 1, 3.25)
+    assert gateway.calls == [("100001", 3.25, "Late fees for 'Title 9300000000001'")]
+    assert [c['id'] for c in completed] == [job_id]
+
+
+def test_submit_does_not_wait_for_gateway(add_overdue_loan):
+    gateway = FakeGateway(block=True)
+    runner = PaymentJobRunner(workers=1, gateway_factory=lambda: gateway)
+    book_id = add_overdue_loan("100001", "9300000000001")
+    try:
+        started = time.perf_counter()
+        success, _, job_id = runner.submit("100001", book_id)
+        assert success and time.perf_counter() - started < 1
+        assert database.get_payment_job(job_id)['status'] in (
+            database.PAYMENT_JOB_QUEUED, database.PAYMENT_JOB_RUNNING)
+    finally:
+        gateway.release.set()
+        runner.shutdown()
+    assert database.get_payment_job(job_id)['status'] == database.PAYMENT_JOB_SUCCEEDED
+
+
+def test_worker_pool_is_bounded(add_overdue_loan):
+    gateway = FakeGateway(block=True)
+    runner = PaymentJobRunner(workers=2, gateway_factory=lambda: gateway)
+    job_ids = [runner.submit("100001", add_overdue_loan("100001", f"930000000000{n}"))[2] for n in range(5)]
+    try:
+        time.sleep(0.2)
+        assert gateway.active == 2
+        assert runner.stats()['in_flight'] == 5
+        gateway.release.set()
+        assert all(runner.wait(j, timeout=5)['status'] == database.PAYMENT_JOB_SUCCEEDED for j in job_ids)
+    finally:
+        gateway.release.set()
+        runner.shutdown()
+    assert gateway.max_active == 2
+
+
+def test_shutdown_leaves_queued_jobs_for_resume(add_overdue_loan):
+    gateway = FakeGateway(block=True)
+    runner = PaymentJobRunner(workers=1, gateway_factory=lambda: gateway)
+    job_ids = [runner.submit("100001", add_overdue_loan("100001", f"930000000000{n}"))[2] for n in range(3)]
+    time.sleep(0.1)
+    runner.shutdown(wait=False)
+    gateway.release.set()
+    runner.wait(job_ids[0], timeout=5)
+
+    statuses = [database.get_payment_job(j)['status'] for j in job_ids]
+    assert statuses == ['succeeded', 'queued', 'queued']
+
+    restarted = PaymentJobRunner(workers=1, gateway_factory=lambda: gateway)
+    assert restarted.resume() == {'resumed': 2, 'interrupted': 0}
+    assert all(restarted.wait(j, timeout=5)['status'] == 'succeeded' for j in job_ids)
+    restarted.shutdown()
+
+
+@pytest.mark.parametrize('result, message', [
+    ((False, "", "Payment declined"), "Payment failed: Payment declined"),
+    (ConnectionError("gateway down"), "Payment processing error: gateway down"),
+])
+def test_failed_payment_is_recorded(add_overdue_loan, runner, gateway, result, message):
+    gateway.result = result
+    book_id = add_overdue_loan("100001", "9300000000001")
+
+    _, _, job_id = runner.submit("100001", book_id)
+
+    job = runner.wait(job_id, timeout=5)
+    assert (job['status'], job['message'], job['transaction_id']) == (
+        database.PAYMENT_JOB_FAILED, message, None)
+
+
+def test_invalid_payment_is_not_queued(runner, gateway):
+    database.insert_book("Title", "Author", "9300000000001", 1, 1)
+    book_id = database.get_book_by_isbn("9300000000001")['id']
+
+    assert runner.submit("12", book_id) == (False, "Invalid patron ID. Must be exactly 6 digits.", None)
+    assert runner.submit("100001", book_id) == (False, "No late fees to pay for this book.", None)
+    assert database.get_payment_job_counts() == {}
+
+
+def test_resume_after_restart(add_overdue_loan, runner, gateway):
+    book_id = add_overdue_loan("100001", "9300000000001")
+    queued = database.insert_payment_job("job-queued", "100001", book_id, 3.25, "Late fees")
+    database.insert_payment_job("job-running", "100001", book_id, 3.25, "Late fees")
+    database.claim_payment_job("job-running", "dead-runner")
+    backdate_heartbeat("job-running", runner.stale_after + 1)
+
+    assert runner.resume() == {'resumed': 1, 'interrupted': 1}
+
+    assert runner.wait(queued['id'], timeout=5)['status'] == database.PAYMENT_JOB_SUCCEEDED
+    assert database.get_payment_job("job-running")['status'] == database.PAYMENT_JOB_INTERRUPTED
+    assert len(gateway.calls) == 1
+    assert runner.resume() == {'resumed': 0, 'interrupted': 0}
+
+
+def backdate_heartbeat(job_id, seconds):
+    conn = database.get_db_connection()
+    try:
+        conn.execute("UPDATE payment_jobs SET updated_at = ? WHERE id = ?",
+                     ((datetime.now() - timedelta(seconds=seconds)).isoformat(), job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_resume_leaves_jobs_of_live_runners_alone(add_overdue_loan):
+    """A second process starting up must not interrupt a charge another one is making."""
+    book_id = add_overdue_loan("100001", "9300000000001")
+    gateway = FakeGateway(block=True)
+    busy = PaymentJobRunner(workers=1, gateway_factory=lambda: gateway, heartbeat=0.05)
+    starting = PaymentJobRunner(workers=1, gateway_factory=lambda: gateway, stale_after=0.5)
+    try:
+        _, _, job_id = busy.submit("100001", book_id)
+        while not gateway.calls:
+            time.sleep(0.01)
+        time.sleep(1.0)     # past stale_after, but heartbeats keep the claim fresh
+
+        assert starting.resume() == {'resumed': 0, 'interrupted': 0}
+        assert database.get_payment_job(job_id)['claimed_by'] == busy.owner
+
+        gateway.release.set()
+        assert busy.wait(job_id, timeout=5)['status'] == database.PAYMENT_JOB_SUCCEEDED
+    finally:
+        gateway.release.set()
+        busy.shutdown()
+        starting.shutdown()
+
+
+def test_job_is_claimed_once(runner, gateway):
+    database.insert_payment_job("job-1", "100001", 1, 3.25, "Late fees")
+
+    assert database.claim_payment_job("job-1")['status'] == database.PAYMENT_JOB_RUNNING
+    assert database.claim_payment_job("job-1") is None
+
+
+def test_payment_api(add_overdue_loan, monkeypatch, runner):
+    monkeypatch.setattr(payment_jobs_module, 'payment_jobs', runner)
+    book_id = add_overdue_loan("100001", "9300000000001")
+    client = create_app().test_client()
+
+    response = client.post('/api/payments', json={'patron_id': "100001", 'book_id': book_id})
+
+    assert response.status_code == 202
+    body = response.get_json()
+    assert body['status_url'] == f"/api/payments/{body['job_id']}"
+    runner.wait(body['job_id'], timeout=5)
+    job = client.get(body['status_url']).get_json()
+    assert job['status'] == 'succeeded'
+    metrics = client.get('/api/metrics').get_json()['payment_jobs']
+    assert metrics['jobs'] == {'succeeded': 1} and metrics['workers'] == 2
+
+
+def test_payment_api_errors(monkeypatch, runner):
+    monkeypatch.setattr(payment_jobs_module, 'payment_jobs', runner)
+    client = create_app().test_client()
+
+    assert client.get('/api/payments/unknown').status_code == 404
+    assert client.post('/api/payments', json={'patron_id': "100001"}).status_code == 400
+    response = client.post('/api/payments', json={'patron_id': "100001", 'book_id': 99})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == "No late fees to pay for this book."
+
+
+def test_concurrent_submits_with_a_small_pool(add_overdue_loan, monkeypatch, runner):
+    database._pool = database.ConnectionPool(database.DATABASE, size=2, timeout=3)
+    monkeypatch.setattr(payment_jobs_module, 'payment_jobs', runner)
+    books = [add_overdue_loan(f"10000{n}", f"930000000010{n}") for n in range(4)]
+    app = create_app()
+
+    def submit(n):
+        return app.test_client().post('/api/payments', json={'patron_id': f"10000{n}", 'book_id': books[n]})
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(4) as executor:
+        responses = list(executor.map(submit, range(4)))
+    assert [r.status_code for r in responses] == [202] * 4
+    assert time.perf_counter() - started < 2.5
+    for response in responses:
+        assert runner.wait(response.get_json()['job_id'], timeout=5)['status'] == 'succeeded'
+    assert database.get_pool_stats()['timeouts'] == 0
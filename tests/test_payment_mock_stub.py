@@ -50,7 +50,8 @@ def test_pay_late_fees_successful_payment(mocker):
     mock_gateway.process_payment.assert_called_once_with(
         patron_id="123456",
         amount=5.00,
-        description="Late fees for 'The Great Gatsby'"
+        description="Late fees for 'The Great Gatsby'",
+        idempotency_key="123456:1:-:5.00#1"
     )
 
 
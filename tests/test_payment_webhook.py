@@ -0,0 +1,268 @@
+"""
+Tests for webhook completion of payments, against the local gateway stub
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+import pytest
+import requests
+from werkzeug.serving import make_server
+
+import database
+from app import create_app
+from services.gateway_stub import StubGatewayServer
+from services.library_service import (
+    calculate_late_fee_for_book, complete_payment_from_webhook, get_cached_late_fee, pay_all_late_fees,
+    pay_late_fees, submit_late_fee_payment, WEBHOOK_BAD_SIGNATURE, WEBHOOK_IGNORED, WEBHOOK_MALFORMED,
+    WEBHOOK_NOT_CONFIGURED, WEBHOOKS_NOT_CONFIGURED)
+from services.payment_service import (
+    PaymentGateway, WEBHOOK_SIGNATURE_HEADER, sign_webhook, verify_webhook_signature)
+
+CALLBACK_URL = "http://127.0.0.1:1/api/payments/webhook"
+
+
+@pytest.fixture
+def app_url():
+    """The app served over HTTP, so the stub can post webhooks to it."""
+    server = make_server('127.0.0.1', 0, create_app(), threaded=True)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    thread.join()
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    with StubGatewayServer() as stub:
+        monkeypatch.setenv('PAYMENT_GATEWAY_URL', stub.url)
+        yield stub
+
+
+def submitted_gateway(transaction_id="txn_100001_1"):
+    gateway = Mock(spec=PaymentGateway)
+    gateway.submit_payment.return_value = (True, transaction_id, "Payment accepted")
+    return gateway
+
+
+def event(event_id="evt_1", event_type="charge.succeeded", transaction_id="txn_100001_1", reference=None,
+          message="Payment of $3.25 processed successfully", amount=3.25):
+    return json.dumps({"id": event_id, "type": event_type, "created": int(time.time()),
+                       "data": {"transaction_id": transaction_id, "reference": reference,
+                                "amount": amount, "message": message}}).encode()
+
+
+def deliver(payload, secret=None):
+    secret = secret or os.environ['PAYMENT_WEBHOOK_SECRET']
+    return complete_payment_from_webhook(payload, sign_webhook(payload, secret))
+
+
+def test_signatures():
+    payload = event()
+    header = sign_webhook(payload, "secret", timestamp=1000)
+
+    assert verify_webhook_signature(payload, header, "secret", now=1010)
+    assert not verify_webhook_signature(payload + b" ", header, "secret", now=1010)
+    assert not verify_webhook_signature(payload, header, "other", now=1010)
+    assert not verify_webhook_signature(payload, header, "secret", now=2000)
+    for bad in (None, "", "v1=abc", "t=x,v1=abc", "garbage"):
+        assert not verify_webhook_signature(payload, bad, "secret", now=1010)
+
+
+def test_submit_returns_before_completion(add_overdue_loan):
+    book_id = add_overdue_loan()
+    gateway = submitted_gateway()
+
+    result = submit_late_fee_payment("100001", book_id, CALLBACK_URL, gateway)
+
+    assert result == (True, "Payment submitted; awaiting confirmation from the payment gateway.", "txn_100001_1")
+    kwargs = gateway.submit_payment.call_args.kwargs
+    assert (kwargs['amount'], kwargs['callback_url']) == (3.25, CALLBACK_URL)
+    record = database.get_payment(kwargs['reference'])
+    assert (record['status'], record['transaction_id']) == (database.PAYMENT_SUBMITTED, "txn_100001_1")
+    assert calculate_late_fee_for_book("100001", book_id)['fee_amount'] == 3.25
+
+
+def test_submitted_payment_blocks_other_charges(add_overdue_loan):
+    book_id = add_overdue_loan()
+    submit_late_fee_payment("100001", book_id, CALLBACK_URL, submitted_gateway())
+    gateway = Mock(spec=PaymentGateway)
+
+    assert pay_late_fees("100001", book_id, gateway) == (
+        False, "A payment for these late fees is already in progress.", None)
+    assert pay_all_late_fees("100001", gateway)[1] == "A payment for these late fees is already in progress."
+    gateway.process_payment.assert_not_called()
+
+
+def test_succeeded_event_settles_the_payment(add_overdue_loan):
+    book_id = add_overdue_loan()
+    submit_late_fee_payment("100001", book_id, CALLBACK_URL, submitted_gateway())
+    assert get_cached_late_fee("100001", book_id)['fee_amount'] == 3.25
+
+    outcome, details = deliver(event())
+
+    assert (outcome, details['payments_updated']) == (database.WEBHOOK_APPLIED, 1)
+    assert get_cached_late_fee("100001", book_id)['fee_amount'] == 0.0
+    assert pay_late_fees("100001", book_id, Mock(spec=PaymentGateway))[:2] == (True, "Late fees already paid.")
+
+
+def test_duplicate_deliveries_apply_once(add_overdue_loan):
+    book_id = add_overdue_loan()
+    submit_late_fee_payment("100001", book_id, CALLBACK_URL, submitted_gateway())
+    payload = event()
+
+    with ThreadPoolExecutor(8) as executor:
+        outcomes = list(executor.map(lambda _: deliver(payload)[0], range(8)))
+
+    assert sorted(outcomes) == [database.WEBHOOK_APPLIED] + [database.WEBHOOK_DUPLICATE] * 7
+    late_failure = deliver(event("evt_1", "charge.failed"))
+    assert late_failure[0] == database.WEBHOOK_DUPLICATE
+    assert database.get_payments_by_transaction("txn_100001_1")[0]['status'] == database.PAYMENT_PAID
+
+
+def test_failed_event_allows_a_retry(add_overdue_loan):
+    book_id = add_overdue_loan()
+    submit_late_fee_payment("100001", book_id, CALLBACK_URL, submitted_gateway())
+
+    assert deliver(event(event_type="charge.failed", message="Payment declined by card issuer"))[0] == \
+        database.WEBHOOK_APPLIED
+
+    record = database.get_payments_by_transaction("txn_100001_1")[0]
+    assert (record['status'], record['message']) == (database.PAYMENT_FAILED, "Payment declined by card issuer")
+    assert submit_late_fee_payment("100001", book_id, CALLBACK_URL, submitted_gateway("txn_100001_2"))[0]
+
+
+def test_success_wins_over_failure_but_not_the_reverse(add_overdue_loan):
+    book_id = add_overdue_loan()
+    gateway = submitted_gateway()
+    gateway.submit_payment.side_effect = ConnectionError("read timed out")
+    assert submit_late_fee_payment("100001", book_id, CALLBACK_URL, gateway)[1] == \
+        "Payment processing error: read timed out"
+    key = gateway.submit_payment.call_args.kwargs['reference']
+
+    # The gateway took the charge after all: its success settles the failed payment by reference
+    assert deliver(event(transaction_id="txn_100001_9", reference=key))[0] == database.WEBHOOK_APPLIED
+    assert database.get_payment(key)['status'] == database.PAYMENT_PAID
+    assert deliver(event("evt_2", "charge.failed", transaction_id="txn_100001_9"))[0] == database.WEBHOOK_APPLIED
+    assert database.get_payment(key)['status'] == database.PAYMENT_PAID
+
+
+def test_success_for_the_wrong_amount_is_not_settled(add_overdue_loan):
+    book_id = add_overdue_loan()
+    submit_late_fee_payment("100001", book_id, CALLBACK_URL, submitted_gateway())
+
+    assert deliver(event(amount=0.25)) == (database.WEBHOOK_AMOUNT_MISMATCH,
+                                           {'event_id': "evt_1", 'payments_updated': 0})
+    assert deliver(event(amount=0.25))[0] == database.WEBHOOK_DUPLICATE
+    assert deliver(event("evt_2", amount=None))[0] == database.WEBHOOK_AMOUNT_MISMATCH
+
+    assert database.get_payments_by_transaction("txn_100001_1")[0]['status'] == database.PAYMENT_SUBMITTED
+    found = database.get_payment_discrepancies()
+    assert [(d['event_id'], d['run_id'], d['kind'], d['expected_amount'], d['gateway_amount']) for d in found] == [
+        ("evt_1", None, database.DISCREPANCY_AMOUNT, 3.25, 0.25),
+        ("evt_2", None, database.DISCREPANCY_AMOUNT, 3.25, None)]
+    assert get_cached_late_fee("100001", book_id)['fee_amount'] == 3.25
+
+
+def test_rejected_events_change_nothing(add_overdue_loan):
+    book_id = add_overdue_loan()
+    submit_late_fee_payment("100001", book_id, CALLBACK_URL, submitted_gateway())
+    payload = event()
+
+    assert deliver(payload, secret="wrong")[0] == WEBHOOK_BAD_SIGNATURE
+    assert complete_payment_from_webhook(payload, None)[0] == WEBHOOK_BAD_SIGNATURE
+    assert deliver(b"not json")[0] == WEBHOOK_MALFORMED
+    assert deliver(event(event_type="charge.dispute.created"))[0] == WEBHOOK_IGNORED
+    assert deliver(event("evt_9", transaction_id="txn_unknown"))[0] == database.WEBHOOK_UNKNOWN
+    assert database.get_payments_by_transaction("txn_100001_1")[0]['status'] == database.PAYMENT_SUBMITTED
+    # None of them was recorded, so the real event still applies
+    assert deliver(payload)[0] == database.WEBHOOK_APPLIED
+
+
+def test_simulated_gateway_cannot_complete_by_webhook(add_overdue_loan):
+    book_id = add_overdue_loan()
+
+    result = submit_late_fee_payment("100001", book_id, CALLBACK_URL, PaymentGateway())
+
+    assert result == (False, "Payment failed: Webhook payments need an HTTP payment gateway", None)
+
+
+def test_webhook_route_status_codes(webhook_secret):
+    client = create_app().test_client()
+    payload = event()
+
+    response = client.post('/api/payments/webhook', data=payload,
+                           headers={WEBHOOK_SIGNATURE_HEADER: sign_webhook(payload, "wrong")})
+    assert (response.status_code, response.get_json()['result']) == (401, WEBHOOK_BAD_SIGNATURE)
+    response = client.post('/api/payments/webhook', data=payload,
+                           headers={WEBHOOK_SIGNATURE_HEADER: sign_webhook(payload, webhook_secret)})
+    assert response.status_code == 404      # no such payment yet: the gateway should redeliver
+
+
+def test_end_to_end_through_the_stub(add_overdue_loan, app_url, stub):
+    stub.callback_delay = 0.2
+    stub.duplicate_callbacks = 2
+    book_id = add_overdue_loan()
+
+    started = time.perf_counter()
+    response = requests.post(app_url + '/api/payments',
+                             json={'patron_id': "100001", 'book_id': book_id, 'completion': "webhook"})
+    elapsed = time.perf_counter() - started
+
+    assert response.status_code == 202 and elapsed < stub.callback_delay
+    body = response.json()
+    assert (body['transaction_id'], body['status']) == ("txn_100001_1", 'submitted')
+    assert requests.get(app_url + body['status_url']).json()['status'] == database.PAYMENT_SUBMITTED
+
+    assert stub.wait_for_callbacks()
+    assert stub.callbacks == [("evt_1", 200)] * 3
+    status = requests.get(app_url + body['status_url']).json()
+    assert (status['status'], status['amount']) == (database.PAYMENT_PAID, 3.25)
+    assert stub.charges["txn_100001_1"]['status'] == "completed"
+    assert requests.get(f"{app_url}/api/late_fee/100001/{book_id}").json()['fee_amount'] == 0.0
+
+
+def test_declined_callback_through_the_stub(add_overdue_loan, app_url, stub):
+    stub.decline_next_callbacks()
+    book_id = add_overdue_loan()
+
+    response = requests.post(app_url + '/api/payments',
+                             json={'patron_id': "100001", 'book_id': book_id, 'completion': "webhook"})
+    assert stub.wait_for_callbacks()
+
+    status = requests.get(app_url + response.json()['status_url']).json()
+    assert (status['status'], status['payments'][0]['message']) == (
+        database.PAYMENT_FAILED, "Payment declined by card issuer")
+
+
+def test_unknown_completion_mode():
+    client = create_app().test_client()
+
+    response = client.post('/api/payments', json={'patron_id': "100001", 'book_id': 1, 'completion': "fax"})
+
+    assert response.status_code == 400
+
+
+def test_webhooks_fail_closed_without_a_secret(add_overdue_loan, monkeypatch, webhook_secret):
+    book_id = add_overdue_loan()
+    monkeypatch.delenv('PAYMENT_WEBHOOK_SECRET')
+    client = create_app().test_client()
+    payload = event()
+
+    response = client.post('/api/payments/webhook', data=payload,
+                           headers={WEBHOOK_SIGNATURE_HEADER: sign_webhook(payload, webhook_secret)})
+    assert (response.status_code, response.get_json()['result']) == (503, WEBHOOK_NOT_CONFIGURED)
+    response = client.post('/api/payments', json={'patron_id': "100001", 'book_id': book_id,
+                                                  'completion': "webhook"})
+    assert response.status_code == 503
+    gateway = submitted_gateway()
+    assert submit_late_fee_payment("100001", book_id, CALLBACK_URL, gateway) == (
+        False, WEBHOOKS_NOT_CONFIGURED, None)
+    gateway.submit_payment.assert_not_called()
+    with StubGatewayServer() as stub:
+        assert PaymentGateway(base_url=stub.url).submit_payment("100001", 3.25, callback_url=CALLBACK_URL) == (
+            False, "", "Webhooks are not configured: no webhook secret")
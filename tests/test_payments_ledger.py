@@ -0,0 +1,161 @@
+"""
+Tests for the idempotent late fee payments ledger
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+import pytest
+
+import database
+from app import create_app
+from services.library_service import (
+    calculate_late_fee_for_book, get_cached_late_fee, get_patron_status_report, pay_late_fees,
+    prepare_late_fee_payment, return_book_by_patron)
+from services.payment_jobs import PaymentJobRunner
+from services.payment_service import PaymentGateway
+
+
+@pytest.fixture
+def gateway():
+    gateway = Mock(spec=PaymentGateway)
+    gateway.process_payment.return_value = (True, "txn_100001_1", "Payment processed")
+    return gateway
+
+
+def test_repeat_payment_returns_stored_transaction(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9200000000001")
+
+    first = pay_late_fees("100001", book_id, gateway)
+    second = pay_late_fees("100001", book_id, gateway)
+
+    assert first == (True, "Payment successful! Payment processed", "txn_100001_1")
+    assert second == (True, "Late fees already paid.", "txn_100001_1")
+    gateway.process_payment.assert_called_once_with(
+        patron_id="100001", amount=3.25, description="Late fees for 'Title 9200000000001'",
+        idempotency_key=f"100001:{book_id}:1:3.25#1")
+
+
+def test_return_message_nets_off_paid_fees(add_overdue_loan, gateway):
+    paid_id = add_overdue_loan("100001", "9200000000001")
+    unpaid_id = add_overdue_loan("100001", "9200000000002", days_overdue=3)
+    pay_late_fees("100001", paid_id, gateway)
+
+    assert return_book_by_patron("100001", paid_id)[1].endswith(
+        "Late fee of $3.25 already paid (10 days overdue).")
+    assert return_book_by_patron("100001", unpaid_id)[1].endswith(
+        "Late fee owed: $0.75 (3 days overdue).")
+
+
+def test_paid_fee_is_reflected_in_fee_lookups(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9200000000001")
+    add_overdue_loan("100001", "9200000000002", days_overdue=3)
+
+    pay_late_fees("100001", book_id, gateway)
+
+    fee = calculate_late_fee_for_book("100001", book_id)
+    assert (fee['fee_amount'], fee['amount_paid'], fee['status']) == (0.0, 3.25, 'Overdue (paid)')
+    report = get_patron_status_report("100001")
+    assert report['total_late_fees'] == 0.75
+    assert [(b['fee_amount'], b['amount_paid']) for b in report['borrows']] == [(0.75, 0.0), (0.0, 3.25)]
+
+    database.update_fines_ledger()
+    assert get_patron_status_report("100001") == report
+    assert calculate_late_fee_for_book("100001", book_id) == fee
+
+
+def test_payment_clears_cached_fee(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9200000000001")
+    assert get_cached_late_fee("100001", book_id)['fee_amount'] == 3.25
+
+    pay_late_fees("100001", book_id, gateway)
+
+    assert get_cached_late_fee("100001", book_id)['fee_amount'] == 0.0
+
+
+def test_fee_accrued_after_payment_is_charged_separately(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9200000000001")
+    loan_id = calculate_late_fee_for_book("100001", book_id)['loan_id']
+    # An earlier payment, made when the loan had only accrued $1.00
+    database.begin_payment(f"100001:{book_id}:{loan_id}:1.00", "100001", book_id, loan_id, 1.00)
+    database.settle_payment(f"100001:{book_id}:{loan_id}:1.00", database.PAYMENT_PAID, "txn_old", "ok")
+
+    error, payment = prepare_late_fee_payment("100001", book_id)
+    success, _, transaction_id = pay_late_fees("100001", book_id, gateway)
+
+    assert error is None
+    assert payment['idempotency_key'] == f"100001:{book_id}:{loan_id}:3.25"
+    assert (success, transaction_id) == (True, "txn_100001_1")
+    assert gateway.process_payment.call_args.kwargs['amount'] == 2.25
+    assert calculate_late_fee_for_book("100001", book_id)['amount_paid'] == 3.25
+
+
+def test_failed_payment_can_be_retried(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9200000000001")
+    gateway.process_payment.side_effect = [(False, "", "Card declined"),
+                                           (True, "txn_100001_2", "Payment processed")]
+
+    assert pay_late_fees("100001", book_id, gateway) == (False, "Payment failed: Card declined", None)
+    assert pay_late_fees("100001", book_id, gateway)[2] == "txn_100001_2"
+    assert gateway.process_payment.call_count == 2
+
+
+def test_payment_in_progress_is_not_charged_again(add_overdue_loan, gateway, monkeypatch):
+    book_id = add_overdue_loan("100001", "9200000000001")
+    _, payment = prepare_late_fee_payment("100001", book_id)
+    database.begin_payment(payment['idempotency_key'], "100001", book_id, payment['loan_id'], 3.25)
+
+    assert pay_late_fees("100001", book_id, gateway) == (
+        False, "A payment for these late fees is already in progress.", None)
+    gateway.process_payment.assert_not_called()
+
+    # An abandoned claim can be taken over once it is stale
+    monkeypatch.setattr(database, 'PAYMENT_PENDING_TIMEOUT', -1)
+    assert pay_late_fees("100001", book_id, gateway)[0]
+
+
+def test_gateway_error_is_recorded(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9200000000001")
+    gateway.process_payment.side_effect = TimeoutError("timed out")
+
+    assert pay_late_fees("100001", book_id, gateway) == (False, "Payment processing error: timed out", None)
+
+    _, payment = prepare_late_fee_payment("100001", book_id)
+    record = database.get_payment(payment['idempotency_key'])
+    assert (record['status'], record['message']) == (database.PAYMENT_FAILED, "timed out")
+
+
+def test_duplicate_payment_jobs_charge_once(add_overdue_loan, gateway):
+    book_id = add_overdue_loan("100001", "9200000000001")
+    runner = PaymentJobRunner(workers=1, gateway_factory=lambda: gateway)
+    try:
+        job_ids = [runner.submit("100001", book_id)[2] for _ in range(2)]
+        jobs = [runner.wait(job_id, timeout=5) for job_id in job_ids]
+    finally:
+        runner.shutdown()
+
+    assert [(j['status'], j['transaction_id']) for j in jobs] == [
+        ('succeeded', "txn_100001_1"), ('succeeded', "txn_100001_1")]
+    assert jobs[1]['message'] == "Late fees already paid."
+    gateway.process_payment.assert_called_once()
+
+
+def test_concurrent_payments_with_a_small_pool(add_overdue_loan, gateway):
+    database._pool = database.ConnectionPool(database.DATABASE, size=2, timeout=3)
+
+    def slow_charge(patron_id, amount, description="", idempotency_key=None):
+        time.sleep(0.3)
+        return True, f"txn_{patron_id}_1", "Payment processed"
+    gateway.process_payment.side_effect = slow_charge
+    books = [add_overdue_loan(f"10000{n}", f"920000000010{n}") for n in range(4)]
+    app = create_app()
+
+    def pay(n):
+        with app.test_request_context():
+            return pay_late_fees(f"10000{n}", books[n], gateway)[0]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(pay, range(4))) == [True] * 4
+    assert time.perf_counter() - started < 2.5
+    assert database.get_pool_stats()['timeouts'] == 0
@@ -0,0 +1,63 @@
+"""
+Tests for the SQLite performance profile applied to pooled connections
+"""
+import pytest
+
+import database
+from database import configure_performance_profile, get_db_connection, get_performance_report
+
+
+@pytest.fixture
+def restore_profile(monkeypatch):
+    monkeypatch.setattr(database, 'PERFORMANCE_PROFILE', dict(database.PERFORMANCE_PROFILE))
+
+
+def test_profile_is_applied_to_connections():
+    """Every pooled connection runs with the production profile."""
+    report = get_performance_report()
+
+    assert report['journal_mode'] == 'wal'
+    assert report['synchronous'] == 1  # NORMAL
+    assert report['temp_store'] == 2   # MEMORY
+    assert report['busy_timeout'] == 5000
+    assert report['cache_size'] == database.PERFORMANCE_PROFILE['cache_size']
+
+
+def test_profile_can_be_overridden(restore_profile):
+    """Overrides take effect on connections opened after the change."""
+    configure_performance_profile(synchronous='FULL', busy_timeout=250)
+
+    report = get_performance_report()
+    assert report['synchronous'] == 2  # FULL
+    assert report['busy_timeout'] == 250
+
+
+def test_profile_rejects_unknown_or_unsafe_settings(restore_profile):
+    """Only known pragmas with plain values are accepted."""
+    with pytest.raises(ValueError):
+        configure_performance_profile(foreign_keys='ON')
+    with pytest.raises(ValueError):
+        configure_performance_profile(synchronous='OFF; DROP TABLE books')
+
+
+def test_readers_do_not_block_writers():
+    """With WAL a long-running read does not stop a borrow-style write from committing."""
+    database.insert_book("WAL Book", "Author", "5555555555555", 2, 2)
+    reader = get_db_connection()
+    writer = get_db_connection()
+    try:
+        reader.execute('BEGIN')
+        reader.execute('SELECT * FROM books').fetchall()
+
+        writer.execute('UPDATE books SET available_copies = available_copies - 1')
+        writer.commit()
+
+        # The reader keeps its snapshot until its transaction ends
+        stale = reader.execute("SELECT available_copies FROM books WHERE isbn = '5555555555555'").fetchone()
+        assert stale[0] == 2
+        reader.rollback()
+    finally:
+        reader.close()
+        writer.close()
+
+    assert database.get_book_by_isbn("5555555555555")['available_copies'] == 1
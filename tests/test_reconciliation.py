@@ -0,0 +1,139 @@
+"""
+Tests for the payment reconciliation job
+"""
+import json
+from datetime import datetime, timedelta
+from unittest.mock import Mock
+
+import cli
+import database
+from benchmarks.reconciliation import SimulatedGateway, run_reconciliation_benchmark
+from cache import LRUCache
+from services import payment_service
+from services.payment_service import PaymentGateway
+from services.reconciliation import reconcile_payments
+
+
+def add_payment(key, transaction_id, amount, status=database.PAYMENT_PAID, loan_id=1):
+    database.begin_payment(key, "100001", 1, loan_id, amount)
+    database.settle_payment(key, status, transaction_id, "ok")
+
+
+def test_matching_payments_are_verified_once():
+    add_payment("a", "txn_1", 3.25)
+    add_payment("b", "txn_2", 0.75)
+    gateway = SimulatedGateway({"txn_1": {"status": "completed", "amount": 3.25},
+                                "txn_2": {"status": "completed", "amount": 0.75}}, latency=0)
+
+    report = reconcile_payments(lambda: gateway)
+    rerun = reconcile_payments(lambda: gateway)
+
+    assert (report['checked'], report['verified'], report['discrepancies']) == (2, 2, 0)
+    assert (rerun['checked'], rerun['already_verified']) == (0, 2)
+    assert gateway.calls == 2
+
+
+def test_discrepancies_are_reported():
+    add_payment("a", "txn_1", 3.25)
+    add_payment("b", "txn_2", 0.75)
+    add_payment("c", "txn_3", 1.50)
+    add_payment("d", "txn_4", 2.00)
+    add_payment("e", None, 2.00, status=database.PAYMENT_FAILED)
+    gateway = SimulatedGateway({"txn_1": {"status": "completed", "amount": 3.25},
+                                "txn_2": {"status": "refunded", "amount": 0.75},
+                                "txn_3": {"status": "completed", "amount": 15.00}}, latency=0)
+
+    report = reconcile_payments(lambda: gateway)
+
+    assert (report['checked'], report['discrepancies']) == (4, 3)
+    found = database.get_payment_discrepancies(report['run_id'])
+    assert sorted((d['transaction_id'], d['kind'], d['gateway_status']) for d in found) == [
+        ("txn_2", 'status', "refunded"), ("txn_3", 'amount', "completed"), ("txn_4", 'not_found', "not_found")]
+    assert next(d for d in found if d['kind'] == 'amount')['gateway_amount'] == 15.00
+    assert reconcile_payments(lambda: gateway)['discrepancies'] == 0
+
+
+def test_consolidated_charge_is_checked_as_one_transaction():
+    for n in range(3):
+        add_payment(f"k{n}", "txn_1", 1.25, loan_id=n + 1)
+    gateway = Mock(spec=PaymentGateway)
+    gateway.verify_payment_status.return_value = {"status": "completed", "amount": 3.75}
+
+    report = reconcile_payments(lambda: gateway)
+
+    assert (report['checked'], report['discrepancies']) == (1, 0)
+    gateway.verify_payment_status.assert_called_once_with("txn_1")
+
+
+def test_unfinished_checks_are_retried_next_run():
+    add_payment("a", "txn_1", 3.25)
+    add_payment("b", "txn_2", 0.75)
+    gateway = Mock(spec=PaymentGateway)
+
+    def verify(transaction_id):
+        if transaction_id == "txn_2":
+            raise ConnectionError("gateway down")
+        return {"status": "pending"}
+    gateway.verify_payment_status.side_effect = verify
+
+    report = reconcile_payments(lambda: gateway)
+
+    assert (report['pending'], report['errors'], report['verified']) == (1, 1, 0)
+    gateway.verify_payment_status.side_effect = None
+    gateway.verify_payment_status.return_value = {"status": "completed", "amount": 3.25}
+    assert reconcile_payments(lambda: gateway)['checked'] == 2
+
+
+def test_simulated_gateway_payments_reconcile_cleanly():
+    """The built-in simulator reports each charge under its own id for the amount charged."""
+    gateway = PaymentGateway()
+    for key, amount in (("a", 3.25), ("b", 0.75)):
+        success, transaction_id, _ = gateway.process_payment("100001", amount, "Late fees")
+        assert success
+        add_payment(key, transaction_id, amount)
+
+    report = reconcile_payments(PaymentGateway)
+
+    assert (report['checked'], report['verified'], report['discrepancies']) == (2, 2, 0)
+
+
+def test_simulated_gateway_finds_charges_from_other_processes(monkeypatch):
+    """Charges this process never saw (a restart, another worker) are found in the ledger."""
+    success, transaction_id, _ = PaymentGateway().process_payment("100001", 3.25, "Late fees")
+    add_payment("a", transaction_id, 3.25)
+    add_payment("b", "txn_100001_unknown", 0.75, status=database.PAYMENT_FAILED)
+    monkeypatch.setattr(payment_service, '_simulated_charges', LRUCache(10))
+
+    report = reconcile_payments(PaymentGateway)
+
+    assert success
+    assert (report['checked'], report['verified'], report['discrepancies']) == (1, 1, 0)
+    assert PaymentGateway().verify_payment_status("txn_100001_unknown")['status'] == "not_found"
+
+
+def test_since_limits_the_window():
+    add_payment("a", "txn_1", 3.25)
+    gateway = SimulatedGateway({}, latency=0)
+
+    report = reconcile_payments(lambda: gateway, since=datetime.now() + timedelta(minutes=1))
+
+    assert report['checked'] == 0
+
+
+def test_checks_run_concurrently():
+    result = run_reconciliation_benchmark(transactions=60, workers=12, latency=0.05, mismatch_every=20)
+
+    assert result['elapsed_seconds'] < result['serial_estimate_seconds'] / 3
+    assert result['discrepancies'] == 3
+    assert (result['gateway_calls'], result['rerun_checked']) == (60, 0)
+
+
+def test_cli_reconcile_payments(capsys, monkeypatch):
+    add_payment("a", "txn_1", 3.25)
+    gateway = SimulatedGateway({"txn_1": {"status": "completed", "amount": 3.25}}, latency=0)
+    monkeypatch.setattr(cli, 'reconcile_payments',
+                        lambda **kwargs: reconcile_payments(lambda: gateway, **kwargs))
+
+    assert cli.main(['--database', database.DATABASE, 'reconcile-payments', '--workers', '2']) == 0
+
+    assert json.loads(capsys.readouterr().out)['verified'] == 1
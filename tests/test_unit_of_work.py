@@ -0,0 +1,80 @@
+"""
+Tests for the request-scoped unit of work used by the Flask app
+"""
+import pytest
+
+import database
+from app import create_app
+from database import get_pool_stats
+from services.library_service import borrow_book_by_patron
+
+
+@pytest.fixture
+def app():
+    app = create_app()
+    app.config['TESTING'] = True
+    return app
+
+
+def test_borrow_request_uses_one_connection(app):
+    """A whole /borrow request is served by a single pooled checkout."""
+    client = app.test_client()
+    before = get_pool_stats()['checkouts']
+
+    client.post('/borrow', data={'patron_id': '654321', 'book_id': '1'})
+
+    assert get_pool_stats()['checkouts'] - before == 1
+    assert database.get_patron_borrow_count('654321') == 1
+
+
+def test_late_fee_request_uses_one_connection(app):
+    """The late fee API does several lookups over one connection."""
+    client = app.test_client()
+    before = get_pool_stats()['checkouts']
+
+    response = client.get('/api/late_fee/123456/3')
+
+    assert response.status_code == 200
+    assert get_pool_stats()['checkouts'] - before == 1
+
+
+def test_connection_is_released_after_request(app):
+    """Nothing stays checked out once the request is over."""
+    app.test_client().get('/catalog')
+    assert get_pool_stats()['in_use'] == 0
+
+
+def test_commit_is_deferred_until_end_of_unit(app):
+    """Writes inside an app context are visible to it, but only committed at the end."""
+    with app.app_context():
+        database.insert_book("Deferred", "Author", "3333333333333", 1, 1)
+        assert database.get_book_by_isbn("3333333333333") is not None
+
+        other = database.get_pool().acquire()
+        try:
+            row = other.execute("SELECT 1 FROM books WHERE isbn = '3333333333333'").fetchone()
+        finally:
+            other.close()
+        assert row is None
+
+    assert database.get_book_by_isbn("3333333333333") is not None
+
+
+def test_unit_of_work_rolls_back_on_error(app):
+    """An exception escaping the app context discards the unit's writes."""
+    with pytest.raises(RuntimeError):
+        with app.app_context():
+            database.insert_book("Rolled Back", "Author", "4444444444444", 1, 1)
+            raise RuntimeError("boom")
+
+    assert database.get_book_by_isbn("4444444444444") is None
+    assert get_pool_stats()['in_use'] == 0
+
+
+def test_service_functions_work_outside_request_context(app):
+    """Without an app context the service layer falls back to the pool."""
+    success, message = borrow_book_by_patron("777777", 1)
+
+    assert success is True
+    assert database.get_patron_borrow_count("777777") == 1
+    assert get_pool_stats()['in_use'] == 0